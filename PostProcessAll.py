@@ -1,39 +1,70 @@
 #Author-Tim Paterson
 #Description-Post process all CAM setups, using the setup name as the output file name.
 
-import adsk.core, adsk.fusion, adsk.cam, traceback, shutil, json, os, os.path, time, re, pathlib, enum, tempfile
+import adsk.core, adsk.fusion, adsk.cam, traceback, shutil, json, os, os.path, time, re, pathlib, enum, tempfile, mmap, hashlib, math, threading, concurrent.futures, array
 
 # Version number of settings as saved in documents and settings file
 # update this whenever settings content changes
-version = 12
+version = 33
 
 # Initial default values of settings
 defaultSettings = {
     "version" : version,
     "ncProgram": "",
+    "alsoPrograms": [],
     "output" : "",
     "sequence" : True,
     "twoDigits" : False,
+    "machineCount" : 1,
     "delFiles" : False,
     "delFolder" : False,
     "splitSetup" : False,
     "combineTool" : False,
     "combineSetups" : False,
+    "alsoSetupFiles" : False,
+    "minimizeTravel" : False,
+    "movableOps" : "",
     "fastZ" : False,
+    "stockClearance" : 1.0,
+    "useTopHeight" : False,
+    "linkFeed" : 0,
+    "rapidRate" : 5000,
+    "arcFit" : False,
+    "arcTolerance" : 0.005,
+    "decimate" : False,
+    "decimateTolerance" : 0.002,
+    "cannedCycles" : False,
+    "subprograms" : "None",
     "toolChange" : "M9 G30",
     "numericName" : False,
     "endCodes" : "M5 M9 M30",
     "onlySelected" : False,
+    "onlyFailed" : False,
+    "watchMode" : False,
     "skipFirstToolchange" : False,
+    "prestageTool" : False,
+    "prestageFormat" : "T{}",
+    "fixtureWcs" : "",
+    "restartIndex" : False,
+    "linkIdentical" : False,
+    "hsmMode" : False,
+    "hsmStrategies" : "adaptive|contour|parallel|scallop|pencil|spiral|radial|morph|flow|steep|ramp|blend|horizontal|project",
+    "hsmOn" : "G05.1 Q1",
+    "hsmOff" : "G05.1 Q0",
     "appendOriginLocation" : True,
+    "batchQueue" : "",
+    "batchRun" : False,
     # Groups are expanded or not
     "groupPersonal" : True,
     "groupPost" : False,
     "groupAdvanced" : False,
     "groupRename" : False,
+    "groupBatch" : False,
     # Retry policy
     "initialDelay" : 0.2,
-    "postRetries" : 3
+    "postRetries" : 3,
+    "postTimeout" : 60,
+    "showStats" : False
 }
 
 # Constants
@@ -46,20 +77,54 @@ constCAMProductId = "CAMProductType"
 constAttrGroup = constCmdDefId
 constAttrName = "settings"
 constAttrCompressedName = "CompressedName"
+constAttrFailedName = "failedOps"
 constSettingsFileExt = ".settings"
 constPostLoopDelay = 0.1
+constCancelCheckLines = 10000  # lines read between checks for cancel
+constProgressSteps = 100        # progress dialog steps for each setup
 constBodyTmpFile = "gcodeBody"
 constOpTmpFile = "8910"   # in case name must be numeric
+constSpeculateName = "8911" # program name when posting ahead, also numeric
+constSpeculateFile = "8912" # file name when posting ahead, apart from the run's
 constRapidZgcode = 'G00 Z{} (Changed from: "{}")\n'
 constRapidXYgcode = 'G00 {} (Changed from: "{}")\n'
 constFeedZgcode = 'G01 Z{} F{} (Changed from: "{}")\n'
 constFeedXYgcode = 'G01 {} F{} (Changed from: "{}")\n'
 constFeedXYZgcode = 'G01 {} Z{} F{} (Changed from: "{}")\n'
 constAddFeedGcode = " F{} (Feed rate added)\n"
+constRapidXYZgcode = 'G00 {} Z{} (Changed from: "{}")\n'
 constMotionGcodeSet = {0,1,2,3,33,38,73,76,80,81,82,84,85,86,87,88,89}
 constHomeGcodeSet = {28, 30}
 constLineNumInc = 5
+constTailSpoolSize = 1024 * 1024   # tail kept in memory up to this size, then spilled to disk
+constCopyBlockSize = 1024 * 1024   # chunk size when copying unchanged G-code
 constNcProgramName = "PostProcessAll NC Program"
+constMachineFolder = "Machine {}"
+constEstRapidFeed = 500         # cm/min, for machining time estimates
+constEstToolChangeTime = 15     # seconds, for machining time estimates
+constArcMaxStep = math.pi / 8   # longest segment fitted, in radians of arc
+constStockBoxModes = ("default", "fixedbox", "relativebox")   # job_stockMode of a stock box
+constMinCycleHoles = 2          # fewest holes written as a canned cycle
+constMaxHeldMoves = 10000       # most moves a filter holds before writing them
+constSubNone = "None"
+constSubM98 = "M98 P / M99"
+constSubOword = "o-word call / sub"
+constSubMinBlocks = 20          # shortest run of moves made a subprogram
+constSubTmpExt = ".sub"         # output file being rewritten with subprograms
+constFirstSubprogram = 5001
+constRestartExt = ".restart.json"
+constPostError = "Fusion reported an error processing operation"
+constPostException = "Fusion reported an exception"
+constPostTimeout = "Fusion did not finish posting"
+constFailedComment = "(Operation {} failed to post and was left out)\n"
+constBatchStateExt = ".posted.json"
+constBatchReportExt = ".report.txt"
+constStillPosting = "Still posting. Try again when it's done."
+constWatchEventId = constCmdDefId + "_Watch"
+constWatchDelay = 2.0           # seconds after a change before checking toolpaths
+constSpeculateEventId = constCmdDefId + "_Speculate"
+constPostEventId = constCmdDefId + "_Post"
+constPostWaitDelay = 1.0        # seconds between checks for the posted document to be active
 
 # Tool tip text
 toolTip = (
@@ -82,11 +147,27 @@ handlers = []
 # Global settingsMgr object
 settingsMgr = None
 
+# Global watcher for watch mode
+watcher = None
+
+# Global speculator posting while the dialog is open
+speculator = None
+
+# Global poster running a post a setup at a time
+poster = None
+
+# Global flag set while posting, so watch mode doesn't start a post
+# from events handled during another one
+fPosting = False
+
 def run(context):
-    global settingsMgr
+    global settingsMgr, watcher, speculator, poster
     ui = None
     try:
         settingsMgr = SettingsManager()
+        watcher = SetupWatcher()
+        speculator = Speculator()
+        poster = Poster()
         app = adsk.core.Application.get()
         ui  = app.userInterface
         InitAddIn()
@@ -111,11 +192,1087 @@ def stop(context):
         cmdControl = addinsPanel.controls.itemById(constCmdDefId)
         if cmdControl:
             cmdControl.deleteMe()
+
+        if watcher:
+            watcher.Stop()
+        if speculator:
+            speculator.Stop()
+        if poster:
+            poster.Stop()
     except:
         if ui:
             ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))	
 
 
+class PostStats:
+    # Counters accumulated during a run, optionally reported at the end,
+    # and notes that are always reported
+    def __init__(self):
+        self.counts = dict()
+        self.details = dict()   # name -> {detail: value}, listed under the count
+        self.notes = []
+        self.lock = threading.Lock()    # also added to by the worker thread
+
+    def Add(self, name, value=1, detail=None):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+            if detail != None:
+                details = self.details.setdefault(name, dict())
+                details[detail] = details.get(detail, 0) + value
+
+    def Note(self, text):
+        with self.lock:
+            self.notes.append(text)
+
+    def Format(self, fCounts=True):
+        lines = list(self.notes)
+        if not fCounts:
+            return "\n".join(lines)
+        if len(lines) != 0 and len(self.counts) != 0:
+            lines.append("")
+        for name, value in self.counts.items():
+            lines.append(self.FormatCount(name, value))
+            for detail, value in self.details.get(name, dict()).items():
+                lines.append(self.FormatCount("    " + detail, value))
+        return "\n".join(lines)
+
+    @staticmethod
+    def FormatCount(name, value):
+        if isinstance(value, float):
+            return "{}: {:,.1f}".format(name, value)
+        return "{}: {:,}".format(name, value)
+
+
+class FragmentStore:
+    # G-code posted for each operation list during a run. Whatever output
+    # files are being assembled, Fusion is asked to post a given list of
+    # operations only once. Fragments are named by a hash of their content
+    # so identical toolpaths are stored once.
+    def __init__(self):
+        self.folder = None
+        self.fragments = dict() # key -> (fragment path, program name when posted)
+        self.outputs = dict()   # content hash -> first output file with it
+
+    def Key(self, program, opList):
+        ids = []
+        for op in opList:
+            try:
+                ids.append(op.operationId)
+            except:
+                ids.append(op.parentSetup.name + ":" + op.name)
+        return (program.name, tuple(ids))
+
+    def Get(self, program, opList):
+        return self.fragments.get(self.Key(program, opList))
+
+    def Drop(self, program, opList):
+        # forget the fragment so it's posted again
+        self.fragments.pop(self.Key(program, opList), None)
+
+    def Add(self, program, opList, path, name):
+        # move a freshly posted file into the store
+        if not self.folder:
+            self.folder = tempfile.mkdtemp(prefix="PostProcessAll").replace("\\", "/")
+        fragment = self.folder + "/" + HashFile(path) + os.path.splitext(path)[1]
+        if os.path.exists(fragment):
+            os.remove(path)
+        else:
+            os.replace(path, fragment)
+        entry = (fragment, name)
+        self.fragments[self.Key(program, opList)] = entry
+        return entry
+
+    def LinkIdentical(self, path):
+        # Replace an output file with a hard link to an earlier output in
+        # this run with the same content. Returns True if linked.
+        digest = HashFile(path)
+        first = self.outputs.get(digest)
+        if first == None or first == path or not os.path.exists(first):
+            self.outputs[digest] = path
+            return False
+        try:
+            os.link(first, path + ".link")
+            os.replace(path + ".link", path)
+            return True
+        except OSError:
+            return False    # file system can't do it, keep the copy
+
+    def Cleanup(self):
+        if self.folder:
+            shutil.rmtree(self.folder, True)
+            self.folder = None
+        self.fragments = dict()
+
+
+class PostCancelled(Exception):
+    # Raised when the user cancels in the middle of a file
+    pass
+
+
+class OutputError(Exception):
+    # Raised on the worker thread when the posted G-code can't be put
+    # together into an output file
+    pass
+
+
+class PostRun:
+    # State shared by everything posted in one run
+    def __init__(self):
+        self.stats = PostStats()
+        self.store = FragmentStore()
+        self.progress = None    # progress dialog currently shown
+        self.progressBase = 0   # progress value where the current setup starts
+        self.fCancelled = False
+        self.failures = []      # (NC program, setup, operation, error) not posted
+        self.worker = None      # thread finishing output files
+        self.finishing = []     # (output file, future) given to the worker
+        self.parameters = dict()    # NC program name -> ProgramParameters
+
+    def Parameters(self, program):
+        params = self.parameters.get(program.name)
+        if params == None:
+            params = self.parameters[program.name] = ProgramParameters(program)
+        return params
+
+    def Finish(self, path, function, *args):
+        # Finish an output file on the worker thread while Fusion goes
+        # on posting. The function must not use the Fusion API.
+        if not self.worker:
+            self.worker = concurrent.futures.ThreadPoolExecutor(1)
+        self.finishing.append((path, self.worker.submit(function, *args)))
+
+    def Wait(self):
+        # Wait for the worker to finish all output files, letting Fusion
+        # handle events in the meantime. Returns (output file, error) for
+        # each file that couldn't be finished, which was deleted.
+        failed = []
+        for path, future in self.finishing:
+            while not future.done():
+                adsk.doEvents()
+                try:
+                    future.result(constPostLoopDelay)
+                except Exception:
+                    pass
+            if future.exception() != None:
+                failed.append((path, str(future.exception())))
+        self.finishing = []
+        return failed
+
+    def CheckCancel(self):
+        # Let Fusion update the progress dialog, and raise PostCancelled
+        # if its cancel button was pressed
+        if self.progress:
+            adsk.doEvents()
+            if self.progress.wasCancelled:
+                self.fCancelled = True
+                raise PostCancelled()
+
+    def Close(self):
+        self.Wait()
+        if self.worker:
+            self.worker.shutdown()
+            self.worker = None
+        for params in self.parameters.values():
+            params.Restore()
+        self.parameters = dict()
+        self.store.Cleanup()
+
+
+class ProgramParameters:
+    # Parameters of an NC program changed for posting. Each write is a
+    # costly call into Fusion, so the values are kept here, only the ones
+    # that changed are written just before the next post, and the values
+    # from before the run are put back once at the end. The output folder
+    # may be kept in another form than written, so it is read back.
+    def __init__(self, program):
+        self.parameters = program.parameters
+        self.values = dict()    # name -> value in Fusion
+        self.pending = dict()   # name -> value to write before the next post
+        self.original = dict()  # name -> value to put back
+        self.written = dict()   # name -> (value written, value read back)
+
+    def Set(self, name, value):
+        if not name in self.values:
+            self.values[name] = self.parameters.itemByName(name).value.value
+        self.original.setdefault(name, self.values[name])
+        if self.values[name] == value or self.written.get(name) == (value, self.values[name]):
+            self.pending.pop(name, None)
+        else:
+            self.pending[name] = value
+
+    def RestoreTo(self, name, value):
+        # Put back this value at the end instead
+        self.original[name] = value
+
+    def Apply(self):
+        for name, value in self.pending.items():
+            if name == "nc_program_output_folder":
+                AssignOutputFolder(self.parameters, value)
+                self.written[name] = (value, self.parameters.itemByName(name).value.value)
+                self.values[name] = self.written[name][1]
+            else:
+                self.parameters.itemByName(name).value.value = value
+                self.values[name] = value
+        self.pending = dict()
+
+    def Restore(self):
+        self.pending = {name: value for name, value in self.original.items() if self.values.get(name) != value}
+        self.Apply()
+        self.original = dict()
+
+
+class WatchedFile:
+    # Posted G-code read a line at a time on the worker thread. Every
+    # constCancelCheckLines lines the run is checked for cancel, so a
+    # very long operation is given up soon after the user cancels.
+    # Everything else is passed to the file.
+    def __init__(self, path, run):
+        self.file = open(path, encoding="utf8", errors='replace')
+        self.run = run
+        self.cntLines = 0
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def readline(self):
+        self.cntLines += 1
+        if self.cntLines >= constCancelCheckLines:
+            self.cntLines = 0
+            if self.run.fCancelled:
+                raise PostCancelled("Cancelled by user")
+        return self.file.readline()
+
+
+class PostedPart:
+    # One posted fragment of an output file, with what putting it in the
+    # file needs from Fusion. It is read when the fragment is posted, so
+    # the file can be put together on the worker thread.
+    def __init__(self, fragment, postedName, iSetup, setup, opList, docSettings, regHsm):
+        self.fragment = fragment
+        self.postedName = postedName    # program name it was posted with
+        self.iSetup = iSetup            # tells the setups of a combined file apart
+        self.setupName = setup.name
+        self.opName = opList[0].name
+        self.fHsm = regHsm != None and IsHsmOperation(opList, regHsm)
+        self.stockTop = GetStockTop(setup, opList, docSettings) if docSettings["fastZ"] else None
+        self.nextTool = None            # tool to prestage, in a setup's own file
+        self.fMovable = False           # may be reordered to minimize travel
+
+
+class ModalState:
+    # Controller modal state while writing a combined program. A block
+    # that would leave the state unchanged is redundant and can be
+    # dropped. Anything not understood is assumed to be needed.
+    modalGcodes = {
+        0: "motion", 1: "motion", 2: "motion", 3: "motion", 80: "motion",
+        73: "motion", 74: "motion", 76: "motion", 81: "motion", 82: "motion", 83: "motion",
+        84: "motion", 85: "motion", 86: "motion", 87: "motion", 88: "motion", 89: "motion",
+        17: "plane", 18: "plane", 19: "plane",
+        20: "units", 21: "units",
+        43: "length", 44: "length", 49: "length",
+        54: "wcs", 55: "wcs", 56: "wcs", 57: "wcs", 58: "wcs", 59: "wcs",
+        90: "distance", 91: "distance",
+        93: "feedMode", 94: "feedMode", 95: "feedMode",
+        98: "retract", 99: "retract",
+    }
+    modalMcodes = {3: "spindle", 4: "spindle", 5: "spindle", 7: "coolant", 8: "coolant", 9: "coolant"}
+    stopMcodes = {0, 1, 2, 30}
+    axisLetters = "XYZABCUVWIJKRQ"
+    regComment = re.compile(r"\([^)]*\)|;.*")
+    regWord = re.compile(r"([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)")
+
+    def __init__(self):
+        self.modes = dict()         # group -> value; missing means unknown
+        self.homed = set()          # (G28/G30, axis) reached since the last move
+        self.fSpindleChanged = False    # since the last move or dwell
+        self.fSpindleSkipped = False    # spindle command dropped since the last move
+
+    def Snapshot(self):
+        # The state as G-code words, for a restart index
+        snapshot = dict()
+        for group, value in self.modes.items():
+            if group == "length":
+                snapshot[group] = "G{}".format(value[0]) + ("" if value[1] == None else " H{:g}".format(value[1]))
+            elif group in ("spindle", "coolant"):
+                snapshot[group] = "M{}".format(value)
+            elif group in ("tool", "nextTool", "speed", "feed"):
+                snapshot[group] = int(value) if value == int(value) else value
+            else:
+                snapshot[group] = "G{}".format(value)
+        return snapshot
+
+    def Update(self, line, fForce=False):
+        # Apply a block to the state and return True, or return False
+        # if the block is redundant. With fForce the block is applied
+        # regardless, for blocks that are written anyway.
+        text = self.regComment.sub("", line).strip().upper()
+        if len(text) == 0:
+            return True     # comment or blank line
+        words = self.regWord.findall(text)
+        if len(text) != sum(len(letter) + len(value) for letter, value in words) + text.count(" ") + text.count("\t"):
+            fUnknown = True     # something other than simple words, e.g. block delete
+        else:
+            fUnknown = False
+
+        changes = dict()
+        Gcodes = set()
+        Mcodes = set()
+        axes = set()
+        other = dict()
+        for letter, value in words:
+            try:
+                num = float(value)
+            except ValueError:
+                fUnknown = True
+                continue
+            if letter == "G":
+                if num == int(num) and int(num) in self.modalGcodes:
+                    Gcodes.add(int(num))
+                elif num in (4, 28, 30):
+                    Gcodes.add(int(num))
+                else:
+                    fUnknown = True
+            elif letter == "M":
+                if num == int(num) and (int(num) in self.modalMcodes or int(num) in self.stopMcodes or num == 6):
+                    Mcodes.add(int(num))
+                else:
+                    fUnknown = True
+            elif letter in self.axisLetters:
+                axes.add(letter)
+            elif letter in "FSTHP":
+                other[letter] = num
+            elif letter != "N":
+                fUnknown = True
+
+        for code in Gcodes:
+            if code in self.modalGcodes:
+                changes[self.modalGcodes[code]] = code
+        for code in Mcodes:
+            if code in self.modalMcodes:
+                changes[self.modalMcodes[code]] = code
+        if "length" in changes:
+            changes["length"] = (changes["length"], other.pop("H", None))
+        if "F" in other:
+            changes["feed"] = other.pop("F")
+        if "S" in other:
+            changes["speed"] = other.pop("S")
+        if 6 in Mcodes:
+            changes["tool"] = other.pop("T", self.modes.get("nextTool"))
+            if changes["tool"] == None:
+                fUnknown = True     # tool not known
+        elif "T" in other:
+            changes["nextTool"] = other.pop("T")
+        fDwell = 4 in Gcodes
+        if fDwell:
+            other.pop("P", None)
+        home = Gcodes & {28, 30}
+        if len(home) > 1 or (home and fDwell):
+            fUnknown = True
+        homes = set()
+        if home:
+            code = home.pop()
+            homes = {(code, axis) for axis in axes} if len(axes) != 0 else {(code, "*")}
+            axes = set()
+        if len(other) != 0:
+            fUnknown = True     # e.g. H or P without the code using it
+        fMove = fUnknown or len(axes) != 0
+        fStop = len(Mcodes & self.stopMcodes) != 0
+        fSpindleCmd = "spindle" in changes or "speed" in changes
+
+        fChanged = any(group not in self.modes or self.modes[group] != value for group, value in changes.items())
+        # a canned cycle left on would drill at every later move, so
+        # cancelling it is never dropped
+        fNeeded = fForce or fMove or fStop or fChanged or 80 in Gcodes or not homes <= self.homed or \
+            (fDwell and (self.fSpindleChanged or not self.fSpindleSkipped))
+        if not fNeeded:
+            if fSpindleCmd:
+                self.fSpindleSkipped = True
+            return False
+
+        # apply the block
+        for group, value in changes.items():
+            if group in ("spindle", "speed") and self.modes.get(group) != value:
+                self.fSpindleChanged = True
+            self.modes[group] = value
+        if 6 in Mcodes:
+            # tool change may stop the spindle and coolant
+            for group in ("spindle", "coolant", "length"):
+                self.modes.pop(group, None)
+        if fStop:
+            if Mcodes & {2, 30}:
+                self.modes = dict()
+            else:
+                for group in ("spindle", "coolant"):
+                    self.modes.pop(group, None)
+        if homes:
+            homeAxes = {axis for code, axis in homes}
+            self.homed = {item for item in self.homed if item[1] not in homeAxes and "*" not in homeAxes} | homes
+        if fMove or 6 in Mcodes:
+            self.homed = set()
+        if fMove or fDwell:
+            self.fSpindleChanged = False
+            self.fSpindleSkipped = False
+        return True
+
+
+class RapidRestorer:
+    # "Restore rapid moves" for one operation's G-code. Moves at feed rate
+    # that stay at or above the feed height are changed to rapid moves.
+    # With zSafe, the feed height is a height known to be clear of the
+    # stock; otherwise it is inferred from the first Z move. With linkFeed,
+    # XY air moves use that feed rate instead of rapid. The time saved is
+    # estimated using rapidRate (units/min).
+    regParseLine = re.compile(r""
+        r"(G(?P<G>[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
+        r"(?P<XY>((X-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
+        r"((Y-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?)"
+        r"(Z(?P<Z>-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
+        r"(F(?P<F>-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?",
+        re.IGNORECASE)
+    regGcodes = re.compile(r"G([0-9]+(?:\.[0-9]*)?)")
+    regXY = re.compile(r"([XY])(-?[0-9]+(?:\.[0-9]*)?)", re.IGNORECASE)
+
+    def __init__(self, zSafe=None, linkFeed=None, rapidRate=None):
+        self.fEnabled = True
+        self.fLockSpeed = False     # M49 in effect
+        self.fStock = zSafe != None
+        self.linkFeed = linkFeed
+        self.rapidRate = rapidRate
+        self.timeSaved = 0          # seconds, estimated
+        self.Gcode = None
+        self.X = None
+        self.Y = None
+        self.Zcur = None
+        self.Zlast = None
+        self.Zfeed = zSafe
+        self.fZfeedNotSet = True
+        self.feedCur = 0
+        self.fNeedFeed = False      # changed to rapid, next feed move needs G1 and F
+        self.fRestoreFeed = False   # changed to link feed, next feed move needs F
+
+    @staticmethod
+    def Above(z, zRef):
+        # z is known to be at or above zRef
+        return z != None and zRef != None and z >= zRef
+
+    def Saved(self, dist, rate):
+        # Add the time saved moving dist at rate instead of the feed rate
+        if dist != None and self.feedCur > 0 and rate:
+            self.timeSaved += max(dist / self.feedCur - dist / rate, 0) * 60
+
+    def AirMove(self, XYcur, Ztmp, line, dist):
+        # Replacement for a move clear of the stock: rapid, or link feed
+        if self.linkFeed:
+            self.Saved(dist, self.linkFeed)
+            self.fRestoreFeed = True
+            if Ztmp != None:
+                return constFeedXYZgcode.format(XYcur, Ztmp, self.linkFeed, line[:-1])
+            return constFeedXYgcode.format(XYcur, self.linkFeed, line[:-1])
+        self.Saved(dist, self.rapidRate)
+        self.fNeedFeed = True
+        self.Gcode = 0
+        if Ztmp != None:
+            return constRapidXYZgcode.format(XYcur, Ztmp, line[:-1])
+        return constRapidXYgcode.format(XYcur, line[:-1])
+
+    def Line(self, line):
+        # Returns the line, replaced if it was changed to a rapid move
+        if not self.fEnabled:
+            return line
+        match = self.regParseLine.match(line)
+        if match.end() == 0:
+            return line
+        try:
+            match = match.groupdict()
+            Gcodes = self.regGcodes.findall(line)
+            fNoMotionGcode = True
+            fHomeGcode = False
+            for GcodeTmp in Gcodes:
+                GcodeTmp = int(float(GcodeTmp))
+                if GcodeTmp in constHomeGcodeSet:
+                    fHomeGcode = True
+                    break
+
+                if GcodeTmp in constMotionGcodeSet:
+                    fNoMotionGcode = False
+                    self.Gcode = GcodeTmp
+                    if self.Gcode == 0:
+                        self.fNeedFeed = False
+                    break
+
+            if fHomeGcode:
+                self.X = None
+                self.Y = None
+                return line
+
+            Ztmp = match["Z"]
+            if Ztmp != None:
+                self.Zlast = self.Zcur
+                self.Zcur = float(Ztmp)
+            Zcur = self.Zcur
+            Zlast = self.Zlast
+
+            feedTmp = match["F"]
+            if feedTmp != None:
+                self.feedCur = float(feedTmp)
+
+            XYcur = match["XY"].rstrip("\n ")
+
+            # Length of the move, for the time saved
+            Xlast = self.X
+            Ylast = self.Y
+            for axis, value in self.regXY.findall(XYcur):
+                if axis.upper() == "X":
+                    self.X = float(value)
+                else:
+                    self.Y = float(value)
+            dist = None
+            if None not in (Xlast, Ylast, self.X, self.Y, Zcur) and (Ztmp == None or Zlast != None):
+                dist = math.dist((Xlast, Ylast, Zlast if Ztmp != None else Zcur), (self.X, self.Y, Zcur))
+            fLink = False
+
+            if not self.fStock and (self.Zfeed == None or self.fZfeedNotSet) and \
+                (self.Gcode == 0 or self.Gcode == 1) and Ztmp != None and len(XYcur) == 0:
+                # Figure out Z feed
+                if (self.Zfeed != None):
+                    self.fZfeedNotSet = False
+                self.Zfeed = Zcur
+                if self.Gcode != 0:
+                    # Replace line with rapid move
+                    line = constRapidZgcode.format(Zcur, line[:-1])
+                    self.Saved(dist, self.rapidRate)
+                    self.fNeedFeed = True
+                    self.Gcode = 0
+
+            Zfeed = self.Zfeed
+            if self.Gcode == 1 and not self.fLockSpeed:
+                if Ztmp != None:
+                    if len(XYcur) == 0 and (self.Above(Zcur, Zlast) or self.Above(Zcur, Zfeed) or self.feedCur == 0):
+                        # Upward move, above feed height, or anomalous feed rate.
+                        # Replace with rapid move
+                        line = constRapidZgcode.format(Zcur, line[:-1])
+                        self.Saved(dist, self.rapidRate)
+                        self.fNeedFeed = True
+                        self.Gcode = 0
+                    elif self.fStock and self.Above(Zcur, Zfeed) and self.Above(Zlast, Zfeed):
+                        # Starts and ends clear of the stock
+                        line = self.AirMove(XYcur, Zcur, line, dist)
+                        fLink = self.Gcode == 1
+
+                elif self.Above(Zcur, Zfeed):
+                    # No Z move, at/above feed height
+                    line = self.AirMove(XYcur, None, line, dist)
+                    fLink = self.Gcode == 1
+
+            elif self.fNeedFeed and fNoMotionGcode:
+                # No G-code present, changing to G1
+                if Ztmp != None:
+                    if len(XYcur) != 0:
+                        if not (self.fStock and self.Above(Zcur, Zfeed) and self.Above(Zlast, Zfeed)):
+                            # Not Z move only - back to G1
+                            line = constFeedXYZgcode.format(XYcur, Zcur, self.feedCur, line[:-1])
+                            self.fNeedFeed = False
+                            self.Gcode = 1
+                        elif self.linkFeed:
+                            line = self.AirMove(XYcur, Zcur, line, dist)
+                            fLink = True
+                            self.fNeedFeed = False
+                            self.Gcode = 1
+                        else:
+                            self.Saved(dist, self.rapidRate)
+                    elif not self.Above(Zcur, Zfeed) and (Zlast == None or Zcur <= Zlast):
+                        # Not up nor above feed height - back to G1
+                        line = constFeedZgcode.format(Zcur, self.feedCur, line[:-1])
+                        self.fNeedFeed = False
+                        self.Gcode = 1
+                    else:
+                        self.Saved(dist, self.rapidRate)
+
+                elif len(XYcur) != 0 and not self.Above(Zcur, Zfeed):
+                    # No Z move, below feed height - back to G1
+                    line = constFeedXYgcode.format(XYcur, self.feedCur, line[:-1])
+                    self.fNeedFeed = False
+                    self.Gcode = 1
+
+                elif len(XYcur) != 0 and self.linkFeed:
+                    line = self.AirMove(XYcur, None, line, dist)
+                    fLink = True
+                    self.fNeedFeed = False
+                    self.Gcode = 1
+
+                else:
+                    self.Saved(dist, self.rapidRate)
+
+            if self.Gcode != 0 and not fLink and (self.fNeedFeed or self.fRestoreFeed):
+                if (feedTmp == None):
+                    # Feed rate not present, add it
+                    line = line[:-1] + constAddFeedGcode.format(self.feedCur)
+                self.fNeedFeed = False
+                self.fRestoreFeed = False
+
+            if Zcur != None and Zfeed != None and Zcur >= Zfeed and self.Gcode != None and \
+                self.Gcode != 0 and not fLink and len(XYcur) != 0 and (Ztmp != None or self.Gcode != 1):
+                # We're at or above the feed height, but made a cutting move.
+                # Feed height is wrong, bring it up
+                self.Zfeed = Zcur + 0.001
+        except:
+            self.fEnabled = False # Just skip changes
+        return line
+
+
+class MoveFilter:
+    # Base for the filters that rewrite moves in one operation's G-code.
+    # Lines are passed in with Line(), which returns the text to write:
+    # nothing while moves are held, or several lines when they are
+    # released. Flush() returns what is held at the end. The position and
+    # modes of the input are followed so moves can be rewritten.
+    regWord = re.compile(r"([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)")
+    axisLetters = "XYZ"
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.pos = [None, None, None]   # X, Y, Z
+        self.motion = None          # motion mode of the input
+        self.fAbsolute = True
+        self.plane = 17
+        self.feed = None
+        self.decimals = 3
+        self.fModalOut = False      # motion mode written differs from the input
+
+    def Line(self, line):
+        return line
+
+    def Flush(self):
+        return ""
+
+    def Position(self):
+        # Current position, if all axes are known
+        return None if None in self.pos else tuple(self.pos)
+
+    def Pass(self, line, words):
+        # Line that isn't held. After rewritten moves, the motion
+        # mode of the input is restored on the next move.
+        self.Track(line, words)
+        if self.fModalOut:
+            if words == None:
+                code = re.sub(r"\([^)]*\)|;.*", "", line).upper()
+                if any(letter in code for letter in self.axisLetters) and self.motion in (0, 1, 2, 3):
+                    line = "G{} ".format(int(self.motion)) + line
+                    self.fModalOut = False
+                elif code.strip() != "":
+                    self.fModalOut = False
+            else:
+                if not any(letter == "G" and value in (0, 1, 2, 3) for letter, value in words) and \
+                    any(letter in self.axisLetters for letter, value in words) and self.motion in (0, 1, 2, 3):
+                    line = "G{} ".format(int(self.motion)) + line
+                self.fModalOut = False
+        return line
+
+    def Parse(self, line):
+        # Returns [(letter, value), ...] for a line of simple words, or None
+        text = line.strip().upper()
+        words = self.regWord.findall(text)
+        if len(words) == 0 or sum(len(letter) + len(value) for letter, value in words) + \
+            text.count(" ") != len(text):
+            return None
+        result = []
+        for letter, value in words:
+            try:
+                result.append((letter, float(value)))
+            except ValueError:
+                return None
+            if letter in self.axisLetters and "." in value:
+                self.decimals = max(self.decimals, len(value) - value.index(".") - 1)
+        return result
+
+    def Track(self, line, words):
+        # Follow the state of the input for a line that isn't held
+        if words == None:
+            if self.regWord.search(line.split("(")[0].upper()) != None:
+                self.pos = [None, None, None]   # not understood
+            return
+        fLost = False
+        for letter, value in words:
+            if letter == "G":
+                if value in (0, 1, 2, 3):
+                    self.motion = value
+                elif value in (17, 18, 19):
+                    self.plane = value
+                elif value in (90, 91):
+                    self.fAbsolute = value == 90
+                elif value not in (4, 20, 21, 40, 43, 49, 54, 55, 56, 57, 58, 59, 94):
+                    fLost = True    # canned cycle, home, etc.
+            elif letter == "F":
+                self.feed = value
+        if fLost:
+            self.motion = None
+            self.pos = [None, None, None]
+            return
+        if self.motion not in (0, 1, 2, 3):
+            return
+        for letter, value in words:
+            if letter in self.axisLetters:
+                if self.fAbsolute:
+                    self.pos["XYZ".index(letter)] = value
+                else:
+                    self.pos = [None, None, None]
+
+    def OnlyMoves(self, words):
+        # Words are just a move, with nothing else that could be lost
+        return all(letter in "GF" or letter in self.axisLetters for letter, value in words)
+
+    def FormatNumber(self, value):
+        text = "{:.{}f}".format(value, self.decimals)
+        text = text.rstrip("0") if "." in text else text + "."
+        if text in ("-.", "-0."):
+            text = "0."
+        return text
+
+
+
+class PathFilter(MoveFilter):
+    # Rewrites runs of linear (G1) moves in one operation's G-code, fitting
+    # arcs (G2/G3) to them where the arc passes within tolerance of every
+    # point, and dropping moves that are within tolerance of a straight
+    # line through their neighbors.
+
+    def __init__(self, arcTolerance, decimateTolerance, stats):
+        super().__init__(stats)
+        self.arcTol = arcTolerance
+        self.decimateTol = decimateTolerance
+        self.start = None           # where the held moves start
+        self.moves = []             # held moves: ((x, y, z), line)
+        self.feedWord = None        # F word of the first held move
+
+    def Line(self, line):
+        words = self.Parse(line)
+        if words != None and self.Position() != None:
+            Gcodes = [value for letter, value in words if letter == "G"]
+            axes = [(letter, value) for letter, value in words if letter in self.axisLetters]
+            feeds = [value for letter, value in words if letter == "F"]
+            motion = Gcodes[0] if len(Gcodes) == 1 else self.motion
+            if len(Gcodes) <= 1 and motion == 1 and len(axes) != 0 and len(feeds) <= 1 and self.fAbsolute and \
+                self.OnlyMoves(words):
+                # A linear move, hold it
+                fFeedChange = len(feeds) != 0 and feeds[0] != self.feed
+                text = self.Flush() if fFeedChange else ""
+                if len(self.moves) == 0:
+                    self.start = tuple(self.pos)
+                    self.feedWord = None
+                if fFeedChange:
+                    self.feed = feeds[0]
+                    self.feedWord = self.FormatNumber(feeds[0])
+                self.motion = 1
+                for letter, value in axes:
+                    self.pos["XYZ".index(letter)] = value
+                self.moves.append((tuple(self.pos), line))
+                if len(self.moves) >= constMaxHeldMoves:
+                    text += self.Flush()
+                return text
+
+        text = self.Flush()
+        return text + self.Pass(line, words)
+
+    def Flush(self):
+        # Release the held moves, with arcs where they fit and the
+        # remaining lines decimated
+        if len(self.moves) == 0:
+            return ""
+        points = [self.start] + [move[0] for move in self.moves]
+        self.out = []
+        self.last = self.start
+        self.feedPending = self.feedWord
+        lineStart = 0
+        i = 0
+        while i < len(self.moves):
+            j = None
+            if self.arcTol and self.plane == 17:
+                # longest arc from point i, at least 3 moves
+                k = i + 3
+                while k < len(points) and self.FitArc(points, i, k) != None:
+                    j = k
+                    k += 1
+            if j != None:
+                self.WriteLines(points, lineStart, i)
+                center, fCW = self.FitArc(points, i, j)
+                end = points[j]
+                block = "{} X{} Y{} I{} J{}".format("G2" if fCW else "G3",
+                    self.FormatNumber(end[0]), self.FormatNumber(end[1]),
+                    self.FormatNumber(center[0] - points[i][0]), self.FormatNumber(center[1] - points[i][1]))
+                self.WriteBlock(block, end)
+                self.stats.Add("Blocks removed by arc fitting", j - i - 1)
+                self.fModalOut = True
+                i = j
+                lineStart = i
+            else:
+                i += 1
+        self.WriteLines(points, lineStart, len(self.moves))
+        self.moves = []
+        return "".join(self.out)
+
+    def WriteLines(self, points, first, end):
+        # Write held moves first to end - 1 as lines, leaving out those
+        # that Decimate() finds aren't needed
+        if first == end:
+            return
+        if self.decimateTol:
+            kept = self.Decimate(points, first, end)
+            if len(kept) != end - first:
+                self.stats.Add("Blocks removed by decimation", end - first - len(kept))
+        else:
+            kept = range(first + 1, end + 1)
+        fDropped = False
+        for k in range(first, end):
+            if k + 1 not in kept:
+                fDropped = True
+                continue
+            line = self.moves[k][1]
+            if fDropped:
+                # rebuild it with the axes changed since the last block written
+                block = "G1"
+                for axis in range(3):
+                    if points[k + 1][axis] != self.last[axis]:
+                        block += " {}{}".format(self.axisLetters[axis], self.FormatNumber(points[k + 1][axis]))
+                self.WriteBlock(block, points[k + 1])
+                fDropped = False
+            else:
+                if self.fModalOut and "G" not in line.upper():
+                    line = "G1 " + line
+                if self.feedPending != None and "F" not in line.upper():
+                    line = line.rstrip("\n") + " F" + self.feedPending + "\n"
+                self.out.append(line)
+                self.feedPending = None
+                self.last = points[k + 1]
+            self.fModalOut = False
+
+    def WriteBlock(self, block, end):
+        if self.feedPending != None:
+            block += " F" + self.feedPending
+            self.feedPending = None
+        self.out.append(block + "\n")
+        self.last = end
+
+    def Decimate(self, points, first, end):
+        # Douglas-Peucker reduction of points[first] to points[end].
+        # Returns the set of indices kept, not including first.
+        kept = {end}
+        stack = [(first, end)]
+        while len(stack) != 0:
+            a, b = stack.pop()
+            if b - a < 2:
+                continue
+            dist, k = max((self.SegmentDistance(points[m], points[a], points[b]), m) for m in range(a + 1, b))
+            if dist > self.decimateTol:
+                kept.add(k)
+                stack.append((a, k))
+                stack.append((k, b))
+        return kept
+
+    @staticmethod
+    def SegmentDistance(point, a, b):
+        # Distance from point to the segment from a to b
+        ab = [b[axis] - a[axis] for axis in range(3)]
+        ap = [point[axis] - a[axis] for axis in range(3)]
+        length = sum(v * v for v in ab)
+        t = 0 if length == 0 else max(0, min(1, sum(ab[axis] * ap[axis] for axis in range(3)) / length))
+        return math.dist(point, [a[axis] + ab[axis] * t for axis in range(3)])
+
+    def FitArc(self, points, i, j):
+        # Arc in the XY plane from points[i] to points[j] that is within
+        # tolerance of every point and every segment between them, with the
+        # points in order around it. Returns (center, fClockwise), or None.
+        z = points[i][2]
+        if any(point[2] != z for point in points[i + 1:j + 1]):
+            return None
+        (x1, y1), (x2, y2), (x3, y3) = [points[k][:2] for k in (i, (i + j) // 2, j)]
+        d = 2 * (x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2))
+        if abs(d) < 1e-12:
+            return None     # straight
+        s1 = x1 * x1 + y1 * y1
+        s2 = x2 * x2 + y2 * y2
+        s3 = x3 * x3 + y3 * y3
+        center = ((s1 * (y2 - y3) + s2 * (y3 - y1) + s3 * (y1 - y2)) / d,
+                  (s1 * (x3 - x2) + s2 * (x1 - x3) + s3 * (x2 - x1)) / d)
+        radius = math.dist(center, (x1, y1))
+        if radius < self.arcTol * 10:
+            return None
+        # deviation check, and the points must turn one way around the
+        # center in short steps. The middle of each segment is inside the
+        # arc by the sagitta of its step, which must be within tolerance too.
+        sweep = 0
+        for k in range(i, j):
+            p = points[k][:2]
+            q = points[k + 1][:2]
+            if abs(math.dist(center, q) - radius) > self.arcTol:
+                return None
+            step = math.atan2((p[0] - center[0]) * (q[1] - center[1]) - (p[1] - center[1]) * (q[0] - center[0]),
+                              (p[0] - center[0]) * (q[0] - center[0]) + (p[1] - center[1]) * (q[1] - center[1]))
+            if step == 0 or abs(step) > constArcMaxStep or (sweep != 0 and (step > 0) != (sweep > 0)):
+                return None
+            if radius * (1 - math.cos(step / 2)) > self.arcTol:
+                return None
+            sweep += step
+        if abs(sweep) > math.pi * 1.9:
+            return None     # close to a full circle
+        # an arc that is nearly straight is left as lines
+        if radius * (1 - math.cos(min(abs(sweep), math.pi) / 2)) < self.arcTol:
+            return None
+        return (center, sweep < 0)
+
+class CycleFilter(MoveFilter):
+    # Finds drilling that was posted as separate moves for each hole:
+    # rapid over the hole, rapid down to the retract plane, feed to the
+    # bottom (with pecks: rapid out and back in), and rapid out. Holes
+    # in a row that drill alike are written as one canned cycle, G81, or
+    # G83 for pecking, with G98 or G99 for where the tool retracts to.
+
+    def __init__(self, stats):
+        super().__init__(stats)
+        self.moves = []     # held moves: (motion, start, end, feed, line)
+
+    def Line(self, line):
+        words = self.Parse(line)
+        start = self.Position()
+        if words != None and start != None and self.fAbsolute and self.OnlyMoves(words):
+            Gcodes = [value for letter, value in words if letter == "G"]
+            motion = Gcodes[0] if len(Gcodes) == 1 else self.motion
+            if len(Gcodes) <= 1 and motion in (0, 1) and any(letter in self.axisLetters for letter, value in words):
+                self.Track(line, words)
+                self.moves.append((motion, start, self.Position(), self.feed, line))
+                if len(self.moves) >= constMaxHeldMoves:
+                    return self.Flush()
+                return ""
+
+        text = self.Flush()
+        return text + self.Pass(line, words)
+
+    def Flush(self):
+        moves = self.moves
+        self.moves = []
+        out = []
+        k = 0
+        while k < len(moves):
+            holes = []
+            end = k
+            while True:
+                hole = self.MatchHole(moves, end)
+                if hole == None or (len(holes) != 0 and not self.SameCycle(holes[0], hole)):
+                    break
+                holes.append(hole)
+                end = hole["next"]
+            if len(holes) >= constMinCycleHoles:
+                out.append(self.FormatCycle(holes))
+                self.stats.Add("Blocks removed by canned cycles", end - k - len(holes) - 1)
+                self.fModalOut = True
+                k = end
+            else:
+                motion, start, stop, feed, line = moves[k]
+                if self.fModalOut:
+                    if "G" not in line.upper():
+                        line = "G{} ".format(int(motion)) + line
+                    self.fModalOut = False
+                out.append(line)
+                k += 1
+        return "".join(out)
+
+    def MatchHole(self, moves, i):
+        # Returns a dictionary describing the hole drilled by the moves
+        # starting at moves[i], or None
+        def Move(i, motion, fDown):
+            # moves[i] if it is only in Z, in the given direction
+            if i >= len(moves) or moves[i][0] != motion:
+                return None
+            move = moves[i]
+            if move[1][:2] != move[2][:2] or move[2][2] == move[1][2] or (move[2][2] < move[1][2]) != fDown:
+                return None
+            return move
+
+        if i >= len(moves):
+            return None
+        motion, start, end, feed, line = moves[i]
+        if motion != 0 or start[2] != end[2] or start[:2] == end[:2]:
+            return None
+        hole = {"x" : end[0], "y" : end[1], "zc" : start[2], "r" : start[2]}
+        i += 1
+        move = Move(i, 0, True)
+        if move != None:
+            hole["r"] = move[2][2]
+            i += 1
+        move = Move(i, 1, True)
+        if move == None or move[2][2] >= hole["r"]:
+            return None
+        hole["feed"] = move[3]
+        depths = [move[2][2]]
+        i += 1
+        while True:
+            # a peck: out to the retract plane, back in, and deeper
+            up = Move(i, 0, False)
+            down = Move(i + 1, 0, True)
+            cut = Move(i + 2, 1, True)
+            if up == None or down == None or cut == None or up[2][2] != hole["r"] or \
+                down[2][2] < depths[-1] or cut[2][2] >= depths[-1] or cut[3] != hole["feed"]:
+                break
+            depths.append(cut[2][2])
+            i += 3
+        move = Move(i, 0, False)
+        if move == None or move[2][2] not in (hole["r"], hole["zc"]):
+            return None
+        hole["retract"] = move[2][2]
+        hole["bottom"] = depths[-1]
+        hole["q"] = None
+        if len(depths) > 1:
+            # the controller pecks by the same amount each time
+            q = hole["r"] - depths[0]
+            if any(abs(depth - max(hole["bottom"], hole["r"] - q * (k + 1))) > 1e-6 for k, depth in enumerate(depths)):
+                return None
+            hole["q"] = q
+        hole["next"] = i + 1
+        return hole
+
+    @staticmethod
+    def SameCycle(first, hole):
+        for key in ("r", "bottom", "q", "feed", "retract"):
+            if hole[key] != first[key]:
+                return False
+        # the next hole is moved to at the height the cycle leaves the tool
+        if first["retract"] == first["r"]:
+            return hole["zc"] == first["r"]
+        return hole["zc"] == first["zc"]
+
+    def FormatCycle(self, holes):
+        first = holes[0]
+        block = "{} {} X{} Y{} Z{} R{}".format("G99" if first["retract"] == first["r"] else "G98",
+            "G81" if first["q"] == None else "G83",
+            self.FormatNumber(first["x"]), self.FormatNumber(first["y"]),
+            self.FormatNumber(first["bottom"]), self.FormatNumber(first["r"]))
+        if first["q"] != None:
+            block += " Q" + self.FormatNumber(first["q"])
+        lines = [block + " F" + self.FormatNumber(first["feed"]) + "\n"]
+        for hole in holes[1:]:
+            lines.append("X{} Y{}\n".format(self.FormatNumber(hole["x"]), self.FormatNumber(hole["y"])))
+        lines.append("G80\n")
+        return "".join(lines)
+
+
+class FilterChain:
+    # Passes G-code through several filters in turn
+
+    def __init__(self, filters):
+        self.filters = filters
+
+    def Line(self, line):
+        text = line
+        for filter in self.filters:
+            text = "".join(filter.Line(block) for block in text.splitlines(True))
+        return text
+
+    def Flush(self):
+        text = ""
+        for filter in self.filters:
+            text = "".join(filter.Line(block) for block in text.splitlines(True)) + filter.Flush()
+        return text
+
+
 class SettingsManager:
     def __init__(self):
         self.default = None
@@ -183,6 +1340,8 @@ class SettingsManager:
             if dst["homeEndsOp"] and not ("endCodes" in dst):
                 dst["endCodes"] = "M5 M9 M30 G28 G30"
             del dst["homeEndsOp"]
+        if "fixedOrder" in dst:
+            del dst["fixedOrder"]   # replaced by movableOps, which has the opposite sense
         for item in src:
             if not (item in dst):
                 dst[item] = src[item]
@@ -221,11 +1380,186 @@ def InitAddIn():
         cmdControl.isPromotedByDefault = True
         cmdControl.isPromoted = True
 
+        # Watch for changes to setups in documents using watch mode
+        watcher.Start()
+
+        # Post while the dialog is open
+        speculator.Start()
+
+        # Post a setup at a time from custom events
+        poster.Start()
+
     except:
         if ui:
             ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
 
+def HashFile(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(constCopyBlockSize)
+            if len(block) == 0:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def PostOperations(program, opList, opFolder, opName, fileExt, docSettings, run, progName, errName):
+    # Post process a list of operations into the run's fragment store,
+    # unless it was already posted this run. progName is the program name
+    # set in the NC program, errName the operation named in error messages.
+    # Returns (fragment path, program name it was posted with, None) on
+    # success, or (None, None, error message).
+    entry = run.store.Get(program, opList)
+    if entry:
+        run.stats.Add("Operation posts reused")
+        return entry + (None,)
+
+    opPath = opFolder + "/" + opName + fileExt
+    retries = docSettings["postRetries"]
+    delay = docSettings["initialDelay"]
+    timeLimit = None
+    run.Parameters(program).Apply()
+    while True:
+        try:
+            program.operations = opList
+            if not program.postProcess(adsk.cam.NCProgramPostProcessOptions.create()):
+                retVal = constPostError
+                if errName != None:
+                    retVal += ": " + errName
+                return (None, None, retVal)
+        except Exception as exc:
+            retVal = constPostException
+            if errName != None:
+                retVal += " in operation " + errName
+            retVal += ": " + str(exc)
+            return (None, None, retVal)
+
+        # wait for it to finish (??), still responding to cancel
+        if timeLimit == None:
+            timeLimit = time.monotonic() + docSettings["postTimeout"]
+        if WaitForFile(opPath, min(time.monotonic() + delay, timeLimit), run):
+            break
+        delay *= 2
+        retries -= 1
+        if retries > 0 and time.monotonic() < timeLimit:
+            continue
+        # Out of retries, keep waiting for the file up to the time limit
+        fFound = False
+        while not fFound and time.monotonic() < timeLimit:
+            fFound = WaitForFile(opPath, min(time.monotonic() + delay, timeLimit), run)
+            delay *= 2
+        if fFound:
+            break
+        # Maybe the file name extension is wrong
+        for file in os.listdir(opFolder):
+            if file.startswith(opName):
+                ext = file[len(opName):]
+                if ext != fileExt:
+                    return (None, None, "Unable to open output file. "
+                        "Found the file with extension '{}' instead "
+                        "of '{}'. Make sure you have the correct file "
+                        "extension set in the Post Process All "
+                        "dialog.".format(ext, fileExt))
+                break
+        retVal = constPostTimeout + " within {} seconds".format(docSettings["postTimeout"])
+        if errName != None:
+            retVal += ": " + errName
+        return (None, None, retVal)
+
+    run.stats.Add("Operation posts")
+    return run.store.Add(program, opList, opPath, progName) + (None,)
+
+
+def WaitForFile(path, waitEnd, run):
+    # Wait until waitEnd, checking for cancel, then try to open the file.
+    # Returns True if it opened.
+    while True:
+        run.CheckCancel()
+        wait = waitEnd - time.monotonic()
+        if wait <= 0:
+            break
+        time.sleep(min(wait, constPostLoopDelay))
+    try:
+        open(path).close()
+        return True
+    except OSError:
+        return False
+
+
+def PostGroup(program, opList, opFolder, opName, fileExt, docSettings, run, progName, errName):
+    # Post a list of operations like PostOperations. If Fusion fails to
+    # post them, the operations that fail are found and recorded in the
+    # run, and the rest are posted. Returns (fragment path, program name
+    # it was posted with, operations posted, None), with no fragment if
+    # every operation failed, or (None, None, None, error message) for
+    # errors other than Fusion failing to post.
+    fragment, postedName, status = PostOperations(program, opList, opFolder, opName, fileExt,
+                                                  docSettings, run, progName, errName)
+    if status == None or not IsPostFailure(status):
+        return (fragment, postedName, opList, status)
+
+    failed = FindFailedOps(program, opList, status, opFolder, opName, fileExt, docSettings, run, progName)
+    if isinstance(failed, str):
+        return (None, None, None, failed)
+    failedOps = [op for op, error in failed]
+    posted = [op for op in opList if not op in failedOps]
+    if len(posted) != 0:
+        fragment, postedName, status = PostOperations(program, posted, opFolder, opName, fileExt,
+                                                      docSettings, run, progName, posted[0].name)
+        if status != None:
+            if not IsPostFailure(status):
+                return (None, None, None, status)
+            # the rest only fail together
+            failed += [(op, status) for op in posted]
+            posted = []
+    for op, error in failed:
+        run.failures.append((program.name, op.parentSetup.name, op.name, error))
+    if len(posted) == 0:
+        return (None, None, posted, None)
+    return (fragment, postedName, posted, None)
+
+
+def PostFirstAgain(program, opList, opFolder, opName, fileExt, docSettings, run, progName):
+    # Operations posted ahead while the dialog was open have a placeholder
+    # program name, so the first ones in a file, whose header is kept,
+    # are posted again with the real one. Returns like PostOperations.
+    run.store.Drop(program, opList)
+    return PostOperations(program, opList, opFolder, opName, fileExt, docSettings, run, progName,
+                          opList[0].name)
+
+
+def FindFailedOps(program, opList, status, opFolder, opName, fileExt, docSettings, run, progName):
+    # Find the operations in a list that failed to post with the given
+    # status by posting each half of the list, and each half of a half
+    # that fails, and so on. Returns [(operation, error message), ...],
+    # or an error message for errors other than Fusion failing to post.
+    if len(opList) == 1:
+        return [(opList[0], status)]
+    failed = []
+    half = len(opList) // 2
+    for part in (opList[:half], opList[half:]):
+        fragment, postedName, partStatus = PostOperations(program, part, opFolder, opName, fileExt,
+                                                          docSettings, run, progName, part[0].name)
+        if partStatus == None:
+            continue
+        if not IsPostFailure(partStatus):
+            return partStatus
+        result = FindFailedOps(program, part, partStatus, opFolder, opName, fileExt, docSettings, run, progName)
+        if isinstance(result, str):
+            return result
+        failed += result
+    if len(failed) == 0:
+        # each half posts on its own, so the operations only fail together
+        failed = [(op, status) for op in opList]
+    return failed
+
+
+def IsPostFailure(status):
+    return status.startswith((constPostError, constPostException, constPostTimeout))
+
+
 def CountOutputFolderFiles(folder, limit, fileExt):
     cntFiles = 0
     cntNcFiles = 0
@@ -269,9 +1603,44 @@ def GetSetups(cam, settings, setups):
         # move all setups into a list
         for setup in cam.setups:
             setups.append(setup)
+    if settings["onlyFailed"]:
+        failed = set(failure[1] for failure in ReadFailures(cam.parentDocument.attributes))
+        if settings["combineSetups"] and len(setups) > 1:
+            # The combined file has every setup, so it is posted again
+            # in full if any of them had failures, rather than replaced
+            # by a file of just those setups
+            if not any(setup.name in failed for setup in setups):
+                setups = []
+        else:
+            setups = [setup for setup in setups if setup.name in failed]
     return setups
 
 
+def ReadFailures(docAttr):
+    # Operations that failed to post, as saved by SaveFailures
+    attr = docAttr.itemByName(constAttrGroup, constAttrFailedName)
+    if attr:
+        try:
+            return json.loads(attr.value)
+        except Exception:
+            pass
+    return []
+
+
+def SaveFailures(docAttr, setups, failures):
+    # Save the operations that failed to post in the document, replacing
+    # what was saved for the setups just posted
+    posted = set(setup.name for setup in setups)
+    records = [record for record in ReadFailures(docAttr) if not record[1] in posted]
+    records += [list(failure) for failure in failures]
+    if len(records) != 0:
+        docAttr.add(constAttrGroup, constAttrFailedName, json.dumps(records))
+    else:
+        attr = docAttr.itemByName(constAttrGroup, constAttrFailedName)
+        if attr:
+            attr.deleteMe()
+
+
 def GetNcProgram(cam, settings):
     for program in cam.ncPrograms:
         if program.name == settings["ncProgram"]:
@@ -279,6 +1648,17 @@ def GetNcProgram(cam, settings):
     return cam.ncPrograms.item(0)
 
 
+def GetNcPrograms(cam, settings):
+    # The selected NC program, followed by any others also selected
+    programs = [GetNcProgram(cam, settings)]
+    names = [programs[0].name]
+    for program in cam.ncPrograms:
+        if program.name in settings["alsoPrograms"] and not program.name in names:
+            programs.append(program)
+            names.append(program.name)
+    return programs
+
+
 def RenameSetups(settings, setups, find, replace, isRegex):
     try:
         app = adsk.core.Application.get()
@@ -321,6 +1701,9 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
             app = adsk.core.Application.get()
             cam = adsk.cam.CAM.cast(app.activeDocument.products.itemByProductType(constCAMProductId))
             docSettings  = settingsMgr.GetSettings(app.activeDocument.attributes)
+            failures = ReadFailures(app.activeDocument.attributes)
+            docSettings["onlyFailed"] = False
+            docSettings["batchRun"] = False
 
             # See if we're doing only selected setups
             selectedSetups = []
@@ -381,6 +1764,32 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
             label.tooltip = input.tooltip
             label.tooltipDescription = input.tooltipDescription
 
+            # text box as a label for additional NC Programs
+            input = inputs.addTextBoxCommandInput("alsoProgramsLabel", 
+                                                   "", 
+                                                   "Also post with NC Programs:",
+                                                   1,
+                                                   True)
+            input.isFullWidth = True
+            input.isVisible = programs.count > 1
+            label = input
+
+            input = inputs.addDropDownCommandInput("alsoPrograms", 
+                                                   "Also post with",
+                                                   adsk.core.DropDownStyles.CheckBoxDropDownStyle)
+            for listItem in programs:
+                input.listItems.add(listItem.name, listItem.name in docSettings["alsoPrograms"])
+            input.isVisible = programs.count > 1
+            input.tooltip = "Additional NC Programs"
+            input.tooltipDescription = (
+                "Post the same setups again with each NC Program checked here, "
+                "for example to run the same parts on a different machine. "
+                "Each NC Program writes to its own output folder, and toolpaths "
+                "are only generated once. All other settings are shared."
+            )
+            label.tooltip = input.tooltip
+            label.tooltipDescription = input.tooltipDescription
+
             # check box to use only selected setups
             input = inputs.addBoolValueInput("onlySelected", 
                                              "Only selected setups", 
@@ -395,6 +1804,37 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
             )
             input.isEnabled = len(selectedSetups) != 0
 
+            # check box to post again only setups with failed operations
+            input = inputs.addBoolValueInput("onlyFailed",
+                                             "Only setups with failed operations",
+                                             True,
+                                             "",
+                                             False)
+            input.tooltip = "Only Process Setups With Failed Operations"
+            input.tooltipDescription = (
+                "Only setups with operations that failed to post the last "
+                "time they were posted will be processed. Operations that "
+                "fail are left out of the G-code and listed when post "
+                "processing finishes. When combining setups, the combined "
+                "file is posted again with all of its setups."
+            )
+            input.isEnabled = len(failures) != 0
+
+            # check box for watch mode
+            input = inputs.addBoolValueInput("watchMode",
+                                             "Post again when setups change",
+                                             True,
+                                             "",
+                                             docSettings["watchMode"])
+            input.tooltip = "Watch Mode"
+            input.tooltipDescription = (
+                "After posting, keep watching this document. When operations "
+                "are edited, added, removed or suppressed, the setups they are "
+                "in are posted again with these settings once their toolpaths "
+                "are generated, without opening this dialog. When combining "
+                "setups, all setups are posted again."
+            )
+
             # check box to delete existing files
             input = inputs.addBoolValueInput("delFiles", 
                                              "Delete existing files", 
@@ -459,6 +1899,18 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
                 "Sequence numbers 0 - 9 will have a leading zero added, becoming"
                 '"01" to "09". This could be useful for formatting or sorting.')
 
+            # number of machines to spread setups across
+            input = inputs.addIntegerSpinnerCommandInput("machineCount", 
+                "Machines to balance across", 1, 20, 1, docSettings["machineCount"])
+            input.tooltip = "Balance Setups Across Machines"
+            input.tooltipDescription = (
+                "When more than 1, setups are divided among this many machines, "
+                "each with its own subfolder (Machine 1, Machine 2, ...) in the "
+                "output folder. Setups are assigned by estimated machining time "
+                "so all machines finish about the same time. Setups in the same "
+                "folder (using ':' in the name) stay on the same machine. A "
+                "schedule for each machine is shown when done.")
+
             # "Personal Use" version
             # check box to split up setup into individual operations
             inputGroup = inputs.addGroupCommandInput("groupPersonal", "Personal Use")
@@ -486,7 +1938,9 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
             input.tooltip = "Combine Consecutive Operations That Use the Same Tool"
             input.tooltipDescription = (
                 "If consecutive operations use the same tool, have Fusion generate "
-                "their output together. This can optimize G-code for some routers. "
+                "their output together. When combining setups, this applies to "
+                "operations from the same setup that end up next to each other. "
+                "This can optimize G-code for some routers. "
                 "However, it will cause the logic that restores rapid moves to also "
                 "treat it as one operation, which can have negative effects if the "
                 "feed heights for the operations are different.")
@@ -509,6 +1963,51 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
                 "the output will run all T1 operations (from both setups), then T2, etc.</p>"
                 "<p>Requires 'Use individual operations' to be enabled.</p>")
 
+            # check box to also write the individual setup files
+            input = inputGroup.children.addBoolValueInput("alsoSetupFiles",
+                                                          "Also write individual setup files",
+                                                          True,
+                                                          "",
+                                                          docSettings["alsoSetupFiles"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings.get("combineSetups", False)
+            input.tooltip = "Write Setup Files Along With the Combined File"
+            input.tooltipDescription = (
+                "In addition to the combined file, write a file for each setup "
+                "just as if setups were not being combined. Each operation is "
+                "only post processed once for both.")
+
+            # check box to reorder operations to reduce rapid travel
+            input = inputGroup.children.addBoolValueInput("minimizeTravel",
+                                                          "Reorder to minimize rapid travel",
+                                                          True,
+                                                          "",
+                                                          docSettings["minimizeTravel"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings.get("combineSetups", False)
+            input.tooltip = "Reorder Operations to Minimize Rapid Travel"
+            input.tooltipDescription = (
+                "Within each tool in the combined file, change the order of "
+                "neighboring operations from the same setup so the moves "
+                "between them are as short as possible. Only operations "
+                "matching \"May be reordered\" are moved. Where each operation "
+                "starts and ends is taken from its G-code. The reduction in "
+                "rapid travel is shown when done."
+                "<p>Operations posted together (Combine operations using same "
+                "tool) stay together.</p>")
+
+            # operations that may be moved
+            input = inputGroup.children.addStringValueInput("movableOps", "May be reordered", docSettings["movableOps"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings.get("combineSetups", False) and \
+                docSettings["minimizeTravel"]
+            input.tooltip = "Operations That May Be Reordered"
+            input.tooltipDescription = (
+                "Only operations whose names match this regular expression "
+                "are moved when reordering, and only among neighbors that "
+                "also match. For example, <b>Drill|Spot|Chamfer</b> lets "
+                "operations with those in their name change places. All "
+                "other operations stay in the order of the setup, since a "
+                "finishing or rest machining operation must follow the one "
+                "before it. Leave blank to keep every operation in order.")
+
             # text box as a label for tool change command
             input = inputGroup.children.addTextBoxCommandInput("toolLabel", 
                                                                "", 
@@ -583,6 +2082,145 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
                 "Review the G-code to verify it is correct. Comments have been "
                 "added to indicate the changes.")
 
+            # clearance above the stock for rapid moves
+            input = inputGroup.children.addFloatSpinnerCommandInput("stockClearance",
+                                                                    "Rapid clearance above stock (mm)",
+                                                                    "",
+                                                                    0,
+                                                                    100,
+                                                                    0.5,
+                                                                    docSettings["stockClearance"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["fastZ"]
+            input.tooltip = "Clearance Above Stock for Rapid Moves"
+            input.tooltipDescription = (
+                "When the setup's stock box and the WCS origin (top or bottom "
+                "of the stock) are known, moves that stay at least this far "
+                "above the top of the stock are changed to rapid moves, "
+                "including moves in X, Y and Z together. Otherwise the feed "
+                "height is inferred from the G-code.")
+
+            # check box to include operation top heights
+            input = inputGroup.children.addBoolValueInput("useTopHeight",
+                                                          "Use operation top heights",
+                                                          True,
+                                                          "",
+                                                          docSettings["useTopHeight"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["fastZ"]
+            input.tooltip = "Use Operation Top Heights"
+            input.tooltipDescription = (
+                "Measure the clearance from the operation's top height when "
+                "it is above the stock, for example when the model sticks "
+                "out of the stock.")
+
+            # feed rate for air moves
+            input = inputGroup.children.addIntegerSpinnerCommandInput("linkFeed",
+                "Air move feed rate (mm/min, 0 for rapid)", 0, 100000, 100, docSettings["linkFeed"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["fastZ"]
+            input.tooltip = "Feed Rate for Air Moves"
+            input.tooltipDescription = (
+                "Moves in X and Y that are clear of the stock, such as the "
+                "links between passes of adaptive clearing, are changed to "
+                "rapid moves when this is 0. Otherwise they are changed to "
+                "feed moves at this rate, for machines whose rapid moves "
+                "don't follow a straight line. Moves straight up and down "
+                "are always made rapid.")
+
+            # machine rapid rate for time estimates
+            input = inputGroup.children.addIntegerSpinnerCommandInput("rapidRate",
+                "Machine rapid rate (mm/min)", 0, 100000, 500, docSettings["rapidRate"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["fastZ"]
+            input.tooltip = "Machine Rapid Rate"
+            input.tooltipDescription = (
+                "Used only to estimate the time saved by rapid moves, "
+                "reported for each operation in the statistics shown when "
+                "done (see Advanced).")
+
+            # check box to fit arcs to linear moves
+            input = inputGroup.children.addBoolValueInput("arcFit",
+                                                          "Fit arcs to linear moves",
+                                                          True,
+                                                          "",
+                                                          docSettings["arcFit"])
+            input.isEnabled = docSettings["splitSetup"] # enable only if using individual operations
+            input.tooltip = "Fit Arcs to Linear Moves"
+            input.tooltipDescription = (
+                "Replace runs of short linear (G1) moves in the XY plane with "
+                "arcs (G2/G3) where an arc stays within the tolerance below "
+                "of every point and every segment. Fewer, longer blocks let "
+                "older controllers keep up at the programmed feed rate. The "
+                "number of blocks removed is shown in the statistics.")
+
+            # arc fitting tolerance
+            input = inputGroup.children.addFloatSpinnerCommandInput("arcTolerance",
+                                                                    "Arc fitting tolerance (mm)",
+                                                                    "",
+                                                                    0.0001,
+                                                                    1,
+                                                                    0.001,
+                                                                    docSettings["arcTolerance"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["arcFit"]
+            input.tooltip = "Arc Fitting Tolerance"
+            input.tooltipDescription = (
+                "How far a fitted arc may be from the original path.")
+
+            # check box to drop linear moves that aren't needed
+            input = inputGroup.children.addBoolValueInput("decimate",
+                                                          "Remove collinear and tiny moves",
+                                                          True,
+                                                          "",
+                                                          docSettings["decimate"])
+            input.isEnabled = docSettings["splitSetup"] # enable only if using individual operations
+            input.tooltip = "Remove Collinear and Tiny Moves"
+            input.tooltipDescription = (
+                "Merge linear (G1) moves that continue in a straight line and "
+                "drop very short moves, keeping the path within the tolerance "
+                "below. Runs are never joined across a feed rate change, a "
+                "tool change or the end of an operation.")
+
+            # decimation tolerance
+            input = inputGroup.children.addFloatSpinnerCommandInput("decimateTolerance",
+                                                                    "Move removal tolerance (mm)",
+                                                                    "",
+                                                                    0.0001,
+                                                                    1,
+                                                                    0.001,
+                                                                    docSettings["decimateTolerance"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["decimate"]
+            input.tooltip = "Move Removal Tolerance"
+            input.tooltipDescription = (
+                "How far the simplified path may be from the original path.")
+
+            # check box for controllers with canned drilling cycles
+            input = inputGroup.children.addBoolValueInput("cannedCycles",
+                                                          "Controller has canned drilling cycles",
+                                                          True,
+                                                          "",
+                                                          docSettings["cannedCycles"])
+            input.isEnabled = docSettings["splitSetup"] # enable only if using individual operations
+            input.tooltip = "Controller Has Canned Drilling Cycles"
+            input.tooltipDescription = (
+                "Check only if the controller supports G81 and G83 with G98 "
+                "and G99. Holes drilled with separate moves for each hole "
+                "(rapid down, feed to the bottom, rapid out) are written as "
+                "a single canned cycle with a list of holes.")
+
+            # drop down for subprograms
+            input = inputGroup.children.addDropDownCommandInput("subprograms",
+                                                                "Subprograms for repeated moves",
+                                                                adsk.core.DropDownStyles.TextListDropDownStyle)
+            for listItem in (constSubNone, constSubM98, constSubOword):
+                input.listItems.add(listItem, listItem == docSettings["subprograms"])
+            input.isEnabled = docSettings["splitSetup"] # enable only if using individual operations
+            input.tooltip = "Subprograms for Repeated Moves"
+            input.tooltipDescription = (
+                "Find runs of moves that are repeated in an output file, such "
+                "as the same part cut in several places, and write them once "
+                "as a subprogram that is called for each copy. The moves in "
+                "the subprogram are incremental (G91). Choose the style your "
+                "controller uses: M98 P / M99 with the subprograms after the "
+                "end of the program, or o-word call / sub with them at the "
+                "start.")
+
             # check box to skip first toolchange
             input = inputGroup.children.addBoolValueInput("skipFirstToolchange",
                                                           "Skip first toolchange",
@@ -597,6 +2235,114 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
                 "spindle and you don't want to generate unnecessary tool change "
                 "commands at the beginning of the program.")
 
+            # check box to prestage the next tool
+            input = inputGroup.children.addBoolValueInput("prestageTool",
+                                                          "Prestage next tool",
+                                                          True,
+                                                          "",
+                                                          docSettings["prestageTool"])
+            input.isEnabled = docSettings["splitSetup"] # enable only if using individual operations
+            input.tooltip = "Prestage Next Tool"
+            input.tooltipDescription = (
+                "After each tool change, add a line selecting the next tool "
+                "that will be used, so a tool changer that supports it can "
+                "load it while the current tool is cutting. The line is "
+                "written using the format below.")
+
+            # format of the prestage line
+            input = inputGroup.children.addStringValueInput("prestageFormat", "", docSettings["prestageFormat"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["prestageTool"]
+            input.isFullWidth = True
+            input.tooltip = "Prestage Next Tool Format"
+            input.tooltipDescription = (
+                "The G-code written after a tool change to prestage the next "
+                "tool. <b>{}</b> is replaced with the tool number. For "
+                "example, <b>T{}</b> for most controllers.")
+
+            # work offsets of fixtures to repeat each setup on
+            input = inputGroup.children.addStringValueInput("fixtureWcs", "Fixture offsets", docSettings["fixtureWcs"])
+            input.isEnabled = docSettings["splitSetup"]
+            input.tooltip = "Fixture Offsets"
+            input.tooltipDescription = (
+                "Work offsets of identical fixtures, such as <b>G54 G55 G56 G57</b>. "
+                "Each setup is posted once and its operations are repeated "
+                "for every fixture, changing only the work offset. Each tool "
+                "cuts all the fixtures before the next tool change. Leave "
+                "empty to use the work offset of the setup.")
+
+            # check box to write a restart index
+            input = inputGroup.children.addBoolValueInput("restartIndex",
+                                                          "Write restart index",
+                                                          True,
+                                                          "",
+                                                          docSettings["restartIndex"])
+            input.isEnabled = docSettings["splitSetup"] # enable only if using individual operations
+            input.tooltip = "Write Restart Index"
+            input.tooltipDescription = (
+                "Write a file next to each output file listing where each "
+                "operation starts, with the tool, work offset, spindle, "
+                "coolant and other modes in effect there. RestartProgram.py "
+                "uses it to make a program that restarts at any operation. "
+                "Subprograms for repeated moves are not used when this is "
+                "checked.")
+
+            # check box to hard link identical output files
+            input = inputGroup.children.addBoolValueInput("linkIdentical",
+                                                          "Hard link identical files",
+                                                          True,
+                                                          "",
+                                                          docSettings["linkIdentical"])
+            input.isEnabled = docSettings["splitSetup"] # enable only if using individual operations
+            input.tooltip = "Hard Link Identical Output Files"
+            input.tooltipDescription = (
+                "When an output file comes out identical to one written "
+                "earlier in the same run, such as the same setup posted "
+                "with another NC program, replace it with a hard link to "
+                "the first. "
+                "<p>Both names are then the same file: editing one changes "
+                "the other.</p>")
+
+            # check box for high-speed machining mode
+            input = inputGroup.children.addBoolValueInput("hsmMode",
+                                                          "Add high-speed machining mode",
+                                                          True,
+                                                          "",
+                                                          docSettings["hsmMode"])
+            input.isEnabled = docSettings["splitSetup"] # enable only if using individual operations
+            input.tooltip = "Add High-Speed Machining Mode"
+            input.tooltipDescription = (
+                "Turn on the controller's look-ahead or high-speed machining "
+                "mode for operations whose strategy matches the expression "
+                "below, and off for all others, such as drilling and tapping. "
+                "It is turned on after the tool change and off before the next "
+                "tool change, or before an operation that doesn't use it.")
+
+            # strategies using high-speed machining mode
+            input = inputGroup.children.addStringValueInput("hsmStrategies", "HSM strategies", docSettings["hsmStrategies"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["hsmMode"]
+            input.tooltip = "HSM Strategies"
+            input.tooltipDescription = (
+                "A regular expression matched against the Fusion strategy "
+                "of each operation, such as <b>adaptive</b>, <b>adaptive2d</b>, "
+                "<b>parallel</b>, <b>drill</b>. Operations that match use "
+                "high-speed machining mode.")
+
+            # G-code to turn high-speed machining mode on
+            input = inputGroup.children.addStringValueInput("hsmOn", "HSM on", docSettings["hsmOn"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["hsmMode"]
+            input.tooltip = "HSM On"
+            input.tooltipDescription = (
+                "The G-code turning high-speed machining mode on, for example "
+                "<b>G05.1 Q1</b> (Fanuc) or <b>G187 P1</b> (Haas).")
+
+            # G-code to turn high-speed machining mode off
+            input = inputGroup.children.addStringValueInput("hsmOff", "HSM off", docSettings["hsmOff"])
+            input.isEnabled = docSettings["splitSetup"] and docSettings["hsmMode"]
+            input.tooltip = "HSM Off"
+            input.tooltipDescription = (
+                "The G-code turning high-speed machining mode off, for example "
+                "<b>G05.1 Q0</b> (Fanuc) or <b>G187</b> (Haas).")
+
             # check box to append origin location to filename
             input = inputGroup.children.addBoolValueInput("appendOriginLocation",
                                                           "Append origin location to filename",
@@ -682,6 +2428,32 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
                 "with the string in the Replace box.")
             inputGroup.isExpanded = docSettings["groupRename"]
 
+            # Batch of documents
+            inputGroup = inputs.addGroupCommandInput("groupBatch", "Batch of Documents")
+            input = inputGroup.children.addStringValueInput("batchQueue", "Batch queue file", docSettings["batchQueue"])
+            input.tooltip = "Batch Queue File"
+            input.tooltipDescription = (
+                "Text file listing the documents to post, one on each line: "
+                "the path of a Fusion archive (.f3d), the name of an open "
+                "document, or * for all open documents. Lines starting "
+                "with # are ignored.")
+
+            input = inputGroup.children.addBoolValueInput("batchRun",
+                                                          "Post documents in batch queue",
+                                                          True,
+                                                          "",
+                                                          False)
+            input.isEnabled = len(docSettings["batchQueue"]) != 0
+            input.tooltip = "Post Documents in Batch Queue"
+            input.tooltipDescription = (
+                "Instead of this document, post each document in the batch "
+                "queue with the settings saved in it, opening and closing "
+                "archives as needed. Documents that haven't changed since "
+                "the batch last posted them are skipped, so an interrupted "
+                "batch picks up where it left off. A report on all documents "
+                "is shown and written next to the queue file.")
+            inputGroup.isExpanded = docSettings["groupBatch"]
+
             # Advanced -- retry settings
             inputGroup = inputs.addGroupCommandInput("groupAdvanced", "Advanced")
             # Time delay
@@ -696,6 +2468,26 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
             input.tooltip = "Number of Retries"
             input.tooltipDescription = (
                 "Retries if post processing failed. Time delay is doubled each retry.")
+            # Time limit
+            input = inputGroup.children.addIntegerSpinnerCommandInput("postTimeout",
+                "Time limit for output file", 5, 600, 5, docSettings["postTimeout"])
+            input.tooltip = "Time Limit to Wait for the Output File"
+            input.tooltipDescription = (
+                "Longest time in seconds to wait for the output file of one post, "
+                "however many retries are left. Operations whose file doesn't "
+                "appear in time are left out like operations that fail to post. "
+                "This doesn't stop Fusion while it runs the post processor. "
+                "Post processing can be cancelled while waiting.")
+            # Statistics
+            input = inputGroup.children.addBoolValueInput("showStats",
+                                                          "Show statistics when done",
+                                                          True,
+                                                          "",
+                                                          docSettings["showStats"])
+            input.tooltip = "Show Statistics When Done"
+            input.tooltipDescription = (
+                "When post processing is complete, show a summary of what was "
+                "done, such as how much G-code was copied without changes.")
             inputGroup.isExpanded = docSettings["groupAdvanced"]
             
             # post processor
@@ -735,6 +2527,14 @@ class CommandEventHandler(adsk.core.CommandCreatedEventHandler):
             onValidateInputs = CommandValidateInputsHandler()
             cmd.validateInputs.add(onValidateInputs)
             handlers.append(onValidateInputs)
+
+            # Connect to the destroy event.
+            onDestroy = CommandDestroyHandler()
+            cmd.destroy.add(onDestroy)
+            handlers.append(onDestroy)
+
+            # Start posting with the settings shown
+            speculator.Begin(docSettings, selectedSetups)
         except:
             ui = app.userInterface
             ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
@@ -766,6 +2566,9 @@ class CommandInputChangedHandler(adsk.core.InputChangedEventHandler):
                 cmd.doExecute(False)    # do it in execute handler for Undo
                 return
 
+            elif input.id == "alsoPrograms":
+                self.docSettings["alsoPrograms"] = [item.name for item in input.listItems if item.isSelected]
+
             elif input.id in self.docSettings:
                 if input.objectType == adsk.core.GroupCommandInput.classType():
                     self.docSettings[input.id] = input.isExpanded
@@ -792,15 +2595,43 @@ class CommandInputChangedHandler(adsk.core.InputChangedEventHandler):
                 inputs.itemById("endCodes").isEnabled = input.value
                 inputs.itemById("endLabel").isEnabled = input.value
                 inputs.itemById("fastZ").isEnabled = input.value
+                inputs.itemById("stockClearance").isEnabled = input.value and inputs.itemById("fastZ").value
+                inputs.itemById("useTopHeight").isEnabled = input.value and inputs.itemById("fastZ").value
+                inputs.itemById("linkFeed").isEnabled = input.value and inputs.itemById("fastZ").value
+                inputs.itemById("rapidRate").isEnabled = input.value and inputs.itemById("fastZ").value
                 inputs.itemById("skipFirstToolchange").isEnabled = input.value
+                inputs.itemById("arcFit").isEnabled = input.value
+                inputs.itemById("arcTolerance").isEnabled = input.value and inputs.itemById("arcFit").value
+                inputs.itemById("decimate").isEnabled = input.value
+                inputs.itemById("decimateTolerance").isEnabled = input.value and inputs.itemById("decimate").value
+                inputs.itemById("cannedCycles").isEnabled = input.value
+                inputs.itemById("subprograms").isEnabled = input.value
+                inputs.itemById("prestageTool").isEnabled = input.value
+                inputs.itemById("prestageFormat").isEnabled = input.value and inputs.itemById("prestageTool").value
+                inputs.itemById("fixtureWcs").isEnabled = input.value
+                inputs.itemById("restartIndex").isEnabled = input.value
+                inputs.itemById("linkIdentical").isEnabled = input.value
+                inputs.itemById("hsmMode").isEnabled = input.value
+                for id in ("hsmStrategies", "hsmOn", "hsmOff"):
+                    inputs.itemById(id).isEnabled = input.value and inputs.itemById("hsmMode").value
                 inputs.itemById("combineSetups").isEnabled = input.value
+                inputs.itemById("alsoSetupFiles").isEnabled = input.value and inputs.itemById("combineSetups").value
+                inputs.itemById("minimizeTravel").isEnabled = input.value and inputs.itemById("combineSetups").value
+                inputs.itemById("movableOps").isEnabled = input.value and inputs.itemById("combineSetups").value and \
+                    inputs.itemById("minimizeTravel").value
                 # If splitSetup is disabled, also disable combineSetups
                 if not input.value:
                     inputs.itemById("combineSetups").value = False
                     self.docSettings["combineSetups"] = False
+                    inputs.itemById("alsoSetupFiles").isEnabled = False
+                    inputs.itemById("minimizeTravel").isEnabled = False
+                    inputs.itemById("movableOps").isEnabled = False
 
             # combineSetups requires splitSetup
             if input.id == "combineSetups":
+                inputs.itemById("alsoSetupFiles").isEnabled = input.value
+                inputs.itemById("minimizeTravel").isEnabled = input.value
+                inputs.itemById("movableOps").isEnabled = input.value and inputs.itemById("minimizeTravel").value
                 if input.value and not inputs.itemById("splitSetup").value:
                     # Auto-enable splitSetup when combineSetups is checked
                     inputs.itemById("splitSetup").value = True
@@ -811,9 +2642,55 @@ class CommandInputChangedHandler(adsk.core.InputChangedEventHandler):
                     inputs.itemById("endCodes").isEnabled = True
                     inputs.itemById("endLabel").isEnabled = True
                     inputs.itemById("fastZ").isEnabled = True
+                    inputs.itemById("stockClearance").isEnabled = inputs.itemById("fastZ").value
+                    inputs.itemById("useTopHeight").isEnabled = inputs.itemById("fastZ").value
+                    inputs.itemById("linkFeed").isEnabled = inputs.itemById("fastZ").value
+                    inputs.itemById("rapidRate").isEnabled = inputs.itemById("fastZ").value
                     inputs.itemById("skipFirstToolchange").isEnabled = True
+                    inputs.itemById("arcFit").isEnabled = True
+                    inputs.itemById("arcTolerance").isEnabled = inputs.itemById("arcFit").value
+                    inputs.itemById("decimate").isEnabled = True
+                    inputs.itemById("decimateTolerance").isEnabled = inputs.itemById("decimate").value
+                    inputs.itemById("cannedCycles").isEnabled = True
+                    inputs.itemById("subprograms").isEnabled = True
+                    inputs.itemById("prestageTool").isEnabled = True
+                    inputs.itemById("prestageFormat").isEnabled = inputs.itemById("prestageTool").value
+                    inputs.itemById("fixtureWcs").isEnabled = True
+                    inputs.itemById("restartIndex").isEnabled = True
+                    inputs.itemById("linkIdentical").isEnabled = True
+                    inputs.itemById("hsmMode").isEnabled = True
+                    for id in ("hsmStrategies", "hsmOn", "hsmOff"):
+                        inputs.itemById(id).isEnabled = inputs.itemById("hsmMode").value
                     inputs.itemById("combineSetups").isEnabled = True
 
+            if input.id == "fastZ":
+                inputs.itemById("stockClearance").isEnabled = input.value
+                inputs.itemById("useTopHeight").isEnabled = input.value
+                inputs.itemById("linkFeed").isEnabled = input.value
+                inputs.itemById("rapidRate").isEnabled = input.value
+
+            if input.id == "arcFit":
+                inputs.itemById("arcTolerance").isEnabled = input.value
+
+            if input.id == "hsmMode":
+                for id in ("hsmStrategies", "hsmOn", "hsmOff"):
+                    inputs.itemById(id).isEnabled = input.value
+
+            if input.id == "decimate":
+                inputs.itemById("decimateTolerance").isEnabled = input.value
+
+            if input.id == "minimizeTravel":
+                inputs.itemById("movableOps").isEnabled = input.value
+
+            if input.id == "prestageTool":
+                inputs.itemById("prestageFormat").isEnabled = input.value
+
+            if input.id == "batchQueue":
+                inputs.itemById("batchRun").isEnabled = len(input.value) != 0
+
+            # Posting done so far is only good for the settings it started with
+            speculator.Begin(self.docSettings, self.selectedSetups)
+
         except:
             ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
@@ -857,65 +2734,482 @@ class CommandExecuteHandler(adsk.core.CommandEventHandler):
                         inputs.itemById("replaceString").value,
                         inputs.itemById("regex").value)
             button.value = False
+        elif self.docSettings["batchRun"]:
+            PostBatch(self.docSettings)
         else:
             PerformPostProcess(self.docSettings, self.selectedSetups)
 
 
-def GetOriginLocationSuffix(setup, debugComments=None):
-    """
-    Analyze the setup's WCS origin relative to stock and return a filename suffix.
-    Returns a string like "-FL-TOP" (Front-Left, Top), "-BR-BOT" (Back-Right, Bottom),
-    "-TOP", "-BOT", or empty string if custom location.
-    debugComments is a list that will be populated with debug info if provided.
-    """
-    try:
-        if debugComments is not None:
-            debugComments.append("(DEBUG: Analyzing origin location for setup: {})\n".format(setup.name))
-            # List all attributes of setup for debugging
-            attrs = [attr for attr in dir(setup) if not attr.startswith('_')]
-            debugComments.append("(DEBUG: Setup attributes: {})\n".format(", ".join(attrs[:20])))  # first 20
-            if len(attrs) > 20:
-                debugComments.append("(DEBUG: Setup attributes (cont): {})\n".format(", ".join(attrs[20:40])))
-            if len(attrs) > 40:
-                debugComments.append("(DEBUG: Setup attributes (cont): {})\n".format(", ".join(attrs[40:])))
-        
-        # Try to access the WCS (Work Coordinate System)
-        # The stock offset point is typically in setup.parameters
-        parameters = setup.parameters
-        if debugComments is not None:
-            debugComments.append("(DEBUG: setup.parameters exists = {})\n".format(parameters is not None))
-        
-        if not parameters:
-            return ""
-            
-        # Look for stock-related parameters
-        stockPoint = None
-        
-        # Try common parameter names for stock point settings
-        paramNames = ['wcs_origin_boxPoint', 'job_stockPointX', 'job_stockPointY', 'job_stockPointZ',
-                      'wcs_stock_point', 'stockPoint']
-        
-        if debugComments is not None:
-            debugComments.append("(DEBUG: Looking for stock point parameters...)\n")
-            
-        for paramName in paramNames:
-            try:
-                param = parameters.itemByName(paramName)
-                if param:
-                    if debugComments is not None:
-                        debugComments.append("(DEBUG: Found parameter: {} = {})\n".format(paramName, param.value.value))
-            except:
-                pass
-        
-        # The actual parameter is likely 'wcs_origin_boxPoint' which is an enum
+# Event handler for the destroy event.
+class CommandDestroyHandler(adsk.core.CommandEventHandler):
+    def __init__(self):
+        super().__init__()
+
+    def notify(self, args):
+        app = adsk.core.Application.get()
+        ui  = app.userInterface
         try:
-            boxPointParam = parameters.itemByName('wcs_origin_boxPoint')
-            if boxPointParam:
-                stockPoint = boxPointParam.value.value
-                if debugComments is not None:
-                    debugComments.append("(DEBUG: wcs_origin_boxPoint value = {})\n".format(stockPoint))
-                    debugComments.append("(DEBUG: wcs_origin_boxPoint type = {})\n".format(type(stockPoint).__name__))
-        except Exception as e:
+            speculator.Discard()    # dialog cancelled, or already taken
+
+        except:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+# Event handler for the custom event posting while the dialog is open.
+class SpeculateEventHandler(adsk.core.CustomEventHandler):
+    def __init__(self):
+        super().__init__()
+
+    def notify(self, args):
+        app = adsk.core.Application.get()
+        ui  = app.userInterface
+        try:
+            speculator.Step()
+
+        except:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+class Speculator:
+    # While the dialog is open, operations are posted into a run's fragment
+    # store using the settings shown, one post for each custom event so the
+    # dialog stays responsive. When OK is clicked with the same settings,
+    # the run is taken over and the posted G-code is used. When a setting
+    # changes the run is discarded and posting starts over. Nothing is
+    # posted while another post is running.
+    def __init__(self):
+        self.run = None
+        self.doc = None
+        self.fingerprint = None
+        self.steps = None           # generator posting one group at a time
+        self.customEvent = None
+
+    def Start(self):
+        app = adsk.core.Application.get()
+        self.customEvent = app.registerCustomEvent(constSpeculateEventId)
+        eventHandler = SpeculateEventHandler()
+        self.customEvent.add(eventHandler)
+        handlers.append(eventHandler)
+
+    def Stop(self):
+        self.Discard()
+        if self.customEvent:
+            adsk.core.Application.get().unregisterCustomEvent(constSpeculateEventId)
+            self.customEvent = None
+
+    @staticmethod
+    def Fingerprint(docSettings):
+        # Settings that matter, ignoring which groups are expanded
+        return json.dumps({key: value for key, value in docSettings.items() if not key.startswith("group")},
+                          sort_keys=True)
+
+    def Begin(self, docSettings, setups):
+        fingerprint = self.Fingerprint(docSettings)
+        if self.run and fingerprint == self.fingerprint:
+            return
+        self.Discard()
+        if docSettings["batchRun"] or not self.customEvent or fPosting:
+            return
+        app = adsk.core.Application.get()
+        self.run = PostRun()
+        self.doc = app.activeDocument
+        self.fingerprint = fingerprint
+        self.steps = self.Posts(json.loads(fingerprint), list(setups))
+        app.fireCustomEvent(constSpeculateEventId)
+
+    def Take(self, docSettings):
+        # The run with what was posted so far, with the NC program
+        # parameters put back, or None if the settings or document are
+        # not the same
+        run = self.run
+        if run and self.doc == adsk.core.Application.get().activeDocument and \
+                self.Fingerprint(docSettings) == self.fingerprint:
+            self.run = None
+            self.steps = None
+            for params in run.parameters.values():
+                params.Restore()
+            return run
+        self.Discard()
+        return None
+
+    def Discard(self):
+        self.steps = None
+        if self.run:
+            self.run.Close()
+            self.run = None
+
+    def Step(self):
+        if self.steps == None:
+            return
+        app = adsk.core.Application.get()
+        if fPosting:
+            # the NC program is in use, check back later
+            threading.Timer(constPostWaitDelay, app.fireCustomEvent, (constSpeculateEventId,)).start()
+            return
+        try:
+            more = next(self.steps, False)
+        except Exception:
+            more = False    # it was only a guess; the real run reports errors
+        if more is True:
+            app.fireCustomEvent(constSpeculateEventId)
+        elif more:
+            threading.Timer(more, app.fireCustomEvent, (constSpeculateEventId,)).start()
+        else:
+            self.steps = None
+
+    def Posts(self, docSettings, setups):
+        # Post the operation lists the run is expected to ask for, yielding
+        # True after each, or the seconds to wait before checking back for
+        # the output file. Setups whose toolpaths need generating are left
+        # for the run.
+        cam = adsk.cam.CAM.cast(self.doc.products.itemByProductType(constCAMProductId))
+        setups = GetSetups(cam, docSettings, setups)
+        fCombineOnly = docSettings["combineSetups"] and len(setups) > 1 and not docSettings["alsoSetupFiles"]
+        if not docSettings["splitSetup"] or (fCombineOnly and docSettings["combineTool"]):
+            return  # posted whole, or grouped by tool across setups
+        opFolder = tempfile.gettempdir().replace("\\", "/")
+        for program in GetNcPrograms(cam, docSettings):
+            parameters = program.parameters
+            fileExt = parameters.itemByName("nc_program_nc_extension").value.value
+            # point the NC program at the scratch folder until the run is
+            # taken or discarded, which puts the parameters back
+            params = self.run.Parameters(program)
+            params.Set("nc_program_openInEditor", False)
+            params.Set("nc_program_output_folder", opFolder)
+            params.Set("nc_program_filename", constSpeculateFile)
+            params.Set("nc_program_name", constSpeculateName)
+            opPath = opFolder + "/" + constSpeculateFile + fileExt
+            for setup in setups:
+                if setup.isSuppressed or not cam.checkToolpath(setup):
+                    continue
+                if fCombineOnly:
+                    groups = [[op] for op in setup.allOperations if not op.isSuppressed]
+                else:
+                    groups = [group[0] for group in OperationGroups(setup.allOperations, docSettings)]
+                for opList in groups:
+                    if self.run.store.Get(program, opList):
+                        continue
+                    if os.path.exists(opPath):
+                        os.remove(opPath)
+                    try:
+                        params.Apply()
+                        program.operations = opList
+                        fPosted = program.postProcess(adsk.cam.NCProgramPostProcessOptions.create())
+                    except Exception:
+                        fPosted = False
+                    # check back for the file rather than wait for it here
+                    waitEnd = time.monotonic() + docSettings["postTimeout"]
+                    while fPosted and not os.path.isfile(opPath) and time.monotonic() < waitEnd:
+                        yield constPostLoopDelay
+                    if fPosted and os.path.isfile(opPath):
+                        self.run.stats.Add("Operation posts")
+                        self.run.store.Add(program, opList, opPath, constSpeculateName)
+                    yield True
+
+
+# Event handler for the custom event posting the next setup.
+class PostEventHandler(adsk.core.CustomEventHandler):
+    def __init__(self):
+        super().__init__()
+
+    def notify(self, args):
+        app = adsk.core.Application.get()
+        ui  = app.userInterface
+        try:
+            poster.Step()
+
+        except:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+class Poster:
+    # Runs a post a file at a time, one for each custom event, so Fusion
+    # handles events between files instead of waiting for the whole run.
+    # The steps are a generator like PostDocument. The posted document
+    # must be active for each step, so the steps wait while another one
+    # is. fPosting is set until the run is done.
+    def __init__(self):
+        self.doc = None
+        self.steps = None
+        self.run = None
+        self.done = None    # called with the report when the run is done
+        self.customEvent = None
+
+    def Start(self):
+        app = adsk.core.Application.get()
+        self.customEvent = app.registerCustomEvent(constPostEventId)
+        eventHandler = PostEventHandler()
+        self.customEvent.add(eventHandler)
+        handlers.append(eventHandler)
+
+    def Stop(self):
+        if self.steps:
+            self.steps.close()
+            self.End()
+        if self.customEvent:
+            adsk.core.Application.get().unregisterCustomEvent(constPostEventId)
+            self.customEvent = None
+
+    def Begin(self, doc, steps, run, done):
+        # Post the steps, taking over the run
+        global fPosting
+        fPosting = True
+        self.doc = doc
+        self.steps = steps
+        self.run = run
+        self.done = done
+        if self.customEvent:
+            adsk.core.Application.get().fireCustomEvent(constPostEventId)
+        else:
+            while self.steps:
+                self.Step()
+
+    def Step(self):
+        if self.steps == None:
+            return
+        app = adsk.core.Application.get()
+        if self.customEvent and app.activeDocument != self.doc:
+            if not self.doc.isValid:
+                self.End()  # closed
+            else:
+                threading.Timer(constPostWaitDelay, app.fireCustomEvent, (constPostEventId,)).start()
+            return
+        try:
+            next(self.steps)
+        except StopIteration as stop:
+            self.End(stop.value, True)
+            return
+        except:
+            self.End()
+            raise
+        if self.customEvent:
+            app.fireCustomEvent(constPostEventId)
+
+    def End(self, report=None, fDone=False):
+        global fPosting
+        run = self.run
+        done = self.done
+        self.doc = None
+        self.steps = None
+        self.run = None
+        self.done = None
+        try:
+            if run.progress:
+                run.progress.hide()
+                run.progress = None
+            run.Close()
+        finally:
+            fPosting = False
+        if fDone:
+            done(report)
+
+
+def RunSteps(steps):
+    # Run all the steps of a post at once, returning the report
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+
+# Event handler for commands finishing, for watch mode.
+class WatchCommandHandler(adsk.core.ApplicationCommandEventHandler):
+    def __init__(self):
+        super().__init__()
+
+    def notify(self, args):
+        app = adsk.core.Application.get()
+        ui  = app.userInterface
+        try:
+            eventArgs = adsk.core.ApplicationCommandEventArgs.cast(args)
+            if eventArgs.commandId == constCmdDefId or fPosting:
+                return
+            doc = app.activeDocument
+            if doc and settingsMgr.GetSettings(doc.attributes)["watchMode"] and watcher.Changed(doc):
+                watcher.Schedule()
+
+        except:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+# Event handler for the watch mode custom event, fired from a timer.
+class WatchEventHandler(adsk.core.CustomEventHandler):
+    def __init__(self):
+        super().__init__()
+
+    def notify(self, args):
+        app = adsk.core.Application.get()
+        ui  = app.userInterface
+        try:
+            watcher.fScheduled = False
+            doc = app.activeDocument
+            if doc:
+                watcher.Post(doc)
+
+        except:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+
+class SetupWatcher:
+    # Watch mode. After each command in a document with watch mode on,
+    # setups whose operations were changed, or whose toolpaths are being
+    # generated, are marked stale. A timer fires a custom event to check
+    # back on the UI thread, and once their toolpaths are done just those
+    # setups are posted again.
+    def __init__(self):
+        self.signatures = dict()    # document name -> {setup name: signature}
+        self.stale = dict()         # document name -> set of setup names
+        self.fScheduled = False
+        self.customEvent = None
+        self.commandHandler = None
+
+    def Start(self):
+        app = adsk.core.Application.get()
+        self.customEvent = app.registerCustomEvent(constWatchEventId)
+        eventHandler = WatchEventHandler()
+        self.customEvent.add(eventHandler)
+        handlers.append(eventHandler)
+        self.commandHandler = WatchCommandHandler()
+        app.userInterface.commandTerminated.add(self.commandHandler)
+        handlers.append(self.commandHandler)
+
+    def Stop(self):
+        app = adsk.core.Application.get()
+        if self.commandHandler:
+            app.userInterface.commandTerminated.remove(self.commandHandler)
+            self.commandHandler = None
+        if self.customEvent:
+            app.unregisterCustomEvent(constWatchEventId)
+            self.customEvent = None
+
+    @staticmethod
+    def Signature(setup):
+        return tuple((op.name, op.isSuppressed) for op in setup.allOperations)
+
+    def Changed(self, doc):
+        # Mark the setups changed since they were last seen as stale.
+        # Returns True if any setup of the document is stale.
+        cam = adsk.cam.CAM.cast(doc.products.itemByProductType(constCAMProductId))
+        if not cam:
+            return False
+        fKnown = doc.name in self.signatures
+        signatures = self.signatures.setdefault(doc.name, dict())
+        stale = self.stale.setdefault(doc.name, set())
+        for setup in cam.setups:
+            signature = self.Signature(setup)
+            if signatures.get(setup.name) != signature:
+                if fKnown:
+                    stale.add(setup.name)
+                signatures[setup.name] = signature
+            for op in setup.allOperations:
+                if not op.isSuppressed and (op.isGenerating or not op.isToolpathValid):
+                    stale.add(setup.name)
+                    break
+        return len(stale) != 0
+
+    def Schedule(self):
+        if not self.fScheduled:
+            self.fScheduled = True
+            threading.Timer(constWatchDelay, adsk.core.Application.get().fireCustomEvent,
+                            (constWatchEventId,)).start()
+
+    def Post(self, doc):
+        # Post the stale setups of the document, or check back later if
+        # their toolpaths are still being generated, another post is
+        # running, or the dialog is posting ahead with the NC programs
+        if fPosting or (speculator and speculator.run):
+            self.Schedule()
+            return
+        stale = self.stale.get(doc.name)
+        cam = adsk.cam.CAM.cast(doc.products.itemByProductType(constCAMProductId))
+        if not stale or not cam:
+            return
+        setups = [setup for setup in cam.setups if setup.name in stale]
+        for setup in setups:
+            for op in setup.allOperations:
+                if not op.isSuppressed and op.isGenerating:
+                    self.Schedule()
+                    return
+        self.stale[doc.name] = set()
+        docSettings = settingsMgr.GetSettings(doc.attributes)
+        if not docSettings["watchMode"] or len(setups) == 0:
+            return
+        # no questions in the background, and the files of setups that
+        # aren't posted again are kept
+        docSettings["delFolder"] = False
+        docSettings["delFiles"] = False
+        docSettings["onlyFailed"] = False
+        docSettings["onlySelected"] = not docSettings["combineSetups"]
+
+        def Done(report):
+            for setup in cam.setups:
+                self.signatures[doc.name][setup.name] = self.Signature(setup)
+            if report != None and report[1] == adsk.core.MessageBoxIconTypes.WarningIconType:
+                adsk.core.Application.get().userInterface.messageBox(report[0],
+                    constCmdName,
+                    adsk.core.MessageBoxButtonTypes.OKButtonType,
+                    report[1])
+
+        run = PostRun()
+        poster.Begin(doc, PostDocument(doc, docSettings, setups, run, False), run, Done)
+
+
+def GetOriginLocationSuffix(setup, debugComments=None):
+    """
+    Analyze the setup's WCS origin relative to stock and return a filename suffix.
+    Returns a string like "-FL-TOP" (Front-Left, Top), "-BR-BOT" (Back-Right, Bottom),
+    "-TOP", "-BOT", or empty string if custom location.
+    debugComments is a list that will be populated with debug info if provided.
+    """
+    try:
+        if debugComments is not None:
+            debugComments.append("(DEBUG: Analyzing origin location for setup: {})\n".format(setup.name))
+            # List all attributes of setup for debugging
+            attrs = [attr for attr in dir(setup) if not attr.startswith('_')]
+            debugComments.append("(DEBUG: Setup attributes: {})\n".format(", ".join(attrs[:20])))  # first 20
+            if len(attrs) > 20:
+                debugComments.append("(DEBUG: Setup attributes (cont): {})\n".format(", ".join(attrs[20:40])))
+            if len(attrs) > 40:
+                debugComments.append("(DEBUG: Setup attributes (cont): {})\n".format(", ".join(attrs[40:])))
+        
+        # Try to access the WCS (Work Coordinate System)
+        # The stock offset point is typically in setup.parameters
+        parameters = setup.parameters
+        if debugComments is not None:
+            debugComments.append("(DEBUG: setup.parameters exists = {})\n".format(parameters is not None))
+        
+        if not parameters:
+            return ""
+            
+        # Look for stock-related parameters
+        stockPoint = None
+        
+        # Try common parameter names for stock point settings
+        paramNames = ['wcs_origin_boxPoint', 'job_stockPointX', 'job_stockPointY', 'job_stockPointZ',
+                      'wcs_stock_point', 'stockPoint']
+        
+        if debugComments is not None:
+            debugComments.append("(DEBUG: Looking for stock point parameters...)\n")
+            
+        for paramName in paramNames:
+            try:
+                param = parameters.itemByName(paramName)
+                if param:
+                    if debugComments is not None:
+                        debugComments.append("(DEBUG: Found parameter: {} = {})\n".format(paramName, param.value.value))
+            except:
+                pass
+        
+        # The actual parameter is likely 'wcs_origin_boxPoint' which is an enum
+        try:
+            boxPointParam = parameters.itemByName('wcs_origin_boxPoint')
+            if boxPointParam:
+                stockPoint = boxPointParam.value.value
+                if debugComments is not None:
+                    debugComments.append("(DEBUG: wcs_origin_boxPoint value = {})\n".format(stockPoint))
+                    debugComments.append("(DEBUG: wcs_origin_boxPoint type = {})\n".format(type(stockPoint).__name__))
+        except Exception as e:
             if debugComments is not None:
                 debugComments.append("(DEBUG: Error accessing wcs_origin_boxPoint: {})\n".format(str(e)))
         
@@ -1005,210 +3299,556 @@ def GetOriginLocationSuffix(setup, debugComments=None):
         return ""
 
 
+def BalanceSetups(cam, setups, cntMachines, run):
+    # Spread setups across machines by estimated machining time, placing
+    # the longest remaining job on the least loaded machine. Setups in the
+    # same folder ("folder:name") are kept together. Returns a list
+    # parallel to cam.setups with the machine index of each included
+    # setup, or None. A schedule summary is added to the run's notes.
+    times = []
+    groups = dict()     # folder (or lone setup) -> [setup index, ...]
+    fEstimated = True
+    for iSetup, setup in enumerate(cam.setups):
+        times.append(0)
+        if setup.isSuppressed or setup.allOperations.count == 0 or not setup in setups:
+            continue
+        try:
+            times[iSetup] = cam.getMachiningTime(setup, 100, constEstRapidFeed, constEstToolChangeTime).machiningTime
+        except:
+            fEstimated = False
+        nameList = setup.name.split(':')
+        if len(nameList) > 1:
+            key = ":".join(name.strip() for name in nameList[:-1])
+        else:
+            key = iSetup
+        groups.setdefault(key, []).append(iSetup)
+
+    if not fEstimated:
+        # no estimate available, balance by number of operations
+        for iSetup, setup in enumerate(cam.setups):
+            times[iSetup] = setup.allOperations.count
+
+    machines = [None] * len(times)
+    loads = [0] * cntMachines
+    members = [[] for machine in range(cntMachines)]
+    jobs = sorted(groups.values(), key=lambda group: sum(times[iSetup] for iSetup in group), reverse=True)
+    for group in jobs:
+        machine = loads.index(min(loads))
+        for iSetup in group:
+            machines[iSetup] = machine
+            members[machine].append(iSetup)
+        loads[machine] += sum(times[iSetup] for iSetup in group)
+
+    # schedule summary
+    names = [setup.name for setup in cam.setups]
+    if fEstimated:
+        run.stats.Note("Estimated machining time, longest {}:".format(FormatTime(max(loads))))
+    else:
+        run.stats.Note("Machining time not available, balanced by number of operations:")
+    for machine in range(cntMachines):
+        if fEstimated:
+            load = FormatTime(loads[machine])
+        else:
+            load = "{} operations".format(loads[machine])
+        if len(members[machine]) == 0:
+            setupNames = "(none)"
+        else:
+            setupNames = ", ".join(names[iSetup] for iSetup in sorted(members[machine]))
+        run.stats.Note("{} ({}): {}".format(constMachineFolder.format(machine + 1), load, setupNames))
+    return machines
+
+
+def FormatTime(seconds):
+    seconds = int(round(seconds))
+    return "{}:{:02}:{:02}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def GetOutputFolder(program):
+    # normalize output folder for this user
+    # "\" is converted to "/"
+    outputFolder = program.parameters.itemByName("nc_program_output_folder").value.value.replace("\\", "/")
+    # keep leading "\\" for file share
+    if outputFolder[0:2] == "//":
+        outputFolder = "\\\\" + outputFolder[2:]
+    try:
+        pathlib.Path(outputFolder).mkdir(exist_ok=True)
+    except Exception as exc:
+        # see if we can map it to folder with compressed user
+        compressedName = program.attributes.itemByName(constAttrGroup, constAttrCompressedName).value
+        if compressedName[0] == "~" and compressedName[1:] == outputFolder[-(len(compressedName) - 1):]:
+            # yes, it matches
+            outputFolder = ExpandFileName(compressedName)
+
+    program.attributes.add(constAttrGroup, constAttrCompressedName, CompressFileName(outputFolder))
+    return outputFolder
+
+
+def PostProgram(program, outputFolder, docSettings, setups, machines, run):
+    # Post the setups with one NC program into its output folder.
+    # machines is None, or has the machine index of each setup in
+    # cam.setups, putting it in that machine's subfolder. A generator
+    # yielding after each file, returning (files written, setups
+    # skipped, failure messages), or None if the user chose to abort.
+    app = adsk.core.Application.get()
+    ui  = app.userInterface
+    cam = adsk.cam.CAM.cast(app.activeDocument.products.itemByProductType(constCAMProductId))
+    parameters = program.parameters
+    cntFiles = 0
+    cntSkipped = 0
+    lstSkipped = ""
+    fDelFolder = docSettings["delFolder"]
+
+    if fDelFolder:
+        fileExt = parameters.itemByName("nc_program_nc_extension").value.value
+        strMsg = CountOutputFolderFiles(outputFolder, len(setups), fileExt)
+        if strMsg:
+            fDelFolder = False
+            strMsg = (
+                "The output folder contains {}. "
+                "It will not be deleted. You may wish to make sure you selected "
+                "the correct folder. If you want the folder deleted, you must "
+                "do it manually."
+                ).format(strMsg)
+            res = ui.messageBox(strMsg, 
+                                constCmdName,
+                                adsk.core.MessageBoxButtonTypes.OKCancelButtonType,
+                                adsk.core.MessageBoxIconTypes.WarningIconType)
+            if res == adsk.core.DialogResults.DialogCancel:
+                return None # abort!
+
+    if fDelFolder:
+        try:
+            shutil.rmtree(outputFolder, True)
+        except:
+            pass #ignore errors
+
+    progress = ui.createProgressDialog()
+    run.progress = progress
+    progress.isCancelButtonShown = True
+    progressMsg = "{} files written to " + outputFolder
+    progress.show("Post Processing...", "", 0, len(setups) * constProgressSteps)
+    progress.progressValue = 1 # try to get it to display
+    progress.progressValue = 0
+
+    # Check if we should combine setups into one file
+    fCombine = docSettings.get("combineSetups", False) and len(setups) > 1
+
+    # Individual setup files are written first, so deleting existing
+    # files can't remove the combined file. Both share one post per
+    # operation through the fragment store.
+    if not fCombine or docSettings["alsoSetupFiles"]:
+        # Normal per-setup processing
+        cntSetups = 0
+        seqDict = dict()
+
+        # We pass through all setups even if only some are selected
+        # so numbering scheme doesn't change.
+        for iSetup, setup in enumerate(cam.setups):
+            if progress.wasCancelled:
+                break
+            if not setup.isSuppressed and setup.allOperations.count != 0:
+                nameList = setup.name.split(':')    # folder separator
+                setupFolder = outputFolder
+                if machines != None:
+                    if machines[iSetup] == None:
+                        continue    # not included, not numbered
+                    setupFolder += "/" + constMachineFolder.format(machines[iSetup] + 1)
+                cnt = len(nameList) - 1
+                i = 0
+                while i < cnt:
+                    setupFolder += "/" + nameList[i].strip()
+                    i += 1
+            
+                # keep a separate sequence number for each folder
+                if setupFolder in seqDict:
+                    seqDict[setupFolder] += 1
+                    # skip if we're not actually including this setup
+                    if setup not in setups:
+                        continue
+                else:
+                    # first file for this folder
+                    seqDict[setupFolder] = 1
+                    # skip if we're not actually including this setup
+                    if setup not in setups:
+                        continue
+
+                    if (docSettings["delFiles"]):
+                        # delete all the files in the folder
+                        try:
+                            for entry in os.scandir(setupFolder):
+                                if entry.is_file():
+                                    try:
+                                        os.remove(entry.path)
+                                    except:
+                                        pass #ignore errors
+                        except:
+                            pass #ignore errors
+
+                # prepend sequence number if enabled
+                fname = nameList[i].strip()
+                if docSettings["sequence"] or docSettings["numericName"]:
+                    seq = seqDict[setupFolder]
+                    seqStr = str(seq)
+                    if docSettings["twoDigits"] and seq < 10:
+                        seqStr = "0" + seqStr
+                    if docSettings["numericName"]:
+                        fname = seqStr
+                    else:
+                        fname = seqStr + ' ' + fname
+
+                # append origin location suffix based on WCS relative to stock
+                if docSettings.get("appendOriginLocation", True):
+                    # debugComments = []  # Set to [] to enable debug output in G-code files
+                    originSuffix = GetOriginLocationSuffix(setup, None)
+                    if originSuffix:
+                        fname = fname + originSuffix
+
+                # append NOFIRSTTOOL if skipFirstToolchange is enabled
+                if docSettings["skipFirstToolchange"] and docSettings["splitSetup"]:
+                    fname = fname + "-NOFIRSTTOOL"
+
+                # post the file
+                run.progressBase = cntSetups * constProgressSteps
+                status = yield from PostProcessSetup(fname, setup, setupFolder, docSettings, program, run, None)
+                if status == None:
+                    cntFiles += 1
+                else:
+                    cntSkipped += 1
+                    lstSkipped += "\nFailed on setup " + setup.name + ": " + status
+                
+            cntSetups += 1
+            progress.message = progressMsg.format(cntFiles)
+            progress.progressValue = cntSetups * constProgressSteps
+            yield True
+
+    if fCombine and not progress.wasCancelled:
+        # Use combined processing mode, one combined file per machine
+        if machines == None:
+            combineList = [(outputFolder, setups)]
+        else:
+            combineList = []
+            for machine in range(docSettings["machineCount"]):
+                machineSetups = [setup for iSetup, setup in enumerate(cam.setups) if machines[iSetup] == machine]
+                if len(machineSetups) != 0:
+                    combineList.append((outputFolder + "/" + constMachineFolder.format(machine + 1), machineSetups))
+
+        for combineFolder, combineSetups in combineList:
+            if progress.wasCancelled:
+                break
+            progress.message = "Combining setups..."
+            progress.progressValue = 0
+            status = yield from PostProcessCombinedSetups(combineSetups, combineFolder, docSettings, program, progress, run)
+            if status == None:
+                cntFiles += 1
+            else:
+                cntSkipped += len(combineSetups)
+                if len(lstSkipped) != 0:
+                    lstSkipped += "\n"
+                lstSkipped += status
+            yield True
+
+    run.fCancelled = progress.wasCancelled
+    progress.hide()
+    run.progress = None
+    # restore program output folder when the run is over
+    run.Parameters(program).RestoreTo("nc_program_output_folder", outputFolder)
+    return (cntFiles, cntSkipped, lstSkipped)
+
+
 def PerformPostProcess(docSettings, setups):
     ui = None
-    progress = None
+    run = None
     try:
         app = adsk.core.Application.get()
         ui  = app.userInterface
+        if fPosting:
+            ui.messageBox(constStillPosting,
+                constCmdName,
+                adsk.core.MessageBoxButtonTypes.OKButtonType,
+                adsk.core.MessageBoxIconTypes.WarningIconType)
+            return
+        run = speculator.Take(docSettings) if speculator else None
+        if run == None:
+            run = PostRun()
         doc = app.activeDocument
-        cam = adsk.cam.CAM.cast(doc.products.itemByProductType(constCAMProductId))
 
-        cntFiles = 0
-        cntSkipped = 0
-        lstSkipped = ""
+        def Done(report):
+            if docSettings["watchMode"]:
+                watcher.Changed(doc)  # start from what was just posted
+                watcher.stale[doc.name] = set()
+            if report != None and report[1] != None:
+                ui.messageBox(report[0],
+                    constCmdName,
+                    adsk.core.MessageBoxButtonTypes.OKButtonType,
+                    report[1])
 
-        program = GetNcProgram(cam, docSettings);
-        parameters = program.parameters
-        setups = GetSetups(cam, docSettings, setups)
+        postRun = run
+        run = None  # the poster closes it
+        poster.Begin(doc, PostDocument(doc, docSettings, setups, postRun, True), postRun, Done)
 
-        # normalize output folder for this user
-        # "\" is converted to "/"
-        outputFolder = parameters.itemByName("nc_program_output_folder").value.value.replace("\\", "/")
-        # keep leading "\\" for file share
-        if outputFolder[0:2] == "//":
-            outputFolder = "\\\\" + outputFolder[2:]
-        try:
-            pathlib.Path(outputFolder).mkdir(exist_ok=True)
-        except Exception as exc:
-            # see if we can map it to folder with compressed user
-            compressedName = program.attributes.itemByName(constAttrGroup, constAttrCompressedName).value
-            if compressedName[0] == "~" and compressedName[1:] == outputFolder[-(len(compressedName) - 1):]:
-                # yes, it matches
-                outputFolder = ExpandFileName(compressedName)
+    except:
+        if run and run.progress:
+            run.progress.hide()
+        if ui:
+            ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
-        compressedName = CompressFileName(outputFolder)
-        program.attributes.add(constAttrGroup, constAttrCompressedName, compressedName)
-        docSettings["output"] = compressedName
+    finally:
+        if run:
+            run.Close()
 
-        # Save settings in document attributes
+
+def PostDocument(doc, docSettings, setups, run, fSaveSettings):
+    # Post the setups of the active document. The settings are saved in
+    # the document if fSaveSettings, which unattended posts leave off so
+    # their overrides aren't kept. A generator yielding after each file,
+    # for Poster or RunSteps, returning (report, message box icon), with
+    # no icon if there's nothing worth showing, or None if the user chose
+    # to abort.
+    cam = adsk.cam.CAM.cast(doc.products.itemByProductType(constCAMProductId))
+
+    cntFiles = 0
+    cntSkipped = 0
+    lstSkipped = ""
+
+    programs = GetNcPrograms(cam, docSettings)
+    setups = GetSetups(cam, docSettings, setups)
+
+    outputFolders = []
+    for program in programs:
+        outputFolders.append(GetOutputFolder(program))
+    docSettings["output"] = CompressFileName(outputFolders[0])
+
+    # Save settings in document attributes
+    if fSaveSettings:
         settingsMgr.SaveSettings(doc.attributes, docSettings)
 
-        if len(setups) != 0 and cam.allOperations.count != 0:
-            # make sure we're not going to delete too much
-            if not docSettings["delFiles"]:
-                docSettings["delFolder"] = False
-
-            if docSettings["delFolder"]:
-                fileExt = parameters.itemByName("nc_program_nc_extension").value.value
-                strMsg = CountOutputFolderFiles(outputFolder, len(setups), fileExt)
-                if strMsg:
-                    docSettings["delFolder"] = False
-                    strMsg = (
-                        "The output folder contains {}. "
-                        "It will not be deleted. You may wish to make sure you selected "
-                        "the correct folder. If you want the folder deleted, you must "
-                        "do it manually."
-                        ).format(strMsg)
-                    res = ui.messageBox(strMsg, 
-                                        constCmdName,
-                                        adsk.core.MessageBoxButtonTypes.OKCancelButtonType,
-                                        adsk.core.MessageBoxIconTypes.WarningIconType)
-                    if res == adsk.core.DialogResults.DialogCancel:
-                        return  # abort!
-
-            if docSettings["delFolder"]:
-                try:
-                    shutil.rmtree(outputFolder, True)
-                except:
-                    pass #ignore errors
+    # Settings that would only fail part way through the files
+    status = CheckPrestageFormat(docSettings)
+    if status != None:
+        return (status, adsk.core.MessageBoxIconTypes.WarningIconType)
+
+    if len(setups) != 0 and cam.allOperations.count != 0:
+        # make sure we're not going to delete too much
+        if not docSettings["delFiles"]:
+            docSettings["delFolder"] = False
+
+        # Optionally spread setups across machines, each with its own folder
+        machines = None
+        if docSettings["machineCount"] > 1:
+            machines = BalanceSetups(cam, setups, docSettings["machineCount"], run)
+
+        # Toolpaths are generated for the first NC program and are
+        # still valid for the rest, which only need posting
+        for i in range(len(programs)):
+            program = programs[i]
+            if outputFolders[i] in outputFolders[:i]:
+                cntSkipped += len(setups)
+                lstSkipped += "\nNC program " + program.name + " was skipped because its " \
+                    "output folder is the same as another selected NC program."
+                continue
 
-            progress = ui.createProgressDialog()
-            progress.isCancelButtonShown = True
-            progressMsg = "{} files written to " + outputFolder
-            progress.show("Post Processing...", "", 0, len(setups))
-            progress.progressValue = 1 # try to get it to display
-            progress.progressValue = 0
+            result = yield from PostProgram(program, outputFolders[i], docSettings, setups, machines, run)
+            if result == None:
+                return None # abort!
+            cntFiles += result[0]
+            cntSkipped += result[1]
+            if len(programs) > 1 and len(result[2]) != 0:
+                lstSkipped += "\nNC program " + program.name + ":"
+            lstSkipped += result[2]
+            if run.fCancelled:
+                break
 
-            # Check if we should combine setups into one file
-            if docSettings.get("combineSetups", False) and len(setups) > 1:
-                # Use combined processing mode
-                progress.message = "Combining setups..."
-                status = PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progress)
-                if status == None:
-                    cntFiles = 1
-                else:
-                    cntSkipped = len(setups)
-                    lstSkipped = status
-                progress.hide()
-                # restore program output folder
-                AssignOutputFolder(parameters, outputFolder)
-            else:
-                # Normal per-setup processing
-                cntSetups = 0
-                seqDict = dict()
-
-                # We pass through all setups even if only some are selected
-                # so numbering scheme doesn't change.
-                for setup in cam.setups:
-                    if progress.wasCancelled:
-                        break
-                    if not setup.isSuppressed and setup.allOperations.count != 0:
-                        nameList = setup.name.split(':')    # folder separator
-                        setupFolder = outputFolder
-                        cnt = len(nameList) - 1
-                        i = 0
-                        while i < cnt:
-                            setupFolder += "/" + nameList[i].strip()
-                            i += 1
-                    
-                        # keep a separate sequence number for each folder
-                        if setupFolder in seqDict:
-                            seqDict[setupFolder] += 1
-                            # skip if we're not actually including this setup
-                            if setup not in setups:
-                                continue
-                        else:
-                            # first file for this folder
-                            seqDict[setupFolder] = 1
-                            # skip if we're not actually including this setup
-                            if setup not in setups:
-                                continue
-
-                            if (docSettings["delFiles"]):
-                                # delete all the files in the folder
-                                try:
-                                    for entry in os.scandir(setupFolder):
-                                        if entry.is_file():
-                                            try:
-                                                os.remove(entry.path)
-                                            except:
-                                                pass #ignore errors
-                                except:
-                                    pass #ignore errors
-
-                        # prepend sequence number if enabled
-                        fname = nameList[i].strip()
-                        if docSettings["sequence"] or docSettings["numericName"]:
-                            seq = seqDict[setupFolder]
-                            seqStr = str(seq)
-                            if docSettings["twoDigits"] and seq < 10:
-                                seqStr = "0" + seqStr
-                            if docSettings["numericName"]:
-                                fname = seqStr
-                            else:
-                                fname = seqStr + ' ' + fname
-
-                        # append origin location suffix based on WCS relative to stock
-                        if docSettings.get("appendOriginLocation", True):
-                            # debugComments = []  # Set to [] to enable debug output in G-code files
-                            originSuffix = GetOriginLocationSuffix(setup, None)
-                            if originSuffix:
-                                fname = fname + originSuffix
-
-                        # append NOFIRSTTOOL if skipFirstToolchange is enabled
-                        if docSettings["skipFirstToolchange"] and docSettings["splitSetup"]:
-                            fname = fname + "-NOFIRSTTOOL"
-
-                        # post the file
-                        status = PostProcessSetup(fname, setup, setupFolder, docSettings, program, None)
-                        if status == None:
-                            cntFiles += 1
-                        else:
-                            cntSkipped += 1
-                            lstSkipped += "\nFailed on setup " + setup.name + ": " + status
-                        
-                    cntSetups += 1
-                    progress.message = progressMsg.format(cntFiles)
-                    progress.progressValue = cntSetups
-
-                progress.hide()
-                # restore program output folder
-                AssignOutputFolder(parameters, outputFolder)
-
-        # done with setups, report results
-        if cntSkipped != 0:
-            ui.messageBox("{} files were written. {} Setups were skipped due to error:{}".format(cntFiles, cntSkipped, lstSkipped), 
-                constCmdName, 
-                adsk.core.MessageBoxButtonTypes.OKButtonType,
-                adsk.core.MessageBoxIconTypes.WarningIconType)
-            
-        elif cntFiles == 0:
-            ui.messageBox('No CAM operations posted', 
-                constCmdName, 
+    # Output files are finished before reporting
+    for path, error in run.Wait():
+        cntFiles -= 1
+        cntSkipped += 1
+        lstSkipped += "\nUnable to finish " + path + ": " + error
+
+    # Record operations that failed to post for the next run
+    if len(run.failures) != 0:
+        lines = ["{} operations failed to post and were left out:".format(len(run.failures))]
+        for failure in run.failures:
+            lines.append("    {}: {} - {}".format(failure[1], failure[2], failure[3]))
+        run.stats.Note("\n".join(lines))
+    SaveFailures(doc.attributes, [] if run.fCancelled else setups, run.failures)
+
+    # done with setups, report results
+    strStats = run.stats.Format(docSettings["showStats"])
+    if len(strStats) != 0:
+        strStats = "\n\n" + strStats
+
+    if cntSkipped != 0:
+        return ("{} files were written. {} Setups were skipped due to error:{}{}".format(cntFiles, cntSkipped, lstSkipped, strStats),
+            adsk.core.MessageBoxIconTypes.WarningIconType)
+
+    if cntFiles == 0:
+        return ("No CAM operations posted", adsk.core.MessageBoxIconTypes.WarningIconType)
+
+    if len(strStats) != 0:
+        return ("{} files were written.{}".format(cntFiles, strStats),
+            adsk.core.MessageBoxIconTypes.WarningIconType if len(run.failures) != 0 else
+            adsk.core.MessageBoxIconTypes.InformationIconType)
+
+    return ("{} files were written.".format(cntFiles), None)
+
+
+def PostBatch(docSettings):
+    # Post each document in the batch queue file with the settings saved
+    # in it, then report on all of them. The queue has a Fusion archive
+    # path, the name of an open document, or "*" for all open documents
+    # on each line. The version of each document posted is saved in a
+    # file next to the queue, and documents that haven't changed since
+    # are skipped, so an interrupted batch picks up where it left off.
+    global fPosting
+    app = adsk.core.Application.get()
+    ui  = app.userInterface
+    if fPosting:
+        ui.messageBox(constStillPosting,
+            constCmdName,
+            adsk.core.MessageBoxButtonTypes.OKButtonType,
+            adsk.core.MessageBoxIconTypes.WarningIconType)
+        return
+    fPosting = True
+    try:
+        queuePath = ExpandFileName(docSettings["batchQueue"])
+        try:
+            with open(queuePath) as file:
+                entries = [line.strip() for line in file]
+        except OSError as exc:
+            ui.messageBox("Unable to read batch queue: " + str(exc),
+                constCmdName,
                 adsk.core.MessageBoxButtonTypes.OKButtonType,
                 adsk.core.MessageBoxIconTypes.WarningIconType)
-            
+            return
+
+        statePath = os.path.splitext(queuePath)[0] + constBatchStateExt
+        try:
+            with open(statePath) as file:
+                state = json.load(file)
+        except Exception:
+            state = dict()  # document -> version posted
+
+        # Documents to post, as (name in queue, open document or archive path)
+        targets = []
+        for entry in entries:
+            if len(entry) == 0 or entry[0] == "#":
+                continue
+            if entry == "*":
+                for doc in app.documents:
+                    if doc.products.itemByProductType(constCAMProductId):
+                        targets.append((doc.name, doc))
+                continue
+            target = ExpandFileName(entry)
+            for doc in app.documents:
+                if doc.name == entry:
+                    target = doc
+                    break
+            targets.append((entry, target))
+
+        original = app.activeDocument
+        lines = []
+        cntPosted = 0
+        for name, target in targets:
+            stamp = BatchStamp(target)
+            if stamp != None and state.get(name) == stamp:
+                lines.append(name + ": up to date")
+                continue
+            if isinstance(target, str) and not os.path.isfile(target):
+                lines.append(name + ": file not found")
+                continue
+
+            run = PostRun()
+            doc = None
+            try:
+                if isinstance(target, str):
+                    options = app.importManager.createFusionArchiveImportOptions(target)
+                    doc = app.importManager.importToNewDocument(options)
+                else:
+                    target.activate()
+                if not app.activeDocument.products.itemByProductType(constCAMProductId):
+                    report = ("No CAM operations posted", adsk.core.MessageBoxIconTypes.WarningIconType)
+                else:
+                    settings = settingsMgr.GetSettings(app.activeDocument.attributes)
+                    # no questions while unattended
+                    settings["delFolder"] = False
+                    settings["onlySelected"] = False
+                    settings["onlyFailed"] = False
+                    report = RunSteps(PostDocument(app.activeDocument, settings, [], run, False))
+            except:
+                if run.progress:
+                    run.progress.hide()
+                report = ("Failed: " + traceback.format_exc().strip().split("\n")[-1],
+                    adsk.core.MessageBoxIconTypes.WarningIconType)
+            finally:
+                run.Close()
+                if doc:
+                    doc.close(False)
+
+            lines.append(name + ": " + report[0].replace("\n", "\n    "))
+            cntPosted += 1
+            if stamp != None and report[1] != adsk.core.MessageBoxIconTypes.WarningIconType and not run.fCancelled:
+                state[name] = stamp
+                with open(statePath, "w") as file:
+                    json.dump(state, file, indent=1)
+            if run.fCancelled:
+                lines.append("Cancelled by user")
+                break
+
+        if original:
+            original.activate()
+
+        report = "{} of {} documents in the batch were posted.\n\n".format(cntPosted, len(targets)) + "\n".join(lines)
+        try:
+            with open(os.path.splitext(queuePath)[0] + constBatchReportExt, "w") as file:
+                file.write(report + "\n")
+        except OSError:
+            pass
+        ui.messageBox(report,
+            constCmdName,
+            adsk.core.MessageBoxButtonTypes.OKButtonType,
+            adsk.core.MessageBoxIconTypes.InformationIconType)
 
     except:
-        if progress:
-            progress.hide()
         if ui:
             ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
+    finally:
+        fPosting = False
+
 
-def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progress):
+def BatchStamp(target):
+    # Version of a document in the batch queue: modification time and size
+    # of an archive, or the saved version of an open document. None if
+    # unknown or the open document has changes not saved, which is never
+    # up to date.
+    if isinstance(target, str):
+        try:
+            info = os.stat(target)
+            return "{}:{}".format(info.st_mtime_ns, info.st_size)
+        except OSError:
+            return None
+    try:
+        if target.isModified:
+            return None
+        return "{}:{}".format(target.dataFile.id, target.dataFile.versionNumber)
+    except:
+        return None
+
+
+def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progress, run):
     """
     Combine multiple setups into a single output file, reordering operations
     by tool number to minimize tool changes. Operations using the same tool
     across different setups will be grouped together.
     
+    A generator, yielding after each post so Fusion stays responsive.
+    The posted G-code is put together into the output file on the
+    worker thread.
+    
     Returns None on success, or an error message string on failure.
     """
     ui = None
     fileHead = None
-    fileBody = None
-    fileOp = None
     retVal = "Fusion reported an exception"
 
     try:
@@ -1240,9 +3880,9 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                     time.sleep(.1)
 
         # Collect all operations from all setups and group by tool number
-        # Each entry: (tool_number, setup, operation)
+        # Each entry: (tool_number, setup index, setup, operation)
         allOps = []
-        for setup in setups:
+        for iSetup, setup in enumerate(setups):
             for i in range(setup.allOperations.count):
                 op = setup.allOperations.item(i)
                 if op.isSuppressed:
@@ -1253,7 +3893,7 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                 else:
                     # Manual NC - assign tool number 0 or find adjacent operation's tool
                     toolNum = 0
-                allOps.append((toolNum, setup, op))
+                allOps.append((toolNum, iSetup, setup, op))
         
         if len(allOps) == 0:
             fileHead.close()
@@ -1266,18 +3906,18 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
 
         # Build list of operations grouped by tool for processing
         # We need to process in groups where each group can be sent to postProcess
-        opGroups = []  # List of (toolNum, [(setup, op), ...])
+        opGroups = []  # List of (toolNum, [(setup index, setup, op), ...])
         currentTool = None
         currentGroup = []
         
-        for toolNum, setup, op in allOps:
+        for toolNum, iSetup, setup, op in allOps:
             if currentTool != toolNum:
                 if currentGroup:
                     opGroups.append((currentTool, currentGroup))
                 currentTool = toolNum
-                currentGroup = [(setup, op)]
+                currentGroup = [(iSetup, setup, op)]
             else:
-                currentGroup.append((setup, op))
+                currentGroup.append((iSetup, setup, op))
         
         if currentGroup:
             opGroups.append((currentTool, currentGroup))
@@ -1285,15 +3925,117 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
         # Set up temporary output location
         opName = constOpTmpFile
         opFolder = tempfile.gettempdir().replace("\\", "/")
-        opPath = opFolder + "/" + opName + fileExt
         
-        parameters.itemByName("nc_program_openInEditor").value.value = False
-        AssignOutputFolder(parameters, opFolder)
-        parameters.itemByName("nc_program_filename").value.value = opName
-        parameters.itemByName("nc_program_name").value.value = fname
+        params = run.Parameters(program)
+        params.Set("nc_program_openInEditor", False)
+        params.Set("nc_program_output_folder", opFolder)
+        params.Set("nc_program_filename", opName)
+        params.Set("nc_program_name", fname)
+
+        # Optional reordering within tool groups to minimize rapid travel,
+        # only of the operations allowed to move
+        regMovable = None
+        if docSettings["minimizeTravel"] and len(docSettings["movableOps"]) != 0:
+            try:
+                regMovable = re.compile(docSettings["movableOps"], re.IGNORECASE)
+            except re.error as exc:
+                RemoveOutput(fileHead, None, path)
+                return "Invalid expression for operations that may be reordered: " + str(exc)
+        regHsm, status = MakeHsmRegex(docSettings)
+        if status != None:
+            RemoveOutput(fileHead, None, path)
+            return status
+        failedOps = []
+        totalOps = sum(len(group[1]) for group in opGroups)
+        processedOps = 0
+        toolGroups = []     # (toolNum, [PostedPart, ...]) for each tool group
+
+        # Post each tool group, reading what putting it in the file needs
+        # from Fusion
+        for toolNum, opsInGroup in opGroups:
+            # Consecutive operations from the same setup can optionally be
+            # posted together, letting Fusion handle the transitions
+            postGroups = []  # List of (setup index, setup, [op, ...])
+            for iSetup, setup, op in opsInGroup:
+                if docSettings.get("combineTool", False) and op.hasToolpath and len(postGroups) != 0 and \
+                    postGroups[-1][0] == iSetup and postGroups[-1][2][-1].hasToolpath:
+                    postGroups[-1][2].append(op)
+                else:
+                    postGroups.append((iSetup, setup, [op]))
+
+            # Post the whole group, leaving out operations that fail to
+            # post, so the first one posted gets the tool change
+            parts = []
+            fFirstGroup = all(len(group[1]) == 0 for group in toolGroups)
+            for iSetup, setup, opList in postGroups:
+                if progress and progress.wasCancelled:
+                    RemoveOutput(fileHead, None, path)
+                    return "Cancelled by user"
+                fragment, postedName, postedOps, status = PostGroup(program, opList, opFolder, opName, fileExt,
+                                                                    docSettings, run, fname, opList[0].name)
+                if status != None:
+                    RemoveOutput(fileHead, None, path)
+                    return status
+                failedOps += [op for op in opList if not op in postedOps]
+                processedOps += len(opList)
+                if fragment != None:
+                    fMovable = regMovable != None and toolNum != 0 and \
+                        all(regMovable.search(op.name) for op in postedOps)
+                    # The first operation in the file may be one that can
+                    # be moved to the front
+                    if fFirstGroup and postedName == constSpeculateName and \
+                        (len(parts) == 0 or (fMovable and parts[0].fMovable)):
+                        fragment, postedName, status = PostFirstAgain(program, postedOps, opFolder, opName, fileExt,
+                                                                      docSettings, run, fname)
+                        if status != None:
+                            RemoveOutput(fileHead, None, path)
+                            return status
+                    part = PostedPart(fragment, postedName, iSetup, setup, postedOps, docSettings, regHsm)
+                    part.fMovable = fMovable
+                    parts.append(part)
+                if progress:
+                    progress.progressValue = int((processedOps / totalOps) * len(setups) * constProgressSteps)
+                yield True
+            toolGroups.append((toolNum, parts))
+
+        if all(len(group[1]) == 0 for group in toolGroups):
+            # don't leave a file with only the header
+            RemoveOutput(fileHead, None, path)
+            return "No operations could be posted" if len(failedOps) != 0 else "No operations to post"
+
+        # Put the file together on the worker thread
+        run.Finish(path, AssembleCombined, toolGroups, [op.parentSetup.name + ": " + op.name for op in failedOps],
+                   fname, opName, path, fileHead, opFolder, fileExt, dict(docSettings), regMovable != None, run)
+        fileHead = None
+
+        return None
 
+    except:
+        if fileHead:
+            try:
+                fileHead.close()
+                os.remove(fileHead.name)
+            except:
+                pass
+        if run.fCancelled:
+            return "Cancelled by user"
+        if ui:
+            retVal += " " + traceback.format_exc()
+        return retVal
+
+
+def AssembleCombined(toolGroups, failedNames, fname, opName, path, fileHead, opFolder, fileExt, docSettings,
+                     fReorder, run):
+    # Runs on the worker thread, so nothing here may use the Fusion API.
+    # Put the posted parts of the tool groups together into the combined
+    # output file and finish it. If anything fails, the partial output
+    # is deleted.
+    fileBody = None
+    fileOp = None
+    tailFile = None
+    try:
         # Set up for file processing
-        fileBody = open(opFolder + "/" + constBodyTmpFile + fileExt, "w")
+        fileBody = OpenBodyFile(opFolder, fileExt)
         fFirst = True
         fBlankOk = False
         lineNum = 10
@@ -1329,92 +4071,73 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
         for code in endMcodes:
             endMcodeSet.add(int(code))
 
-        if fFastZenabled:
-            regParseLine = re.compile(r""
-                r"(G(?P<G>[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
-                r"(?P<XY>((X-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
-                r"((Y-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?)"
-                r"(Z(?P<Z>-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
-                r"(F(?P<F>-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?",
-                re.IGNORECASE)
-            regGcodes = re.compile(r"G([0-9]+(?:\.[0-9]*)?)")
-
-        tailGcode = ""
+        units = None    # G20 or G21, from the G-code
+        regUnits = re.compile(r"\bG\s*(20|21)\b", re.IGNORECASE)
+
         pendingStopCmds = []
-        totalOps = sum(len(group[1]) for group in opGroups)
-        processedOps = 0
+        restarts = [] if docSettings["restartIndex"] else None   # (offset in body, setup, operation)
+
+        fHsmOn = False
+        travelEnd = None        # (setup index, (x, y)) where the last operation ended
+        travel = [0, 0]         # rapid travel between operations, before and after reordering
 
         # Track current machine state to suppress redundant commands
         currentToolNum = None
-        currentSpindleSpeed = None
         currentSetup = None  # Track current setup to detect WCS changes
+        state = ModalState()
         
-        # Regex patterns for detecting commands to potentially suppress
-        regSpindleSpeed = re.compile(r'\bS(\d+)', re.IGNORECASE)
-        regSpindleStart = re.compile(r'\bM\s*3\b', re.IGNORECASE)
         regCoolantOff = re.compile(r'\bM\s*9\b', re.IGNORECASE)
-        regCoolantOn = re.compile(r'\bM\s*[78]\b', re.IGNORECASE)
-        regDwell = re.compile(r'\bG\s*4\b', re.IGNORECASE)
-        regReturnHome = re.compile(r'\bG\s*(28|53)\b', re.IGNORECASE)  # G28 or G53 (machine coords)
         # Fusion Personal Use warning message to suppress
         regPersonalUseWarning = re.compile(r'\(When using Fusion for Personal Use|\(moves is reduced to match|\(which can increase machining time|\(are available with a Fusion Subscription', re.IGNORECASE)
 
         # Process each tool group
-        for toolNum, opsInGroup in opGroups:
+        for iGroup, (toolNum, parts) in enumerate(toolGroups):
             # Determine if this is a real tool change (first op in group with different tool)
             fRealToolChange = (currentToolNum is None or currentToolNum != toolNum)
             # Update current tool at start of group so subsequent ops know they're same tool
             currentToolNum = toolNum
-            
-            # Process each operation in this tool group
-            for idx, (setup, op) in enumerate(opsInGroup):
+
+            if fReorder and toolNum != 0:
+                # See where each one starts and ends, then put them in
+                # the order with least travel
+                parts, travelEnd = OrderForTravel(parts, travelEnd, travel)
+
+            # Process each operation (or group of operations) in this tool group
+            for idx, part in enumerate(parts):
                 # Only the first operation in the group gets the actual tool change
                 fRealToolChangeThisOp = fRealToolChange and (idx == 0)
                 
                 # Detect if WCS is changing (different setup = different WCS)
-                fWcsChanging = (currentSetup is not None and currentSetup != setup)
-                
-                if progress and progress.wasCancelled:
-                    fileBody.close()
-                    fileHead.close()
-                    os.remove(fileBody.name)
-                    os.remove(path)
-                    return "Cancelled by user"
-
-                # Post process this operation
-                opList = [op]
+                fWcsChanging = (currentSetup is not None and currentSetup != part.iSetup)
                 
-                retries = docSettings["postRetries"]
-                delay = docSettings["initialDelay"]
-                while True:
-                    try:
-                        program.operations = opList
-                        if not program.postProcess(adsk.cam.NCProgramPostProcessOptions.create()):
-                            retVal = "Fusion reported an error processing operation: " + op.name
-                            return retVal
-                    except Exception as exc:
-                        retVal += " in operation " + op.name + ": " + str(exc)
-                        return retVal
-
-                    time.sleep(delay)
-                    try:
-                        fileOp = open(opPath, encoding="utf8", errors='replace')
-                        break
-                    except:
-                        delay *= 2
-                        retries -= 1
-                        if retries > 0:
-                            continue
-                        return "Unable to open " + opPath
+                fileOp = WatchedFile(part.fragment, run)
                 
                 # Parse and combine the gcode (similar to PostProcessSetup)
                 if not fFirst and fBlankOk:
                     fileBody.write("\n")
 
+                # High-speed machining mode is off for tool changes and
+                # operations that don't use it
+                fHsm = part.fHsm
+                if fHsmOn and (not fHsm or fRealToolChangeThisOp):
+                    lineNum = WriteBlocks(fileBody, docSettings["hsmOff"] + "\n", fNum, lineNum)
+                    state.Update(docSettings["hsmOff"], True)
+                    fHsmOn = False
+                fHsmStart = fHsm and not fHsmOn
+                if fHsmStart and not fRealToolChangeThisOp:
+                    lineNum = WriteBlocks(fileBody, docSettings["hsmOn"] + "\n", fNum, lineNum)
+                    state.Update(docSettings["hsmOn"], True)
+                    fHsmOn = True
+                    fHsmStart = False
+
                 for stopCmd in pendingStopCmds:
                     fileBody.write("M9 (Coolant off for program stop)\n")
                     fileBody.write(stopCmd)
+                    state.Update("M9", True)
+                    state.Update(stopCmd, True)
                 pendingStopCmds = []
+                if restarts != None:
+                    restarts.append((fileBody.tell(), part.setupName, part.opName))
 
                 # % at start only
                 line = fileOp.readline()
@@ -1436,6 +4159,8 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                         line = fileOp.readline()
                         break
                     if fFirst:
+                        if part.postedName != fname:
+                            line = ReplaceProgramName(line, part.postedName, fname)  # posted earlier for another file
                         pos = line.upper().find(opName.upper())
                         if pos != -1:
                             pos += len(opName)
@@ -1445,18 +4170,10 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
 
                 if len(line) == 0:
                     fileOp.close()
-                    os.remove(fileOp.name)
                     fileOp = None
-                    processedOps += 1
-                    if progress:
-                        progress.progressValue = int((processedOps / totalOps) * len(setups))
                     continue
 
                 # Find tool change line and process preamble
-                # Track whether this operation uses the same tool as previous
-                # Within a tool group, only the first operation needs full setup
-                fSuppressToolSetup = (idx > 0)  # Not the first operation in this tool group
-                
                 toolChangePattern = re.compile(r'(?=.*\bM\s*6\b)(?=.*\bT\s*\d{1,3}\b)', re.IGNORECASE)
                 
                 # For same-tool operations, we need to skip the preamble (coolant off, return home, 
@@ -1475,6 +4192,9 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                     match = match.groupdict()
                     lineContent = match["line"]
                     fNum = match["N"] != None
+                    matchUnits = regUnits.search(lineContent)
+                    if matchUnits:
+                        units = int(matchUnits.group(1))
 
                     # Check if this is the tool change line
                     if toolChangePattern.search(lineContent):
@@ -1489,6 +4209,8 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                                         lineNum += constLineNumInc
                                 else:
                                     fileBody.write(toolChange)
+                                for code in toolChange.splitlines() if isinstance(toolChange, str) else toolChange:
+                                    state.Update(code, True)
                             elif fFirst and not docSettings["skipFirstToolchange"] and len(toolChange) != 0:
                                 if fToolChangeNum:
                                     for code in toolChange:
@@ -1496,6 +4218,8 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                                         lineNum += constLineNumInc
                                 else:
                                     fileBody.write(toolChange)
+                                for code in toolChange.splitlines() if isinstance(toolChange, str) else toolChange:
+                                    state.Update(code, True)
                         elif fWcsChanging and len(toolChange) != 0:
                             # Same tool but WCS changing - output G28/G30 for safety, but NOT M9
                             # Parse toolChange and filter out coolant commands
@@ -1512,19 +4236,9 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                                         lineNum += constLineNumInc
                                     else:
                                         fileBody.write(codeStr + "\n")
+                                    state.Update(codeStr, True)
                         break
 
-                    # Suppress preamble lines when not changing tools
-                    if fSuppressToolSetup:
-                        # Skip coolant off (M9)
-                        if regCoolantOff.search(lineContent):
-                            line = fileOp.readline()
-                            continue
-                        # Skip return home (G28) UNLESS WCS is changing (safety measure)
-                        if regReturnHome.search(lineContent) and not fWcsChanging:
-                            line = fileOp.readline()
-                            continue
-                    
                     # Skip Fusion Personal Use warning comments
                     if regPersonalUseWarning.search(lineContent):
                         line = fileOp.readline()
@@ -1536,6 +4250,7 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                             fileBody.write("N" + str(lineNum) + " ")
                             lineNum += constLineNumInc
                         fileBody.write(lineContent)
+                        state.Update(lineContent, True)
                     line = fileOp.readline()
                     if len(line) == 0:
                         break
@@ -1543,21 +4258,19 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                         fBlankOk = True
 
                 # Process body - now we're past the tool change line
-                fFastZ = fFastZenabled
-                Gcode = None
-                Zcur = None
-                Zlast = None
-                Zfeed = None
-                fZfeedNotSet = True
-                feedCur = 0
-                fNeedFeed = False
-                fLockSpeed = False
-                
-                # Track if we're still in the post-tool-change setup phase
-                # (spindle start, dwell, coolant on, WCS selection)
-                fInToolSetup = True
-                linesSinceToolChange = 0
-
+                # Prestage line for the tool of the next group
+                prestage = None
+                if docSettings["prestageTool"]:
+                    nextTool = NextTool([group[0] or None for group in toolGroups], iGroup + 1, toolNum)
+                    if nextTool != None:
+                        prestage = docSettings["prestageFormat"].format(nextTool) + "\n"
+
+                rapids = None
+                if fFastZenabled:
+                    rapids = MakeRapidRestorer(part, docSettings, units)
+                paths = MakePathFilter(docSettings, units, run)
+
+                lineFull = line
                 while len(line) > 0:
                     match = regBody.match(line)
                     if match is None:
@@ -1570,12 +4283,6 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                     match = match.groupdict()
                     line = match["line"]
                     fNum = match["N"] != None
-                    
-                    linesSinceToolChange += 1
-                    
-                    # After ~15 lines from tool change, we're past the setup phase
-                    if linesSinceToolChange > 15:
-                        fInToolSetup = False
 
                     # Check for end markers
                     endMark = match["M"]
@@ -1583,10 +4290,8 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                         endMark = int(endMark)
                         if endMark in endMcodeSet:
                             break
-                        if endMark == 49:
-                            fLockSpeed = True
-                        elif endMark == 48:
-                            fLockSpeed = False
+                        if rapids != None and endMark in (48, 49):
+                            rapids.fLockSpeed = endMark == 49
                     endMark = match["G"]
                     if endMark != None:
                         endMark = int(endMark)
@@ -1595,146 +4300,43 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
 
                     # Determine if this line should be skipped
                     skipCurrentLine = False
+                    lineIn = line
+                    fToolChangeLine = toolChangePattern.search(line) != None
                     
-                    # Skip first tool change if option enabled
-                    if fFirst and docSettings["skipFirstToolchange"]:
-                        if toolChangePattern.search(line):
-                            skipCurrentLine = True
-                    
-                    # When tool isn't actually changing, suppress setup commands
-                    if fSuppressToolSetup and fInToolSetup:
-                        # Skip tool change line (T# M6)
-                        if toolChangePattern.search(line):
-                            skipCurrentLine = True
-                        # Skip spindle speed + start (S#### M3) if same speed
-                        elif regSpindleStart.search(line):
-                            speedMatch = regSpindleSpeed.search(line)
-                            if speedMatch:
-                                newSpeed = int(speedMatch.group(1))
-                                if newSpeed == currentSpindleSpeed:
-                                    skipCurrentLine = True
-                                else:
-                                    currentSpindleSpeed = newSpeed
-                            else:
-                                # M3 without S - skip if spindle already running
-                                if currentSpindleSpeed is not None:
-                                    skipCurrentLine = True
-                        # Skip dwell (G4) - only used for spindle spinup
-                        elif regDwell.search(line):
-                            skipCurrentLine = True
-                        # Skip coolant commands (M7, M8) - coolant still on from previous op
-                        elif regCoolantOn.search(line):
-                            skipCurrentLine = True
-                    else:
-                        # Track spindle speed for future comparisons
-                        if regSpindleStart.search(line):
-                            speedMatch = regSpindleSpeed.search(line)
-                            if speedMatch:
-                                currentSpindleSpeed = int(speedMatch.group(1))
-                    
-                    # Once we see actual motion (G0, G1) we're past setup
-                    if re.search(r'\bG\s*[01]\b', line, re.IGNORECASE) and re.search(r'[XYZ]', line, re.IGNORECASE):
-                        fInToolSetup = False
+                    if fFirst and docSettings["skipFirstToolchange"] and fToolChangeLine:
+                        # Skip first tool change if option enabled, tool is already loaded
+                        skipCurrentLine = True
+                        state.Update(line, True)
+                    elif not state.Update(line):
+                        # Block doesn't change the machine state (same tool,
+                        # spindle already running, coolant on, etc.)
+                        skipCurrentLine = True
+                        fToolChangeLine = False
+                        run.stats.Add("Redundant blocks dropped")
                     
                     # Analyze code for chances to make rapid moves (fastZ feature)
-                    if fFastZ and not skipCurrentLine:
-                        matchFast = regParseLine.match(line)
-                        if matchFast and matchFast.end() != 0:
-                            try:
-                                matchFast = matchFast.groupdict()
-                                Gcodes = regGcodes.findall(line)
-                                fNoMotionGcode = True
-                                fHomeGcode = False
-                                for GcodeTmp in Gcodes:
-                                    GcodeTmp = int(float(GcodeTmp))
-                                    if GcodeTmp in constHomeGcodeSet:
-                                        fHomeGcode = True
-                                        break
-
-                                    if GcodeTmp in constMotionGcodeSet:
-                                        fNoMotionGcode = False
-                                        Gcode = GcodeTmp
-                                        if Gcode == 0:
-                                            fNeedFeed = False
-                                        break
-
-                                if not fHomeGcode:
-                                    Ztmp = matchFast["Z"]
-                                    if Ztmp != None:
-                                        Zlast = Zcur
-                                        Zcur = float(Ztmp)
-
-                                    feedTmp = matchFast["F"]
-                                    if feedTmp != None:
-                                        feedCur = float(feedTmp)
-
-                                    XYcur = matchFast["XY"].rstrip("\n ")
-
-                                    if (Zfeed == None or fZfeedNotSet) and (Gcode == 0 or Gcode == 1) and Ztmp != None and len(XYcur) == 0:
-                                        # Figure out Z feed
-                                        if (Zfeed != None):
-                                            fZfeedNotSet = False
-                                        Zfeed = Zcur
-                                        if Gcode != 0:
-                                            # Replace line with rapid move
-                                            line = constRapidZgcode.format(Zcur, line[:-1])
-                                            fNeedFeed = True
-                                            Gcode = 0
-
-                                    if Gcode == 1 and not fLockSpeed:
-                                        if Ztmp != None:
-                                            if len(XYcur) == 0 and (Zcur >= Zlast or Zcur >= Zfeed or feedCur == 0):
-                                                # Upward move, above feed height, or anomalous feed rate.
-                                                # Replace with rapid move
-                                                line = constRapidZgcode.format(Zcur, line[:-1])
-                                                fNeedFeed = True
-                                                Gcode = 0
-
-                                        elif Zcur >= Zfeed:
-                                            # No Z move, at/above feed height
-                                            line = constRapidXYgcode.format(XYcur, line[:-1])
-                                            fNeedFeed = True
-                                            Gcode = 0
-
-                                    elif fNeedFeed and fNoMotionGcode:
-                                        # No G-code present, changing to G1
-                                        if Ztmp != None:
-                                            if len(XYcur) != 0:
-                                                # Not Z move only - back to G1
-                                                line = constFeedXYZgcode.format(XYcur, Zcur, feedCur, line[:-1])
-                                                fNeedFeed = False
-                                                Gcode = 1
-                                            elif Zcur < Zfeed and Zcur <= Zlast:
-                                                # Not up nor above feed height - back to G1
-                                                line = constFeedZgcode.format(Zcur, feedCur, line[:-1])
-                                                fNeedFeed = False
-                                                Gcode = 1
-                                                
-                                        elif len(XYcur) != 0 and Zcur < Zfeed:
-                                            # No Z move, below feed height - back to G1
-                                            line = constFeedXYgcode.format(XYcur, feedCur, line[:-1])
-                                            fNeedFeed = False
-                                            Gcode = 1
-
-                                    if (Gcode != 0 and fNeedFeed):
-                                        if (feedTmp == None):
-                                            # Feed rate not present, add it
-                                            line = line[:-1] + constAddFeedGcode.format(feedCur)
-                                        fNeedFeed = False
-
-                                    if Zcur != None and Zfeed != None and Zcur >= Zfeed and Gcode != None and \
-                                        Gcode != 0 and len(XYcur) != 0 and (Ztmp != None or Gcode != 1):
-                                        # We're at or above the feed height, but made a cutting move.
-                                        # Feed height is wrong, bring it up
-                                        Zfeed = Zcur + 0.001
-                            except:
-                                fFastZ = False # Just skip changes
+                    if rapids != None and not skipCurrentLine:
+                        line = rapids.Line(line)
+                    if paths != None and not skipCurrentLine:
+                        line = paths.Line(line)
+                    if line is not lineIn:
+                        for block in line.splitlines(True):
+                            state.Update(block, True)
                     
                     if not skipCurrentLine:
+                        lineNum = WriteBlocks(fileBody, line, fNum, lineNum)
+                    if fToolChangeLine and prestage != None:
                         if fNum:
                             fileBody.write("N" + str(lineNum) + " ")
                             lineNum += constLineNumInc
-                        fileBody.write(line)
+                        fileBody.write(prestage)
+                        state.Update(prestage, True)
+                        prestage = None
+                    if fToolChangeLine and fHsmStart:
+                        lineNum = WriteBlocks(fileBody, docSettings["hsmOn"] + "\n", fNum, lineNum)
+                        state.Update(docSettings["hsmOn"], True)
+                        fHsmOn = True
+                        fHsmStart = False
                     
                     lineFull = fileOp.readline()
                     if len(lineFull) == 0:
@@ -1747,101 +4349,69 @@ def PostProcessCombinedSetups(setups, outputFolder, docSettings, program, progre
                     line = match["line"]
                     fNum = match["N"] != None
 
-                # Save tail from first operation
-                tailContent = fileOp.read()
-                tailLines = tailContent.splitlines(True)
-                remainingTail = []
-                for tailLine in tailLines:
-                    if re.search(r'\bM\s*[01]\b', tailLine, re.IGNORECASE):
-                        match = regBody.match(tailLine)
-                        if match:
-                            match = match.groupdict()
-                            if match["N"] != None:
-                                stopCmd = "N" + str(lineNum) + " " + match["line"]
-                                lineNum += constLineNumInc
-                            else:
-                                stopCmd = tailLine
-                            pendingStopCmds.append(stopCmd)
-                    else:
-                        remainingTail.append(tailLine)
-                
-                if fFirst:
-                    tailGcode = "".join(remainingTail)
+                if paths != None:
+                    line = paths.Flush()
+                    for block in line.splitlines(True):
+                        state.Update(block, True)
+                    lineNum = WriteBlocks(fileBody, line, fNum, lineNum)
+                if rapids != None:
+                    AddTimeSaved(run, part, rapids)
+
+                # Scan tail for M0/M1 commands, saving the tail from the first
+                # operation that has one (a Manual NC operation may not)
+                if tailFile is None or tailFile.tell() == 0:
+                    if tailFile is None:
+                        tailFile = tempfile.SpooledTemporaryFile(constTailSpoolSize, "w+", newline="")
+                    lineNum = ScanTail(fileOp, lineFull, regBody, tailFile, pendingStopCmds, lineNum)
+                else:
+                    lineNum = ScanTail(fileOp, lineFull, regBody, None, pendingStopCmds, lineNum)
                 fFirst = False
-                currentSetup = setup  # Update current setup for WCS change detection
+                currentSetup = part.iSetup  # Update current setup for WCS change detection
                 fileOp.close()
-                os.remove(fileOp.name)
                 fileOp = None
-                
-                processedOps += 1
-                if progress:
-                    progress.progressValue = int((processedOps / totalOps) * len(setups))
+
+        if fHsmOn:
+            lineNum = WriteBlocks(fileBody, docSettings["hsmOff"] + "\n", fNum, lineNum)
+            state.Update(docSettings["hsmOff"], True)
 
         # Write remaining pending commands
         for stopCmd in pendingStopCmds:
             fileBody.write("M9 (Coolant off for program stop)\n")
             fileBody.write(stopCmd)
+            state.Update("M9", True)
+            state.Update(stopCmd, True)
 
         # Add tail
-        if len(tailGcode) != 0:
-            tailGcode = tailGcode.splitlines(True)
-            for code in tailGcode:
-                match = regBody.match(code)
-                if match:
-                    match = match.groupdict()
-                    if match["N"] != None:
-                        fileBody.write("N" + str(lineNum) + " " + match["line"])
-                        lineNum += constLineNumInc
-                    else:
-                        fileBody.write(code)
-                else:
-                    fileBody.write(code)
+        if not fFirst and (tailFile is None or tailFile.tell() == 0):
+            run.stats.Note("{}: no end of program found to finish the file".format(fname))
+        lineNum = WriteTail(fileBody, tailFile, regBody, lineNum)
+        tailFile = None
 
-        # Copy body to head
-        fileBody.close()
-        fileBody = open(fileBody.name)
-        while True:
-            block = fileBody.read(10240)
-            if len(block) == 0:
-                break
-            fileHead.write(block)
+        for name in failedNames:
+            fileHead.write(constFailedComment.format(name))
         fileBody.close()
-        os.remove(fileBody.name)
-        fileBody = None
-        fileHead.close()
-        fileHead = None
-
-        return None
 
     except:
-        if fileHead:
-            try:
-                fileHead.close()
-                os.remove(fileHead.name)
-            except:
-                pass
-        if fileBody:
-            try:
-                fileBody.close()
-                os.remove(fileBody.name)
-            except:
-                pass
         if fileOp:
-            try:
-                fileOp.close()
-                os.remove(fileOp.name)
-            except:
-                pass
-        if ui:
-            retVal += " " + traceback.format_exc()
-        return retVal
-
-
-def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComments=None):
+            fileOp.close()
+        if tailFile:
+            tailFile.close()
+        if fileBody:
+            fileBody.close()
+        RemoveOutput(fileHead, fileBody.name if fileBody else None, path)
+        raise
+    FinishOutput(fileHead, fileBody.name, path, restarts, docSettings["subprograms"], docSettings["linkIdentical"], run)
+    if travel[1] < travel[0]:
+        run.stats.Note("{}: rapid travel between operations reduced from {:,.1f} to {:,.1f}".format(
+            fname, travel[0], travel[1]))
+
+
+def PostProcessSetup(fname, setup, setupFolder, docSettings, program, run, debugComments=None):
+    # A generator, yielding after each post so Fusion stays responsive.
+    # The posted G-code is put together into the output file on the
+    # worker thread. Returns None on success, or an error message.
     ui = None
     fileHead = None
-    fileBody = None
-    fileOp = None
     retVal = "Fusion reported an exception"
 
     try:
@@ -1851,6 +4421,11 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
         cam = adsk.cam.CAM.cast(doc.products.itemByProductType(constCAMProductId))
         parameters = program.parameters
 
+        # High-speed machining mode, checked before any files are made
+        regHsm, status = MakeHsmRegex(docSettings)
+        if status != None:
+            return status
+
         # Verify file name is valid by creating it now
         fileExt = parameters.itemByName("nc_program_nc_extension").value.value
         path = setupFolder + "/" + fname + fileExt
@@ -1883,15 +4458,17 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
             opFolder = tempfile.gettempdir()    # e.g., C:\Users\Tim\AppData\Local\Temp
             opFolder = opFolder.replace("\\", "/")
 
-        parameters.itemByName("nc_program_openInEditor").value.value = False
-        AssignOutputFolder(parameters, opFolder)
-        parameters.itemByName("nc_program_filename").value.value = opName
-        parameters.itemByName("nc_program_name").value.value = fname
+        params = run.Parameters(program)
+        params.Set("nc_program_openInEditor", False)
+        params.Set("nc_program_output_folder", opFolder)
+        params.Set("nc_program_filename", opName)
+        params.Set("nc_program_name", fname)
 
         # Do it all at once?
         if not docSettings["splitSetup"]:
             fileHead.close()
             try:
+                params.Apply()
                 program.operations = [setup]
                 if not program.postProcess(adsk.cam.NCProgramPostProcessOptions.create()):
                     return "Fusion reported an error."
@@ -1901,9 +4478,86 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
                 retVal += ": " + str(exc)
                 return retVal
 
-        # Split setup into individual operations
-        opPath = opFolder + "/" + opName + fileExt
-        fileBody = open(opFolder + "/" + constBodyTmpFile + fileExt, "w")
+        # Split setup into individual operations, posting each group and
+        # reading what putting it in the file needs from Fusion
+        parts = []
+        failedOps = []
+        ops = setup.allOperations
+
+        # Tool of each operation, to find the next tool for prestaging
+        if docSettings["prestageTool"]:
+            tools = []
+            for op in ops:
+                if not op.isSuppressed and op.hasToolpath:
+                    tools.append(op.tool.parameters.itemByName("tool_number").value.value)
+                else:
+                    tools.append(None)
+        for opList, opHasTool, curTool, iFirst, i in OperationGroups(ops, docSettings):
+            run.CheckCancel()
+            fragment, postedName, postedOps, status = PostGroup(program, opList, opFolder, opName, fileExt,
+                                                                docSettings, run, fname,
+                                                                opHasTool.name if opHasTool != None else None)
+            if status != None:
+                RemoveOutput(fileHead, None, path)
+                return status
+            if opHasTool != None and not opHasTool in postedOps:
+                postedOps = []  # manual operations aren't posted without the operation after them
+            failedOps += [op for op in opList if not op in postedOps]
+            if len(postedOps) == 0:
+                continue
+            opList = postedOps
+            if len(parts) == 0 and postedName == constSpeculateName:
+                fragment, postedName, status = PostFirstAgain(program, opList, opFolder, opName, fileExt,
+                                                              docSettings, run, fname)
+                if status != None:
+                    RemoveOutput(fileHead, None, path)
+                    return status
+            part = PostedPart(fragment, postedName, 0, setup, opList, docSettings, regHsm)
+            if docSettings["prestageTool"]:
+                part.nextTool = NextTool(tools, i, curTool)
+            parts.append(part)
+            if run.progress:
+                run.progress.progressValue = run.progressBase + constProgressSteps * i // ops.count
+            yield True
+
+        if len(parts) == 0:
+            # don't leave a file with only the header
+            RemoveOutput(fileHead, None, path)
+            return "No operations could be posted" if len(failedOps) != 0 else "No operations to post"
+
+        # Put the file together on the worker thread
+        run.Finish(path, AssembleSetup, parts, [op.name for op in failedOps], fname, opName, path, fileHead,
+                   opFolder, fileExt, dict(docSettings), run)
+        fileHead = None
+
+        return None
+
+    except:
+        if fileHead:
+            try:
+                fileHead.close()
+                os.remove(fileHead.name)
+            except:
+                pass
+
+        if run.fCancelled:
+            return "Cancelled by user"
+
+        if ui:
+            retVal += " " + traceback.format_exc()
+
+        return retVal
+
+
+def AssembleSetup(parts, failedNames, fname, opName, path, fileHead, opFolder, fileExt, docSettings, run):
+    # Runs on the worker thread, so nothing here may use the Fusion API.
+    # Put the posted parts of a setup together into its output file and
+    # finish it. If anything fails, the partial output is deleted.
+    fileBody = None
+    fileOp = None
+    tailFile = None
+    try:
+        fileBody = OpenBodyFile(opFolder, fileExt)
         fFirst = True
         fBlankOk = False
         lineNum = 10
@@ -1938,103 +4592,28 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
         endMcodeSet = set()
         for code in endMcodes:
             endMcodeSet.add(int(code))
+        regEnd = MakeEndRegex(endMcodeSet, endGcodeSet)
 
-        if fFastZenabled:
-            regParseLine = re.compile(r""
-                r"(G(?P<G>[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
-                r"(?P<XY>((X-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
-                r"((Y-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?)"
-                r"(Z(?P<Z>-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?"
-                r"(F(?P<F>-?[0-9]+(\.[0-9]*)?)[^XYZF]*)?",
-                re.IGNORECASE)
-            regGcodes = re.compile(r"G([0-9]+(?:\.[0-9]*)?)")
+        units = None    # G20 or G21, from the G-code
+        regUnits = re.compile(r"\bG\s*(20|21)\b", re.IGNORECASE)
 
         # Pending M0/M1 commands to write at start of next operation
         pendingStopCmds = []
 
-        i = 0
-        ops = setup.allOperations
-        while i < ops.count:
-            op = ops[i]
-            i += 1
-            if op.isSuppressed:
-                continue
+        # Where each operation starts in the body: (offset, setup, operation)
+        restarts = [] if docSettings["restartIndex"] else None
 
-            # Look ahead for operations without a toolpath. This can happen
-            # with a manual operation. Group it with current operation.
-            # Or if first, group it with subsequent ones.
-            # Also optionally group together operations with the same tool number
-            # BUT: Don't group Manual NC (no toolpath) - process them separately
-            opHasTool = None
-            curTool = -1
-            hasTool = op.hasToolpath
-            
-            # If this is a Manual NC operation (no toolpath), process it alone
-            if not hasTool:
-                opList = [op]
-                # Find the next operation with a toolpath to get tool info for grouping
-                while i < ops.count:
-                    nextOp = ops[i]
-                    if not nextOp.isSuppressed and nextOp.hasToolpath:
-                        opHasTool = nextOp
-                        opList.append(nextOp)
-                        curTool = nextOp.tool.parameters.itemByName("tool_number").value.value
-                        i += 1
-                        break
-                    i += 1
-            else:
-                opHasTool = op
-                curTool = op.tool.parameters.itemByName("tool_number").value.value
-                opList = [op]
-                while i < ops.count:
-                    op = ops[i]
-                    if not op.isSuppressed:
-                        # Stop grouping if we hit a Manual NC (no toolpath) or different tool
-                        if not op.hasToolpath:
-                            break  # Don't include Manual NC in this group
-                        if not docSettings.get("combineTool", False) or op.tool.parameters.itemByName("tool_number").value.value != curTool:
-                            break
-                        opList.append(op)
-                    i += 1
+        # High-speed machining mode is on
+        fHsmOn = False
+
+        # Work offsets of fixtures to repeat each operation on
+        fixtures = [re.sub(r"\s+", " ", code) for code in regWcs.findall(docSettings["fixtureWcs"].upper())]
+        if len(fixtures) == 0:
+            fixtures = None
+
+        for part in parts:
+            fileOp = WatchedFile(part.fragment, run)
 
-            retries = docSettings["postRetries"]
-            delay = docSettings["initialDelay"]
-            while True:
-                try:
-                    program.operations = opList
-                    if not program.postProcess(adsk.cam.NCProgramPostProcessOptions.create()):
-                        retVal = "Fusion reported an error processing operation"
-                        if (opHasTool != None):
-                            retVal += ": " +  opHasTool.name
-                        return retVal
-                except Exception as exc:
-                    if (opHasTool != None):
-                        retVal += " in operation " +  opHasTool.name
-                    retVal += ": " + str(exc)
-                    return retVal
-
-                time.sleep(delay) # wait for it to finish (??)
-                try:
-                    fileOp = open(opPath, encoding="utf8", errors='replace')
-                    break
-                except:
-                    delay *= 2
-                    retries -= 1
-                    if retries > 0:
-                        continue
-                    # Maybe the file name extension is wrong
-                    for file in os.listdir(opFolder):
-                        if file.startswith(opName):
-                            ext = file[len(opName):]
-                            if ext != fileExt:
-                                return ("Unable to open output file. "
-                                    "Found the file with extension '{}' instead "
-                                    "of '{}'. Make sure you have the correct file "
-                                    "extension set in the Post Process All "
-                                    "dialog.".format(ext, fileExt))
-                            break
-                    return "Unable to open " + opPath
-            
             # Parse the gcode. We expect a header like this:
             #
             # % <optional>
@@ -2060,12 +4639,22 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
             if not fFirst and fBlankOk:
                 fileBody.write("\n")
 
+            # High-speed machining mode is off for tool changes, and every
+            # operation here starts with one. It is turned on again after
+            # the tool change for operations that use it.
+            if fHsmOn:
+                lineNum = WriteBlocks(fileBody, docSettings["hsmOff"] + "\n", fNum, lineNum)
+                fHsmOn = False
+            fHsmStart = part.fHsm
+
             # Write any pending M0/M1 commands from previous operation's Manual NC
             # Add M9 (coolant off) before each stop command for safety
             for stopCmd in pendingStopCmds:
                 fileBody.write("M9 (Coolant off for program stop)\n")
                 fileBody.write(stopCmd)
             pendingStopCmds = []
+            if restarts != None:
+                restarts.append((fileBody.tell(), part.setupName, part.opName))
 
             # % at start only
             line = fileOp.readline()
@@ -2085,6 +4674,8 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
                     break
 
                 if fFirst:
+                    if part.postedName != fname:
+                        line = ReplaceProgramName(line, part.postedName, fname)  # posted earlier for another file
                     pos = line.upper().find(opName.upper())
                     if pos != -1:
                         pos += len(opName)
@@ -2102,6 +4693,9 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
                 match = regBody.match(line).groupdict()
                 line = match["line"]        # filter off line number if present
                 fNum = match["N"] != None
+                matchUnits = regUnits.search(line)
+                if matchUnits:
+                    units = int(matchUnits.group(1))
 
                 # Check for tool change line using more specific pattern
                 if toolChangePattern.search(line):
@@ -2134,20 +4728,28 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
                     fileBody.write(line)
                 line = fileOp.readline()
                 if len(line) == 0:
-                    return "Tool change G-code (Txx) not found; this post processor is not compatible with Post Process All."
+                    raise OutputError("Tool change G-code (Txx) not found; this post processor is not compatible with Post Process All.")
                 if line[0] == "\n":
                     fBlankOk = True
 
             # We're done with the head, move on to the body
             # Initialize rapid move optimizations
-            fFastZ = fFastZenabled
-            Gcode = None
-            Zcur = None
-            Zfeed = None
-            fZfeedNotSet = True
-            feedCur = 0
-            fNeedFeed = False
-            fLockSpeed = False
+            rapids = None
+            if fFastZenabled:
+                rapids = MakeRapidRestorer(part, docSettings, units)
+            paths = MakePathFilter(docSettings, units, run)
+            fNumbered = False
+
+            # Without line numbers or rapid move changes, the body after the
+            # tool change line is copied unchanged
+            fPassthrough = not fFastZenabled and not fNum and paths == None and fixtures == None and \
+                not (fFirst and docSettings["skipFirstToolchange"])
+            copyStart = None
+
+            # Prestage the next tool after the tool change
+            prestage = None
+            if part.nextTool != None:
+                prestage = docSettings["prestageFormat"].format(part.nextTool) + "\n"
 
             # Note that match, line, and fNum are already set
             while True:
@@ -2158,123 +4760,59 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
                     if endMark in endMcodeSet:
                         break
                     # When M49/M48 is used to turn off speed changes, disable fast moves as well
-                    if endMark == 49:
-                        fLockSpeed = True
-                    elif endMark == 48:
-                        fLockSpeed = False
+                    if rapids != None and endMark in (48, 49):
+                        rapids.fLockSpeed = endMark == 49
                 endMark = match["G"]
                 if endMark != None:
                     endMark = int(endMark)
                     if endMark in endGcodeSet:
                         break
 
-                if fFastZ:
+                fToolChangeLine = toolChangePattern.search(line) != None
+                if fixtures != None:
+                    line = regWcs.sub(fixtures[0], line)
+
+                if rapids != None:
                     # Analyze code for chances to make rapid moves
-                    match = regParseLine.match(line)
-                    if match.end() != 0:
-                        try:
-                            match = match.groupdict()
-                            Gcodes = regGcodes.findall(line)
-                            fNoMotionGcode = True
-                            fHomeGcode = False
-                            for GcodeTmp in Gcodes:
-                                GcodeTmp = int(float(GcodeTmp))
-                                if GcodeTmp in constHomeGcodeSet:
-                                    fHomeGcode = True
-                                    break
-
-                                if GcodeTmp in constMotionGcodeSet:
-                                    fNoMotionGcode = False
-                                    Gcode = GcodeTmp
-                                    if Gcode == 0:
-                                        fNeedFeed = False
-                                    break
-
-                            if not fHomeGcode:
-                                Ztmp = match["Z"]
-                                if Ztmp != None:
-                                    Zlast = Zcur
-                                    Zcur = float(Ztmp)
-
-                                feedTmp = match["F"]
-                                if feedTmp != None:
-                                    feedCur = float(feedTmp)
-
-                                XYcur = match["XY"].rstrip("\n ")
-
-                                if (Zfeed == None or fZfeedNotSet) and (Gcode == 0 or Gcode == 1) and Ztmp != None and len(XYcur) == 0:
-                                    # Figure out Z feed
-                                    if (Zfeed != None):
-                                        fZfeedNotSet = False
-                                    Zfeed = Zcur
-                                    if Gcode != 0:
-                                        # Replace line with rapid move
-                                        line = constRapidZgcode.format(Zcur, line[:-1])
-                                        fNeedFeed = True
-                                        Gcode = 0
-
-                                if Gcode == 1 and not fLockSpeed:
-                                    if Ztmp != None:
-                                        if len(XYcur) == 0 and (Zcur >= Zlast or Zcur >= Zfeed or feedCur == 0):
-                                            # Upward move, above feed height, or anomalous feed rate.
-                                            # Replace with rapid move
-                                            line = constRapidZgcode.format(Zcur, line[:-1])
-                                            fNeedFeed = True
-                                            Gcode = 0
-
-                                    elif Zcur >= Zfeed:
-                                        # No Z move, at/above feed height
-                                        line = constRapidXYgcode.format(XYcur, line[:-1])
-                                        fNeedFeed = True
-                                        Gcode = 0
-
-                                elif fNeedFeed and fNoMotionGcode:
-                                    # No G-code present, changing to G1
-                                    if Ztmp != None:
-                                        if len(XYcur) != 0:
-                                            # Not Z move only - back to G1
-                                            line = constFeedXYZgcode.format(XYcur, Zcur, feedCur, line[:-1])
-                                            fNeedFeed = False
-                                            Gcode = 1
-                                        elif Zcur < Zfeed and Zcur <= Zlast:
-                                            # Not up nor above feed height - back to G1
-                                            line = constFeedZgcode.format(Zcur, feedCur, line[:-1])
-                                            fNeedFeed = False
-                                            Gcode = 1
-                                            
-                                    elif len(XYcur) != 0 and Zcur < Zfeed:
-                                        # No Z move, below feed height - back to G1
-                                        line = constFeedXYgcode.format(XYcur, feedCur, line[:-1])
-                                        fNeedFeed = False
-                                        Gcode = 1
-
-                                if (Gcode != 0 and fNeedFeed):
-                                    if (feedTmp == None):
-                                        # Feed rate not present, add it
-                                        line = line[:-1] + constAddFeedGcode.format(feedCur)
-                                    fNeedFeed = False
-
-                                if Zcur != None and Zfeed != None and Zcur >= Zfeed and Gcode != None and \
-                                    Gcode != 0 and len(XYcur) != 0 and (Ztmp != None or Gcode != 1):
-                                    # We're at or above the feed height, but made a cutting move.
-                                    # Feed height is wrong, bring it up
-                                    Zfeed = Zcur + 0.001
-                        except:
-                            fFastZ = False # Just skip changes
+                    line = rapids.Line(line)
 
                 # copy line to output
                 # Skip T code line if this is first operation and skipFirstToolchange is enabled
                 skipCurrentLine = False
                 if fFirst and docSettings["skipFirstToolchange"]:
                     # Check for tool change line: must contain both M6 and T### (1-3 digits)
-                    if toolChangePattern.search(line):
+                    if fToolChangeLine:
                         skipCurrentLine = True
                 
                 if not skipCurrentLine:
+                    if paths != None:
+                        # held lines come out later, numbered like the rest
+                        fNumbered = fNum = fNumbered or fNum
+                        line = paths.Line(line)
+                    lineNum = WriteBlocks(fileBody, line, fNum, lineNum)
+                if fToolChangeLine and prestage != None:
                     if (fNum):
                         fileBody.write("N" + str(lineNum) + " ")
                         lineNum += constLineNumInc
-                    fileBody.write(line)
+                    fileBody.write(prestage)
+                    prestage = None
+                if fToolChangeLine and fHsmStart:
+                    lineNum = WriteBlocks(fileBody, docSettings["hsmOn"] + "\n", fNum, lineNum)
+                    fHsmOn = True
+                    fHsmStart = False
+                if fixtures != None and copyStart == None:
+                    # The rest of the body is repeated for each fixture
+                    fNumFixture = fNum
+                    lineNum = WriteBlocks(fileBody, fixtures[0] + "\n", fNum, lineNum)
+                    fileBody.flush()
+                    copyStart = fileBody.tell()
+                if fPassthrough and prestage == None and not fHsmStart:
+                    # Nothing in the rest of the body needs rewriting, so copy it
+                    # straight through. We resume at the tail, or where it gave up.
+                    fPassthrough = False
+                    copied = CopyBodyUnchanged(fileOp, fileBody, regEnd)
+                    if copied != None:
+                        run.stats.Add("Bytes copied without rewriting", copied)
                 lineFull = fileOp.readline()
                 if len(lineFull) == 0:
                     break
@@ -2282,32 +4820,28 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
                 line = match["line"]        # filter off line number if present
                 fNum = match["N"] != None
 
+            if paths != None:
+                lineNum = WriteBlocks(fileBody, paths.Flush(), fNumbered, lineNum)
+            if rapids != None:
+                AddTimeSaved(run, part, rapids)
+            if copyStart != None:
+                lineNum = CopyForFixtures(fileBody, copyStart, fixtures, fNumFixture, regBody, lineNum)
+                run.stats.Add("Operations repeated for fixtures", len(fixtures) - 1)
+
             # Found tail of program - scan for M0/M1 commands to preserve in sequence
-            tailContent = lineFull + fileOp.read()
-            tailLines = tailContent.splitlines(True)
-            remainingTail = []
-            for tailLine in tailLines:
-                if re.search(r'\bM\s*[01]\b', tailLine, re.IGNORECASE):
-                    # Preserve M0/M1 (program stop) commands from Manual NC operations
-                    # Save them to be written at the START of next operation
-                    match = regBody.match(tailLine).groupdict()
-                    if match["N"] != None:
-                        stopCmd = "N" + str(lineNum) + " " + match["line"]
-                        lineNum += constLineNumInc
-                    else:
-                        stopCmd = tailLine
-                    pendingStopCmds.append(stopCmd)
-                else:
-                    remainingTail.append(tailLine)
-            
             if fFirst:
                 # Save remaining tail (without M0/M1) for the very end
-                tailGcode = "".join(remainingTail)
+                tailFile = tempfile.SpooledTemporaryFile(constTailSpoolSize, "w+", newline="")
+                lineNum = ScanTail(fileOp, lineFull, regBody, tailFile, pendingStopCmds, lineNum)
+            else:
+                lineNum = ScanTail(fileOp, lineFull, regBody, None, pendingStopCmds, lineNum)
             fFirst = False
             fileOp.close()
-            os.remove(fileOp.name)
             fileOp = None
 
+        if fHsmOn:
+            lineNum = WriteBlocks(fileBody, docSettings["hsmOff"] + "\n", fNum, lineNum)
+
         # Write any remaining pending M0/M1 commands before final tail
         for stopCmd in pendingStopCmds:
             fileBody.write("M9 (Coolant off for program stop)\n")
@@ -2315,57 +4849,705 @@ def PostProcessSetup(fname, setup, setupFolder, docSettings, program, debugComme
 
         # Completed all operations, add tail
         # Update line numbers if present
-        if len(tailGcode) != 0:
-            tailGcode = tailGcode.splitlines(True)
-            for code in tailGcode:
-                match = regBody.match(code).groupdict()
-                if match["N"] != None:
-                    fileBody.write("N" + str(lineNum) + " " + match["line"])
-                    lineNum += constLineNumInc
-                else:
-                    fileBody.write(code)
+        lineNum = WriteTail(fileBody, tailFile, regBody, lineNum)
+        tailFile = None
 
-        # Copy body to head
-        fileBody.close()
-        fileBody = open(fileBody.name)  # open for reading
-        # copy in chunks
-        while True:
-            block = fileBody.read(10240)
-            if len(block) == 0:
-                break
-            fileHead.write(block)
-            block = None    # free memory
+        for name in failedNames:
+            fileHead.write(constFailedComment.format(name))
         fileBody.close()
-        os.remove(fileBody.name)
-        fileBody = None
+
+    except:
+        if fileOp:
+            fileOp.close()
+        if tailFile:
+            tailFile.close()
+        if fileBody:
+            fileBody.close()
+        RemoveOutput(fileHead, fileBody.name if fileBody else None, path)
+        raise
+    FinishOutput(fileHead, fileBody.name, path, restarts, docSettings["subprograms"], docSettings["linkIdentical"], run)
+
+
+def OperationGroups(ops, docSettings):
+    # The operations of a setup that are posted together, in order.
+    # Yields (operations, operation with the tool or None, tool number
+    # or -1, index of first operation, index after the last).
+    i = 0
+    while i < ops.count:
+        op = ops[i]
+        i += 1
+        if op.isSuppressed:
+            continue
+        iFirst = i - 1
+
+        # Look ahead for operations without a toolpath. This can happen
+        # with a manual operation. Group it with current operation.
+        # Or if first, group it with subsequent ones.
+        # Also optionally group together operations with the same tool number
+        # BUT: Don't group Manual NC (no toolpath) - process them separately
+        opHasTool = None
+        curTool = -1
+        hasTool = op.hasToolpath
+        
+        # If this is a Manual NC operation (no toolpath), process it alone
+        if not hasTool:
+            opList = [op]
+            # Find the next operation with a toolpath to get tool info for grouping
+            while i < ops.count:
+                nextOp = ops[i]
+                if not nextOp.isSuppressed and nextOp.hasToolpath:
+                    opHasTool = nextOp
+                    opList.append(nextOp)
+                    curTool = nextOp.tool.parameters.itemByName("tool_number").value.value
+                    i += 1
+                    break
+                i += 1
+        else:
+            opHasTool = op
+            curTool = op.tool.parameters.itemByName("tool_number").value.value
+            opList = [op]
+            while i < ops.count:
+                op = ops[i]
+                if not op.isSuppressed:
+                    # Stop grouping if we hit a Manual NC (no toolpath) or different tool
+                    if not op.hasToolpath:
+                        break  # Don't include Manual NC in this group
+                    if not docSettings.get("combineTool", False) or op.tool.parameters.itemByName("tool_number").value.value != curTool:
+                        break
+                    opList.append(op)
+                i += 1
+        yield opList, opHasTool, curTool, iFirst, i
+
+
+def ReplaceProgramName(line, postedName, fname):
+    # Put fname in place of the program name a fragment was posted with.
+    # Only the O-word and a comment starting with the name are changed,
+    # so the same digits elsewhere in the header are left alone.
+    regName = re.compile(r"(^\s*O\s*0*|\(\s*)" + re.escape(postedName) + r"(?![\w.-])", re.IGNORECASE)
+    return regName.sub(lambda match: match.group(1) + fname, line)
+
+
+def OpenBodyFile(folder, fileExt):
+    # Temporary file for the body of an output file, named so it can't
+    # clash with one still being finished by the worker thread
+    handle, path = tempfile.mkstemp(fileExt, constBodyTmpFile, folder)
+    os.close(handle)
+    return open(path.replace("\\", "/"), "w")
+
+
+def FinishOutput(fileHead, bodyPath, path, restarts, subprograms, fLink, run):
+    # Runs on the worker thread, so nothing here may use the Fusion API.
+    # Copy the body to the head, then write the restart index or extract
+    # subprograms, and optionally hard link the file if identical to
+    # another. If anything fails, the partial output is deleted.
+    try:
+        headSize = fileHead.tell()
+        with open(bodyPath) as fileBody:
+            # copy in chunks
+            while True:
+                block = fileBody.read(10240)
+                if len(block) == 0:
+                    break
+                fileHead.write(block)
+                block = None    # free memory
+        os.remove(bodyPath)
         fileHead.close()
-        fileHead = None
+        if restarts != None:
+            WriteRestartIndex(path, headSize, restarts)
+        elif subprograms != constSubNone:
+            ExtractSubprograms(path, subprograms, run)
+        if fLink and run.store.LinkIdentical(path):
+            run.stats.Add("Identical files hard linked")
+    except:
+        RemoveOutput(fileHead, bodyPath, path)
+        raise
 
+
+def RemoveOutput(fileHead, bodyPath, path):
+    # Close and delete a partial output file, with its body if it has
+    # one and any restart index
+    fileHead.close()
+    for name in (bodyPath, path, os.path.splitext(path)[0] + constRestartExt):
+        if name == None:
+            continue
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def MakeHsmRegex(docSettings):
+    # Returns (expression matching strategies using high-speed machining
+    # mode or None if not enabled, error message or None)
+    if not docSettings["hsmMode"]:
+        return None, None
+    try:
+        return re.compile(docSettings["hsmStrategies"], re.IGNORECASE), None
+    except re.error as exc:
+        return None, "Invalid expression for high-speed machining strategies: " + str(exc)
+
+
+def CheckPrestageFormat(docSettings):
+    # Returns an error message if the prestage format can't make a block
+    # from a tool number, or None
+    if not docSettings["splitSetup"] or not docSettings["prestageTool"]:
         return None
+    try:
+        docSettings["prestageFormat"].format(1)
+    except Exception as exc:
+        return "Invalid format for prestaging the next tool: \"{}\" ({})".format(docSettings["prestageFormat"], exc)
+    return None
 
+
+def IsHsmOperation(opList, regHsm):
+    # High-speed machining mode is used only if every operation with a
+    # toolpath has a strategy that uses it
+    ops = [op for op in opList if op.hasToolpath]
+    return len(ops) != 0 and all(regHsm.search(op.strategy) != None for op in ops)
+
+
+def MakeRapidRestorer(part, docSettings, units):
+    # RapidRestorer for a posted part, with settings in the program's
+    # units (G20 or G21)
+    scale = 1 / 25.4 if units == 20 else 1     # settings are in mm
+    return RapidRestorer(GetStockSafeZ(part.stockTop, docSettings, units),
+                         round(docSettings["linkFeed"] * scale, 1) or None,
+                         docSettings["rapidRate"] * scale or None)
+
+
+def MakePathFilter(docSettings, units, run):
+    # Filters rewriting the moves of an operation, with tolerances in the
+    # program's units, or None if no path rewriting is enabled
+    filters = []
+    if docSettings["cannedCycles"]:
+        filters.append(CycleFilter(run.stats))
+    if docSettings["arcFit"] or docSettings["decimate"]:
+        scale = 1 / 25.4 if units == 20 else 1     # settings are in mm
+        filters.append(PathFilter(docSettings["arcTolerance"] * scale if docSettings["arcFit"] else None,
+                                  docSettings["decimateTolerance"] * scale if docSettings["decimate"] else None,
+                                  run.stats))
+    if len(filters) == 0:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return FilterChain(filters)
+
+
+regNoCode = re.compile(r"\s*(\([^)]*\)\s*)*$")
+
+def WriteBlocks(fileBody, text, fNum, lineNum):
+    # Write one or more lines, numbering each if fNum. Blank lines
+    # and comments aren't numbered. Returns the next line number.
+    if not fNum:
+        fileBody.write(text)
+        return lineNum
+    for line in text.splitlines(True):
+        if regNoCode.match(line) == None:
+            fileBody.write("N" + str(lineNum) + " ")
+            lineNum += constLineNumInc
+        fileBody.write(line)
+    return lineNum
+
+
+def AddTimeSaved(run, part, rapids):
+    if rapids.timeSaved > 0:
+        run.stats.Add("Seconds saved by rapid moves", rapids.timeSaved, "{}: {}".format(part.setupName, part.opName))
+
+
+def GetStockTop(setup, opList, docSettings):
+    # Top of the setup's stock box in the WCS, in cm, optionally raised
+    # to the operations' top heights. Returns None if it can't be
+    # determined. The origin must be a point on the stock box (not the
+    # model box), and the WCS must be in the model's orientation so the
+    # stock's Z extent is its height in the WCS.
+    try:
+        parameters = setup.parameters
+        if parameters.itemByName('wcs_origin_mode').value.value != "stockPoint" or \
+            parameters.itemByName('job_stockMode').value.value not in constStockBoxModes or \
+            parameters.itemByName('wcs_orientation_mode').value.value != "modelOrientation" or \
+            parameters.itemByName('wcs_orientation_flipZ').value.value:
+            return None
+        boxPoint = str(parameters.itemByName('wcs_origin_boxPoint').value.value).lower().split()
+        if boxPoint[0] == "top":
+            top = 0
+        elif boxPoint[0] == "bottom":
+            top = parameters.itemByName('stockZHigh').value.value - parameters.itemByName('stockZLow').value.value
+        else:
+            return None
     except:
-        if fileHead:
-            try:
-                fileHead.close()
-                os.remove(fileHead.name)
-            except:
-                pass
+        return None     # parameter missing
 
-        if fileBody:
+    if docSettings["useTopHeight"]:
+        for op in opList:
             try:
-                fileBody.close()
-                os.remove(fileBody.name)
+                if op.hasToolpath:
+                    top = max(top, op.parameters.itemByName('topHeight_value').value.value)
             except:
                 pass
+    return top
 
-        if fileOp:
-            try:
-                fileOp.close()
-                os.remove(fileOp.name)
-            except:
-                pass
 
-        if ui:
-            retVal += " " + traceback.format_exc()
+def GetStockSafeZ(top, docSettings, units):
+    # Height in the WCS that moves can stay at or above without touching
+    # the stock, in the program's units (G20 or G21): the stock top from
+    # GetStockTop plus the clearance setting. Returns None if it can't be
+    # determined.
+    if top == None or units not in (20, 21):
+        return None
 
-        return retVal
+    # Parameters are in cm, clearance setting in mm
+    if units == 21:
+        return top * 10 + docSettings["stockClearance"]
+    return top / 2.54 + docSettings["stockClearance"] / 25.4
+
+
+def OrderForTravel(parts, travelEnd, travel):
+    # Reorder the posted parts of one tool group to minimize the rapid
+    # travel between them. Only neighboring parts of the same setup (same
+    # coordinate system) that may be moved are moved, among themselves.
+    # travelEnd is (setup index, (x, y)) where the previous part ended,
+    # or None. The travel before and after is added to travel.
+    # Returns the new list and where its last part ends.
+    ends = [GetTravelEnds(part.fragment) for part in parts]
+    result = []
+    i = 0
+    while i < len(parts):
+        setup = parts[i].iSetup
+        j = i
+        while j < len(parts) and parts[j].iSetup == setup and ends[j] != None and parts[j].fMovable:
+            j += 1
+        j = max(j, i + 1)
+        order = list(range(i, j))
+        if len(order) > 1:
+            start = None
+            if travelEnd != None and travelEnd[0] == setup:
+                start = travelEnd[1]
+            before = TravelCost(order, ends, start)
+            best = SolveTravel(order, ends, start)
+            after = TravelCost(best, ends, start)
+            if after < before:
+                order = best
+            travel[0] += before
+            travel[1] += min(before, after)
+        for k in order:
+            result.append(parts[k])
+            travelEnd = None if ends[k] == None else (parts[k].iSetup, ends[k][1])
+        i = j
+    return result, travelEnd
+
+
+def SolveTravel(order, ends, start):
+    # Nearest neighbor, from each possible first operation when there is
+    # no fixed starting point, then improved by 2-opt
+    best = None
+    for first in order if start == None else [None]:
+        path = [] if first == None else [first]
+        left = [k for k in order if k != first]
+        pos = start if first == None else ends[first][1]
+        while len(left) != 0:
+            k = min(left, key=lambda k: math.dist(pos, ends[k][0]))
+            path.append(k)
+            left.remove(k)
+            pos = ends[k][1]
+        if best == None or TravelCost(path, ends, start) < TravelCost(best, ends, start):
+            best = path
+
+    cost = TravelCost(best, ends, start)
+    fImproved = True
+    while fImproved:
+        fImproved = False
+        for i in range(len(best) - 1):
+            for j in range(i + 1, len(best)):
+                path = best[:i] + best[i:j + 1][::-1] + best[j + 1:]
+                costTmp = TravelCost(path, ends, start)
+                if costTmp < cost - 1e-9:
+                    best = path
+                    cost = costTmp
+                    fImproved = True
+    return best
+
+
+def TravelCost(order, ends, start):
+    # XY distance moved between operations, starting from start if known
+    cost = 0
+    pos = start
+    for k in order:
+        if pos != None:
+            cost += math.dist(pos, ends[k][0])
+        pos = ends[k][1]
+    return cost
+
+
+regTravelWord = re.compile(r"([GXY])\s*([-+]?[0-9]*\.?[0-9]+)")
+
+def GetTravelEnds(path):
+    # Where the motion in posted G-code starts and ends in XY, as
+    # ((x, y), (x, y)), or None if it can't be determined
+    x = None
+    y = None
+    start = None
+    with open(path, encoding="utf8", errors='replace') as file:
+        for line in file:
+            words = regTravelWord.findall(ModalState.regComment.sub("", line).upper())
+            if len(words) == 0:
+                continue
+            Gcodes = {float(value) for letter, value in words if letter == "G"}
+            if Gcodes & {28, 30, 53}:
+                continue    # move home, not in work coordinates
+            if 91 in Gcodes:
+                return None     # incremental moves
+            for letter, value in words:
+                if letter == "X":
+                    x = float(value)
+                elif letter == "Y":
+                    y = float(value)
+            if start == None and x != None and y != None:
+                start = (x, y)
+    if start == None:
+        return None
+    return (start, (x, y))
+
+
+def ExtractSubprograms(path, style, run):
+    # Find runs of moves that repeat in the output file and move them to
+    # subprograms. The moves are compared as incremental moves, so copies
+    # in different places match. Repeats can be anywhere in the file, but
+    # it is read a line at a time, keeping only an ID for each line.
+    parser = MoveFilter(run.stats)
+    with open(path) as file:
+        for line in file:
+            parser.Parse(line)  # find the precision used
+    scale = 10 ** parser.decimals
+
+    # Give each move an ID by what it does; anything else gets an ID of its own
+    regEnd = re.compile(r"^\s*(N\d+\s*)?[^(;]*\bM\s*0?(2|30)\b", re.IGNORECASE)
+    tracker = MoveFilter(run.stats)
+    moves = {}
+    ids = array.array("q")
+    steps = {}          # move ID -> (step, words) of its first copy
+    progEnd = None      # last line ending the program
+    fPercent = False    # first line is %
+    with open(path) as file:
+        for line in file:
+            words = parser.Parse(line)
+            if regEnd.match(line):
+                progEnd = len(ids)
+            if len(ids) == 0:
+                fPercent = line.strip() == "%"
+            start = tracker.Position()
+            fMove = False
+            if words != None and start != None and tracker.fAbsolute and tracker.plane == 17:
+                Gcodes = [value for letter, value in words if letter == "G"]
+                fMove = len(Gcodes) <= 1 and all(letter in "NGXYZIJF" for letter, value in words) and \
+                    (Gcodes[0] if len(Gcodes) != 0 else tracker.motion) in (0, 1, 2, 3) and \
+                    any(letter in "XYZ" for letter, value in words)
+            if fMove:
+                tracker.Track(line, words)
+                end = tracker.Position()
+                step = [int(tracker.motion)] + [round((end[axis] - start[axis]) * scale) for axis in range(3)]
+                step += [round(value * scale) for letter, value in words if letter in "IJ"]
+                step.append(None if tracker.motion == 0 else tracker.feed)
+                step = tuple(step)
+                moveId = moves.setdefault(step, len(moves))
+                ids.append(moveId)
+                steps.setdefault(moveId, (step, words))
+            else:
+                if words == None or any(letter == "M" and value == 6 for letter, value in words):
+                    tracker.pos = [None, None, None]    # might have moved
+                else:
+                    tracker.Track(line, words)
+                ids.append(-1 - len(ids))
+
+    # Rolling hash of each window of constSubMinBlocks IDs
+    length = constSubMinBlocks
+    n = len(ids)
+    if n < length * 2 or (style == constSubM98 and progEnd == None):
+        return      # too short, or nowhere to put the subprograms
+    mod = (1 << 61) - 1
+    base = 1000003
+    power = pow(base, length, mod)
+    windows = {}
+    hashes = array.array("q", bytes(8 * n))
+    value = 0
+    for k in range(n):
+        value = (value * base + ids[k]) % mod
+        if k >= length:
+            value = (value - ids[k - length] * power) % mod
+        if k >= length - 1:
+            hashes[k - length + 1] = value
+            windows.setdefault(value, []).append(k - length + 1)
+
+    # Take repeats first come, first served, making each as long as
+    # all its copies allow
+    covered = bytearray(n)
+    subs = []
+    for first in range(n - length + 1):
+        if covered[first] or ids[first] < 0:
+            continue
+        starts = [first]
+        for start in windows[hashes[first]]:
+            if start >= starts[-1] + length and not any(covered[start:start + length]) and \
+                ids[start:start + length] == ids[first:first + length]:
+                starts.append(start)
+        if len(starts) < 2:
+            continue
+        size = length
+        while all(start + size < n and ids[start + size] == ids[first + size] and not covered[start + size]
+                for start in starts) and \
+            all(starts[k] + size + 1 <= starts[k + 1] for k in range(len(starts) - 1)):
+            size += 1
+        for start in starts:
+            covered[start:start + size] = b"\x01" * size
+        subs.append((first, size, starts))
+    if len(subs) == 0:
+        return
+
+    # Write the subprograms
+    def Format(value):
+        return tracker.FormatNumber(value / scale)
+
+    subText = []
+    calls = {}
+    saved = 0
+    for number, (first, size, starts) in enumerate(subs, constFirstSubprogram):
+        if style == constSubM98:
+            body = ["\n", "O{}\n".format(number)]
+            call = "M98 P{}\n".format(number)
+        else:
+            body = ["o{} sub\n".format(number)]
+            call = "o{} call\n".format(number)
+        body.append("G91\n")
+        motion = None
+        feed = None
+        for step, words in (steps[moveId] for moveId in ids[first:first + size]):
+            block = []
+            if step[0] != motion:
+                motion = step[0]
+                block.append("G{}".format(motion))
+            block += ["{}{}".format(axis, Format(step[1 + k])) for k, axis in enumerate("XYZ") if step[1 + k] != 0]
+            if len(block) == 0 or block == ["G{}".format(motion)]:
+                block.append("{}0.".format(next(letter for letter, value in words if letter in "XYZ")))
+            block += ["{}{}".format(letter, tracker.FormatNumber(value)) for letter, value in words if letter in "IJ"]
+            if step[-1] != None and step[-1] != feed:
+                feed = step[-1]
+                block.append("F" + tracker.FormatNumber(feed))
+            body.append(" ".join(block) + "\n")
+        body.append("G90\n")
+        body.append("M99\n" if style == constSubM98 else "o{} endsub\n".format(number))
+        subText.append("".join(body))
+        for start in starts:
+            calls[start] = (size, call)
+        saved += size * (len(starts) - 1) - len(starts) - 4
+
+    # Copy the file with calls in place of the repeats. M98 subprograms
+    # go after the end of the program; o-word subprograms must be defined
+    # before they're called.
+    if style == constSubM98:
+        after = progEnd
+    else:
+        after = 0 if fPercent else -1
+    tmpPath = path + constSubTmpExt
+    try:
+        with open(path) as file, open(tmpPath, "w") as out:
+            if after == -1:
+                out.writelines(subText)
+            skip = 0
+            for k, line in enumerate(file):
+                if skip != 0:
+                    skip -= 1
+                elif k in calls:
+                    size, call = calls[k]
+                    # keep the line number, if any
+                    match = re.match(r"\s*(N\d+\s+)", line)
+                    out.write((match.group(1) if match else "") + call)
+                    skip = size - 1
+                else:
+                    out.write(line)
+                if k == after:
+                    out.writelines(subText)
+        os.replace(tmpPath, path)
+    except:
+        try:
+            os.remove(tmpPath)
+        except OSError:
+            pass
+        raise
+    run.stats.Add("Subprograms", len(subs))
+    run.stats.Add("Blocks moved to subprograms", saved)
+
+
+def WriteRestartIndex(path, headSize, restarts):
+    # Write the index of where each operation starts in the output file,
+    # with the controller state there, for RestartProgram.py. restarts
+    # has offsets in the body, which follows headSize bytes of header.
+    state = ModalState()
+    entries = []
+    k = 0
+    offset = 0
+    with open(path, "rb") as file:
+        for lineNum, line in enumerate(file, 1):
+            while k < len(restarts) and restarts[k][0] + headSize <= offset:
+                entries.append({
+                    "setup" : restarts[k][1],
+                    "operation" : restarts[k][2],
+                    "offset" : offset,
+                    "line" : lineNum,
+                    "state" : state.Snapshot()})
+                k += 1
+            state.Update(line.decode("utf8", "replace"), True)
+            offset += len(line)
+    index = {"version" : 1, "file" : os.path.basename(path), "head" : headSize, "restarts" : entries}
+    with open(os.path.splitext(path)[0] + constRestartExt, "w") as file:
+        json.dump(index, file, indent=1)
+
+
+regWcs = re.compile(r"(?<![A-Z])G\s*0*5[4-9](?:\.1\s*P\s*[0-9]+)?(?![0-9.])", re.IGNORECASE)
+
+def CopyForFixtures(fileBody, start, fixtures, fNum, regBody, lineNum):
+    # Repeat the body written since start for each fixture after the
+    # first, changing the work offset and line numbers.
+    # Returns the next line number.
+    fileBody.flush()
+    with tempfile.SpooledTemporaryFile(constTailSpoolSize, "w+", newline="") as fileCopy:
+        with open(fileBody.name) as fileSrc:
+            fileSrc.seek(start)
+            shutil.copyfileobj(fileSrc, fileCopy)
+        for code in fixtures[1:]:
+            lineNum = WriteBlocks(fileBody, code + "\n", fNum, lineNum)
+            fileCopy.seek(0)
+            for line in fileCopy:
+                match = regBody.match(line).groupdict()
+                line = regWcs.sub(code, match["line"])
+                if match["N"] != None:
+                    fileBody.write("N" + str(lineNum) + " ")
+                    lineNum += constLineNumInc
+                fileBody.write(line)
+    return lineNum
+
+
+def NextTool(tools, start, curTool):
+    # Find the tool used next after the current one: the first entry
+    # from start on that is a different tool. Entries of None (no tool)
+    # are skipped. Returns None if no other tool follows.
+    for tool in tools[start:]:
+        if tool != None and tool != curTool:
+            return tool
+    return None
+
+
+def ScanTail(fileOp, line, regBody, tailFile, pendingStopCmds, lineNum):
+    # Stream the tail of an operation one line at a time, starting with
+    # line. M0/M1 (program stop) commands from Manual NC operations are
+    # saved in pendingStopCmds to be written at the start of the next
+    # operation. All other lines go to tailFile, or are dropped if it is
+    # None. Nothing is accumulated in memory, so an end code that matches
+    # early in a very large file is harmless. Returns updated line number.
+    while len(line) != 0:
+        if re.search(r'\bM\s*[01]\b', line, re.IGNORECASE):
+            match = regBody.match(line)
+            if match:
+                match = match.groupdict()
+                if match["N"] != None:
+                    stopCmd = "N" + str(lineNum) + " " + match["line"]
+                    lineNum += constLineNumInc
+                else:
+                    stopCmd = line
+                pendingStopCmds.append(stopCmd)
+        elif tailFile is not None:
+            tailFile.write(line)
+        line = fileOp.readline()
+    return lineNum
+
+
+def WriteTail(fileBody, tailFile, regBody, lineNum):
+    # Write the saved tail to the body, renumbering lines if present.
+    # The tail file is closed (and deleted). Returns updated line number.
+    if tailFile is None:
+        return lineNum
+    tailFile.seek(0)
+    for code in tailFile:
+        match = regBody.match(code)
+        if match:
+            match = match.groupdict()
+            if match["N"] != None:
+                fileBody.write("N" + str(lineNum) + " " + match["line"])
+                lineNum += constLineNumInc
+                continue
+        fileBody.write(code)
+    tailFile.close()
+    return lineNum
+
+
+def MakeEndRegex(endMcodeSet, endGcodeSet):
+    # Build a byte regex matching the start of any line that ends the body
+    # the same way the line-by-line parser does: a leading M-code in the
+    # end list, or a G-code in the list following an optional M-code. It
+    # also matches a line number (N), which has to be rewritten.
+    alts = [rb"(?P<N>N)"]
+    if len(endMcodeSet) != 0:
+        codes = "|".join(str(code) for code in endMcodeSet).encode()
+        alts.append(rb"M0*(?:" + codes + rb")(?![0-9])")
+    if len(endGcodeSet) != 0:
+        codes = "|".join(str(code) for code in endGcodeSet).encode()
+        alts.append(rb"(?:M[0-9]+ *)?G0*(?:" + codes + rb")(?![0-9])")
+    return re.compile(rb"^(?:" + rb"|".join(alts) + rb")", re.IGNORECASE | re.MULTILINE)
+
+
+# Bytes that would not come through a text mode read and write unchanged:
+# non-ASCII characters, and line endings other than the native ones
+if os.linesep == "\r\n":
+    regPassthroughUnsafe = re.compile(rb"[^\x00-\x7f]|\r(?!\n)|(?<!\r)\n")
+else:
+    regPassthroughUnsafe = re.compile(rb"[^\x00-\x7f]|\r")
+
+
+def CopyBodyUnchanged(fileOp, fileBody, regEnd):
+    # Copy the rest of an operation body from the posted file to the output
+    # without parsing it a line at a time. The posted file is memory mapped
+    # and searched once for the start of the tail, then the bytes up to it
+    # are copied by the kernel where possible, or as slices of the map.
+    # On success, fileOp is left at the start of the tail and the number of
+    # bytes copied is returned. If the body can't be passed through as is
+    # (line numbers, unexpected characters), None is returned and fileOp
+    # is left where it was.
+    start = fileOp.tell()
+    with open(fileOp.name, "rb") as fileRaw:
+        size = os.fstat(fileRaw.fileno()).st_size
+        # tell() is only a byte offset when the decoder has no pending state
+        if start == 0 or start >= size:
+            return None
+        with mmap.mmap(fileRaw.fileno(), 0, access=mmap.ACCESS_READ) as fileMap:
+            if fileMap[start - 1] != ord("\n"):
+                return None
+            match = regEnd.search(fileMap, start)
+            if match is None:
+                end = size
+            elif match.group("N") != None:
+                return None
+            else:
+                end = match.start()
+            if regPassthroughUnsafe.search(fileMap, start, end):
+                return None
+
+            fileBody.flush()
+            fileDst = fileBody.buffer
+            fileDst.flush()
+            pos = start
+            if hasattr(os, "copy_file_range"):
+                try:
+                    while pos < end:
+                        cnt = os.copy_file_range(fileRaw.fileno(), fileDst.fileno(), end - pos, pos)
+                        if cnt == 0:
+                            break
+                        pos += cnt
+                except OSError:
+                    pass
+                # resynchronize buffered position with the file descriptor
+                fileDst.seek(0, os.SEEK_END)
+            with memoryview(fileMap) as view:
+                while pos < end:
+                    cnt = min(end - pos, constCopyBlockSize)
+                    fileDst.write(view[pos:pos + cnt])
+                    pos += cnt
+    fileOp.seek(end)
+    return end - start
@@ -0,0 +1,127 @@
+#Description-Make a program that restarts a G-code file from Post Process All at an operation.
+#
+# Usage:
+#   python RestartProgram.py <G-code file>              list the operations
+#   python RestartProgram.py <G-code file> <number>     restart at an operation
+#   python RestartProgram.py --safe "<blocks>" <G-code file> <number>
+#                                                       retract with <blocks>
+#
+# This uses the restart index written next to the G-code file when
+# "Write restart index" is checked. The restart program is written next
+# to the G-code file, with "-RESTART-<number>" added to the name. It has
+# the header of the program, blocks to retract the spindle to a safe
+# height, the blocks to restore the tool, work offset, spindle, coolant
+# and other modes in effect where the operation starts, then the rest of
+# the program from there. The safe blocks are separated by ":". If the
+# operation starts with its own tool change, the tool, length offset,
+# spindle and coolant are left to it. It runs without Fusion.
+
+import json, os, os.path, re, sys
+
+constRestartExt = ".restart.json"
+constRestartName = "{}-RESTART-{}{}"
+
+# Default blocks to retract the spindle before anything else
+constSafeBlocks = "G28 G91 Z0.:G90"
+# Lines searched for a tool change before the first move
+constToolChangeLines = 40
+
+# Modes restored before the tool change, in order
+restoreModes = ("units", "plane", "distance", "feedMode")
+# State the operation's own tool change sets again
+toolChangeState = ("tool", "length", "spindle", "speed", "coolant")
+
+regComment = re.compile(r"\(.*?\)|;.*")
+regToolChange = re.compile(r"(^|[^A-Z])M0*6(?!\d)")
+regMove = re.compile(r"(^|[^A-Z])(G0*[0-3](?![\d.])|[XYZ][-+.\d])")
+
+
+def ReadIndex(path):
+    indexPath = os.path.splitext(path)[0] + constRestartExt
+    try:
+        with open(indexPath) as file:
+            return json.load(file)
+    except OSError:
+        sys.exit("No restart index '" + indexPath + "'. Post with \"Write restart index\" checked.")
+
+
+def StartsWithToolChange(body):
+    # True if the body changes tools before it moves
+    for line in body.splitlines()[:constToolChangeLines]:
+        line = regComment.sub("", line.decode("utf8", "replace")).upper()
+        if regToolChange.search(line):
+            return True
+        if regMove.search(line):
+            return False
+    return False
+
+
+def RestoreBlocks(state, safe):
+    # G-code to put the controller in the given state
+    blocks = [block for block in safe.split(":") if len(block.strip()) > 0]
+    blocks += [state[group] for group in restoreModes if group in state]
+    if "tool" in state:
+        blocks.append("T{} M6".format(state["tool"]))
+    if "wcs" in state:
+        blocks.append(state["wcs"])
+    if "length" in state:
+        blocks.append(state["length"])
+    if "spindle" in state:
+        spindle = state["spindle"]
+        if "speed" in state and spindle != "M5":
+            spindle = "S{} {}".format(state["speed"], spindle)
+        blocks.append(spindle)
+    if "coolant" in state:
+        blocks.append(state["coolant"])
+    if "feed" in state:
+        blocks.append("F{}".format(state["feed"]))
+    return blocks
+
+
+def WriteRestart(path, index, number, safe):
+    restart = index["restarts"][number - 1]
+    base, ext = os.path.splitext(path)
+    outPath = constRestartName.format(base, number, ext)
+    with open(path, "rb") as file:
+        head = file.read(index["head"])
+        file.seek(restart["offset"])
+        body = file.read()
+    newline = b"\r\n" if b"\r\n" in head else b"\n"
+    restore = ["(Restart at {}: {})".format(restart["setup"], restart["operation"])]
+    state = restart["state"]
+    if StartsWithToolChange(body):
+        state = {group: value for group, value in state.items() if group not in toolChangeState}
+    restore += RestoreBlocks(state, safe)
+    with open(outPath, "wb") as file:
+        file.write(head)
+        for block in restore:
+            file.write(block.encode("utf8") + newline)
+        file.write(body)
+    return outPath
+
+
+def main(args):
+    safe = constSafeBlocks
+    if len(args) > 1 and args[0] == "--safe":
+        safe = args[1]
+        args = args[2:]
+    if len(args) < 1 or len(args) > 2:
+        sys.exit("Usage: python RestartProgram.py [--safe \"<blocks>\"] <G-code file> [<operation number>]")
+    path = args[0]
+    index = ReadIndex(path)
+    restarts = index["restarts"]
+    if len(args) == 1:
+        for number, restart in enumerate(restarts, 1):
+            print("{:4}  line {:<8} {}: {}".format(number, restart["line"], restart["setup"], restart["operation"]))
+        return
+    try:
+        number = int(args[1])
+    except ValueError:
+        number = 0
+    if number < 1 or number > len(restarts):
+        sys.exit("Operation number must be 1 to {}.".format(len(restarts)))
+    print("Wrote " + WriteRestart(path, index, number, safe))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])